@@ -0,0 +1,183 @@
+# coding=utf-8
+
+########################################################################
+#                                                                      #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                          #
+#                                                                      #
+# Background variability model                                         #
+#                                                                      #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com       #
+#                                                                      #
+########################################################################
+"""
+Robust statistics of the background variability of each CCD and of regions
+of the CCDs, and the map of the lower limit of detection derived from them.
+CCDs with a high particle background have a higher variability level, and
+get a higher detection limit than the quiet ones.
+"""
+
+# Third-party imports
+
+import numpy as np
+
+# Ratio between the standard deviation and the median absolute deviation of
+# a normal distribution
+MAD_SIGMA = 1.4826
+
+# Quantiles of the variability written with the statistics
+QUANTILES = (0.1, 0.5, 0.9, 0.99)
+
+BACKGROUND_DTYPE = [('CCDNR', 'i2'), ('REGION', 'i2'), ('NPIX', 'i4'),
+        ('MEDIAN', 'f8'), ('MAD', 'f8')] + \
+        [('Q{0:g}'.format(100 * q), 'f8') for q in QUANTILES]
+
+########################################################################
+
+
+def window_median(values, first, last) :
+    """
+    Function computing the median of a window of each row of a sorted matrix.
+    @param values: The matrix, sorted along its last axis
+    @param first: The first index of the window of each row
+    @param last: The index after the window of each row
+    @return: The median of the window of each row
+    """
+    rows = np.arange(len(values))
+    n = last - first
+
+    return (values[rows, first + (n - 1) // 2] +
+            values[rows, first + n // 2]) / 2
+
+########################################################################
+
+
+def clipped_statistics(values, n_sigma=3.0, iterations=5) :
+    """
+    Function computing the sigma-clipped median and median absolute
+    deviation of groups of values, all the groups at once. The values are
+    sorted once, so that the values kept in a group are a window of it.
+    @param values: The values, of shape (n_groups, n_values)
+    @param n_sigma: The clipping limit, in units of MAD_SIGMA * MAD
+    @param iterations: The maximal number of clipping iterations
+    @return: The median, the MAD and the number of values kept, per group
+    """
+    data = np.sort(np.asarray(values, dtype=np.float64), axis=-1)
+    index = np.arange(data.shape[-1])
+    first = np.zeros(len(data), dtype=np.int64)
+    last  = np.full(len(data), data.shape[-1], dtype=np.int64)
+
+    for i in range(iterations + 1) :
+        median = window_median(data, first, last)
+
+        # Deviations of the kept values, the others being moved to the end
+        deviation = np.absolute(data - median[:, None])
+        deviation[(index < first[:, None]) | (index >= last[:, None])] = np.inf
+        deviation.sort(axis=-1)
+        mad = window_median(deviation, np.zeros_like(first), last - first)
+
+        if i == iterations :
+            break
+
+        # Groups with a null MAD are not clipped
+        limit = np.where(mad > 0, n_sigma * MAD_SIGMA * mad, np.inf)
+        new_first = np.maximum(first, np.sum(data < (median - limit)[:, None],
+                axis=-1))
+        new_last = np.minimum(last, np.sum(data <= (median + limit)[:, None],
+                axis=-1))
+        if np.array_equal(new_first, first) and \
+                np.array_equal(new_last, last) :
+            break
+        first, last = new_first, new_last
+
+    return median, mad, last - first
+
+########################################################################
+
+
+def region_values(v_matrix, regions) :
+    """
+    Function grouping the pixels of the CCDs by region.
+    @param v_matrix: The V round matrix of each CCD, of shape (12, 64, 200)
+    @param regions: The number of regions along RAWX and RAWY
+    @return: The values of each region, of shape (12 * nx * ny, n_pixels),
+             ordered by CCD, RAWX block and RAWY block
+    """
+    v_matrix = np.asarray(v_matrix, dtype=np.float64)
+    nx, ny = regions
+    sx, sy = v_matrix.shape[1] // nx, v_matrix.shape[2] // ny
+    if sx * nx != v_matrix.shape[1] or sy * ny != v_matrix.shape[2] :
+        raise ValueError("{0} x {1} regions do not divide a CCD of {2} x {3} "
+                "pixels".format(nx, ny, *v_matrix.shape[1:]))
+
+    blocks = v_matrix.reshape(12, nx, sx, ny, sy).transpose(0, 1, 3, 2, 4)
+
+    return blocks.reshape(12 * nx * ny, sx * sy)
+
+########################################################################
+
+
+def background_model(v_matrix, regions=(1, 4), n_sigma=3.0, iterations=5) :
+    """
+    Function computing the robust statistics of the variability of each CCD
+    and of each region of the CCDs. The median and the MAD are sigma-clipped,
+    the quantiles are those of all the pixels.
+    @param v_matrix: The V round matrix of each CCD
+    @param regions: The number of regions along RAWX and RAWY
+    @param n_sigma: The clipping limit, in units of MAD_SIGMA * MAD
+    @param iterations: The maximal number of clipping iterations
+    @return: Record array of BACKGROUND_DTYPE, one row per CCD with REGION
+             set to -1, then one row per region
+    """
+    v_matrix = np.asarray(v_matrix, dtype=np.float64)
+    n_regions = regions[0] * regions[1]
+
+    # Whole CCDs, then regions, in one pass
+    values = [v_matrix.reshape(12, -1)]
+    if n_regions > 1 :
+        values.append(region_values(v_matrix, regions))
+    ccd    = [np.arange(12)] + [np.arange(12).repeat(n_regions)] * \
+            (len(values) - 1)
+    region = [np.full(12, -1)] + [np.tile(np.arange(n_regions), 12)] * \
+            (len(values) - 1)
+
+    model = np.zeros(sum([len(v) for v in values]), dtype=BACKGROUND_DTYPE)
+    model['CCDNR']  = np.concatenate(ccd) + 1
+    model['REGION'] = np.concatenate(region)
+
+    first = 0
+    for group in values :
+        last = first + len(group)
+        median, mad, npix = clipped_statistics(group, n_sigma, iterations)
+        quantiles = np.quantile(group, QUANTILES, axis=-1)
+        model['MEDIAN'][first:last] = median
+        model['MAD'][first:last]    = mad
+        model['NPIX'][first:last]   = npix
+        for q, name in zip(quantiles, BACKGROUND_DTYPE[5:]) :
+            model[name[0]][first:last] = q
+        first = last
+
+    return model
+
+########################################################################
+
+
+def threshold_map(model, regions, lower_limit, n_mad=0.0) :
+    """
+    Function computing the lower limit of detection of each pixel from the
+    background model: the clipped median of its region, raised by n_mad
+    times the MAD, and never below the global lower limit.
+    @param model: The background_model output
+    @param regions: The number of regions along RAWX and RAWY of the model
+    @param lower_limit: The global lower limit
+    @param n_mad: The number of MAD added to the median
+    @return: The lower limit of each pixel, of shape (12, 64, 200)
+    """
+    nx, ny = regions
+    if nx * ny > 1 :
+        rows = model[model['REGION'] >= 0]
+    else :
+        rows = model[model['REGION'] < 0]
+    level = (rows['MEDIAN'] + n_mad * MAD_SIGMA * rows['MAD'])
+    level = np.maximum(level, lower_limit).reshape(12, nx, ny)
+
+    return level.repeat(64 // nx, axis=1).repeat(200 // ny, axis=2)
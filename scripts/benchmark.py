@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+########################################################################
+#                                                                      #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                          #
+#                                                                      #
+# Benchmark of the detector stages                                     #
+#                                                                      #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com       #
+#                                                                      #
+########################################################################
+"""
+Benchmark of the stages of the detector on synthetic observations. Each
+stage is timed separately, and the results are written to a JSON file and
+appended to a CSV file, one row per stage, to follow the performance across
+versions.
+"""
+
+# Built-in imports
+
+import sys
+import os
+import time
+import json
+import platform
+import subprocess
+
+# Running edet2sky_stub when SAS is not available
+os.environ.setdefault('EXOD_EDET2SKY', '{0} {1}'.format(sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'edet2sky_stub.py')))
+
+# Third-party imports
+
+from astropy.io import fits
+import numpy as np
+import argparse
+import matplotlib
+matplotlib.use('Agg')
+
+# Internal imports
+
+from fits_extractor import *
+from variability_utils import *
+from file_utils import *
+from renderer import render_variability
+from synthetic import Flare, generate_observation
+import file_names as FileNames
+
+# Benchmark configurations: duration (s), rate (counts/s), time window (s)
+CONFIGURATIONS = {
+    'small'  : (20000.0, 10.0, 100.0),
+    'medium' : (60000.0, 50.0, 100.0),
+    'large'  : (120000.0, 200.0, 10.0),
+}
+
+########################################################################
+#                                                                      #
+# Timing                                                               #
+#                                                                      #
+########################################################################
+
+class Timer(object):
+    """
+    Timer of the stages of the benchmark.\n
+
+    Attributes:\n
+    times:  Dictionary of the durations of each stage, one per repetition
+    """
+
+    def __init__(self):
+        super(Timer, self).__init__()
+        self.times = {}
+
+
+    def run(self, stage, function, *args, **kwargs) :
+        """
+        Runs and times a function.
+        @return: The result of the function
+        """
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.times.setdefault(stage, []).append(time.perf_counter() - start)
+
+        return result
+
+########################################################################
+
+
+def version() :
+    """
+    Returns the git description of the scripts, or None.
+    """
+    try :
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                universal_newlines=True).stdout.strip() or None
+    except OSError :
+        return None
+
+########################################################################
+#                                                                      #
+# Stages                                                               #
+#                                                                      #
+########################################################################
+
+def benchmark_observation(path, tw, gtr, bs, dl, timer, render=True) :
+    """
+    Function running the stages of the detector on an observation.
+    @param path: The observation folder
+    @param tw: The time window
+    @param gtr: The good time ratio
+    @param bs: The box size
+    @param dl: The detection level
+    @param timer: The Timer
+    @param render: If the rendering is timed
+    @return: The number of detected sources
+    """
+    evts = path + FileNames.CLEAN_FILE
+    img  = path + FileNames.IMG_FILE
+    out  = path + 'benchmark/'
+    os.makedirs(out, exist_ok=True)
+
+    data, header, (t0, tf) = timer.run('extraction', extraction_events, evts)
+    gti = extraction_deleted_periods(path + FileNames.GTI_FILE)
+
+    time_windows = time_window_grid(t0, tf, tw, gtr)
+    counts = timer.run('binning', lambda : [count_events(data[ccd],
+            time_windows, tw) for ccd in range(12)])
+    projection_ratio = timer.run('gti_projection', projection_ratios, gti,
+            time_windows, tw)
+    v_matrix = timer.run('variability', lambda : [variability_from_counts(
+            counts[ccd], projection_ratio, gtr) for ccd in range(12)])
+
+    median = max(np.median(v_matrix), 0.75)
+    variable_areas = timer.run('box_detection', lambda : [
+            variable_areas_detection(median, bs, dl, v_matrix[ccd])
+            for ccd in range(12)])
+
+    with open(out + FileNames.LOG, 'w') as log_f :
+        sources = timer.run('positions', variable_sources_position,
+                variable_areas, header['OBS_ID'], path,
+                out + FileNames.REGION, log_f, img)
+
+    img_v = timer.run('transformation', lambda : data_transformation(
+            ccd_config(v_matrix), header))
+
+    params = {'CREATOR' : 'benchmark', 'DATE' : time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.gmtime()), 'OBS_ID' : header['OBS_ID'],
+            'TW' : tw, 'GTR' : gtr, 'DL' : dl, 'BS' : bs}
+    timer.run('fits_writing', fits_writer, img_v, sources, img, params,
+            out + FileNames.VARIABILITY, ccd_data=v_matrix)
+
+    if render :
+        timer.run('rendering', render_variability, out + FileNames.VARIABILITY,
+                out + FileNames.OUTPUT_IMAGE_SRCS, sources=True,
+                maximum_value=10)
+
+    return len(sources)
+
+########################################################################
+#                                                                      #
+# Main programme                                                       #
+#                                                                      #
+########################################################################
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark of the detector "
+            "stages on synthetic observations")
+    parser.add_argument("-path", help="Folder where the synthetic "
+            "observations are generated", default='/tmp/exod_benchmark',
+            type=str)
+    parser.add_argument("-configs", help="Configurations to run, among {0}"
+            .format(', '.join(CONFIGURATIONS)), default=['small'], nargs='+',
+            type=str)
+    parser.add_argument("-repeat", help="Number of repetitions",
+            default=3, type=int)
+    parser.add_argument("-gaps", help="Number of GTI gaps", default=5,
+            type=int)
+    parser.add_argument("-bs", "--box-size", dest="bs", default=3, type=int)
+    parser.add_argument("-dl", "--detection-level", dest="dl", default=8,
+            type=float)
+    parser.add_argument("-gtr", "--good-time-ratio", dest="gtr", default=1.0,
+            type=float)
+    parser.add_argument("-json", help="Output JSON file. Default: "
+            "benchmark_<date>.json in the path", default=None, type=str)
+    parser.add_argument("-csv", help="CSV file the results are appended to. "
+            "Default: benchmark.csv in the path", default=None, type=str)
+    parser.add_argument("--no-render", dest="render", action='store_false',
+            help="Do not time the rendering")
+    args = parser.parse_args()
+
+    if args.path[-1] != '/' :
+        args.path += '/'
+    date = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime())
+    if args.json == None :
+        args.json = args.path + 'benchmark_{0}.json'.format(
+                date.replace(':', ''))
+    if args.csv == None :
+        args.csv = args.path + 'benchmark.csv'
+
+    results = {
+        'date'     : date,
+        'version'  : version(),
+        'host'     : {'machine' : platform.machine(),
+                      'python'  : platform.python_version(),
+                      'numpy'   : np.__version__,
+                      'cpus'    : os.cpu_count()},
+        'configs'  : {},
+    }
+
+    for config in args.configs :
+        duration, rate, tw = CONFIGURATIONS[config]
+        path = args.path + config + '/'
+
+        # Regular GTI gaps, and one flare of 3 x 3 pixels per CCD lasting
+        # 10 time windows with 30 events per window
+        gap = duration / (4 * (args.gaps + 1))
+        gaps = [(k * duration / (args.gaps + 1), k * duration /
+                (args.gaps + 1) + gap) for k in range(1, args.gaps + 1)]
+        flares = [Flare(ccd + 1, 32, 100, (ccd + 0.5) * duration / 13,
+                10 * tw, 300) for ccd in range(12)]
+
+        print(" Generating {0} observation".format(config))
+        n_events = generate_observation(path, duration, rate, gaps, flares)
+
+        timer = Timer()
+        for k in range(args.repeat) :
+            print(" {0} : repetition {1}".format(config, k + 1))
+            n_sources = benchmark_observation(path, tw, args.gtr, args.bs,
+                    args.dl, timer, args.render)
+
+        results['configs'][config] = {
+            'duration' : duration, 'rate' : rate, 'tw' : tw,
+            'gaps' : args.gaps, 'flares' : len(flares),
+            'events' : n_events, 'sources' : n_sources,
+            'stages' : {stage : {'min' : min(times),
+                    'median' : float(np.median(times)), 'times' : times}
+                    for stage, times in timer.times.items()}}
+
+        for stage, times in timer.times.items() :
+            print("\t{0:<16}{1:9.3f} s".format(stage, min(times)))
+
+    with open(args.json, 'w') as f :
+        json.dump(results, f, indent=1)
+
+    write_header = not os.path.isfile(args.csv)
+    with open(args.csv, 'a') as f :
+        if write_header :
+            f.write('date,version,config,events,stage,min,median\n')
+        for config, res in results['configs'].items() :
+            for stage, t in res['stages'].items() :
+                f.write('{0},{1},{2},{3},{4},{5:.6f},{6:.6f}\n'.format(date,
+                        results['version'], config, res['events'], stage,
+                        t['min'], t['median']))
+
+    print(" Results written to {0} and {1}".format(args.json, args.csv))
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+########################################################################
+#                                                                      #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                          #
+#                                                                      #
+# Archive-wide catalogue of the variable sources                       #
+#                                                                      #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com       #
+#                                                                      #
+########################################################################
+"""
+Catalogue of the variable sources of all the observations, stored in a
+SQLite database. Each run of the detector, i.e. an observation and a set of
+parameters, is ingested with its source table; ingesting a run again replaces
+its sources. The positions are indexed by their unit vectors in an R*Tree,
+so that cone searches do not depend on the RA wrap or on the poles.
+The database is in WAL mode and each ingestion is one transaction, so that
+many detector processes of the same machine may write to it at the same time.
+"""
+
+# Built-in imports
+
+import sys
+import os
+import time
+import sqlite3
+from contextlib import contextmanager
+
+# Third-party imports
+
+import argparse
+import numpy as np
+from astropy.io import ascii
+
+# Internal imports
+
+import file_names as FileNames
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    RUN_ID    INTEGER PRIMARY KEY,
+    OBS_ID    TEXT NOT NULL,
+    DL        REAL NOT NULL,
+    TW        REAL NOT NULL,
+    BS        INTEGER NOT NULL,
+    GTR       REAL NOT NULL,
+    DATE_OBS  TEXT,
+    TSTART    REAL,
+    PATH      TEXT,
+    INGESTED  TEXT,
+    NSRC      INTEGER,
+    UNIQUE (OBS_ID, DL, TW, BS, GTR)
+);
+CREATE TABLE IF NOT EXISTS sources (
+    SRC_ID    INTEGER PRIMARY KEY,
+    RUN_ID    INTEGER NOT NULL REFERENCES runs (RUN_ID),
+    ID        INTEGER,
+    CCDNR     INTEGER,
+    RAWX      REAL,
+    RAWY      REAL,
+    RAWR      REAL,
+    X         REAL,
+    Y         REAL,
+    SKYR      REAL,
+    RA        REAL,
+    DEC       REAL,
+    R         REAL,
+    CX        REAL,
+    CY        REAL,
+    CZ        REAL
+);
+CREATE INDEX IF NOT EXISTS sources_run ON sources (RUN_ID);
+CREATE VIRTUAL TABLE IF NOT EXISTS sources_index USING rtree (
+    SRC_ID, XMIN, XMAX, YMIN, YMAX, ZMIN, ZMAX
+);
+"""
+
+# Columns of the source tables written by the detector
+SOURCE_COLUMNS = ['ID', 'CCDNR', 'RAWX', 'RAWY', 'RAWR', 'X', 'Y', 'SKYR',
+        'RA', 'DEC', 'R']
+
+########################################################################
+
+
+def unit_vector(ra, dec) :
+    """
+    Function giving the unit vectors of sky positions.
+    @param ra: The right ascensions in degrees
+    @param dec: The declinations in degrees
+    @return: The x, y and z components
+    """
+    ra  = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+
+    return np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)
+
+########################################################################
+
+
+def run_parameters(folder) :
+    """
+    Function reading the observation and the parameters of a run from the
+    name of its output folder, <obs>/<DL>_<TW>_<BS>_<GTR>/.
+    @param folder: The output folder of the detector
+    @return: The observation ID and the parameters DL, TW, BS and GTR
+    """
+    folder = os.path.normpath(folder)
+    dl, tw, bs, gtr = os.path.basename(folder).split('_')
+
+    return os.path.basename(os.path.dirname(folder)), {'DL' : float(dl),
+            'TW' : float(tw), 'BS' : int(bs), 'GTR' : float(gtr)}
+
+########################################################################
+
+
+class Catalogue(object):
+    """
+    Archive-wide catalogue of the variable sources.\n
+
+    Attributes:\n
+    path:       The path to the database\n
+    connection: The connection to the database, in autocommit mode so that
+                the transactions are opened explicitly
+    """
+
+    def __init__(self, path, timeout=60):
+        """
+        Constructor for Catalogue class. The database is created if needed.
+        @param path: The path to the database
+        @param timeout: The time in seconds waited for the other writers
+        """
+        super(Catalogue, self).__init__()
+
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout,
+                isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA busy_timeout = {0}".format(
+                int(timeout * 1000)))
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+
+        with self.transaction() :
+            for statement in SCHEMA.split(';') :
+                if statement.strip() != '' :
+                    self.connection.execute(statement)
+
+
+    def __enter__(self) :
+        return self
+
+
+    def __exit__(self, *exc) :
+        self.close()
+
+
+    def close(self) :
+        """
+        Closes the connection to the database.
+        """
+        self.connection.close()
+
+
+    @contextmanager
+    def transaction(self) :
+        """
+        Context manager of a write transaction. The write lock is taken at
+        the start, so that concurrent writers wait instead of failing when
+        upgrading a read lock.
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try :
+            yield self.connection
+        except BaseException :
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+
+    def ingest(self, sources, obs, params, date_obs=None, tstart=None,
+            path=None) :
+        """
+        Ingests the source table of a run, replacing the sources of a
+        previous ingestion of the same run.
+        @param sources: The source table, with the SOURCE_COLUMNS
+        @param obs: The observation ID
+        @param params: The parameters of the run, with DL, TW, BS and GTR
+        @param date_obs: The start date of the observation, ISO format
+        @param tstart: The start time of the observation
+        @param path: The output folder of the run
+        @return: The number of sources ingested
+        """
+        key = (str(obs), float(params['DL']), float(params['TW']),
+                int(params['BS']), float(params['GTR']))
+
+        rows = []
+        for src in sources :
+            values = [None if np.ma.is_masked(src[c]) else src[c].item()
+                    for c in SOURCE_COLUMNS]
+            ra, dec = values[8], values[9]
+            if ra == None or dec == None or not np.isfinite([ra, dec]).all() :
+                rows.append(values + [None, None, None])
+            else :
+                rows.append(values + [float(v) for v in unit_vector(ra, dec)])
+
+        with self.transaction() as c :
+            old = c.execute("SELECT RUN_ID FROM runs WHERE OBS_ID = ? AND "
+                    "DL = ? AND TW = ? AND BS = ? AND GTR = ?", key).fetchone()
+            if old != None :
+                c.execute("DELETE FROM sources_index WHERE SRC_ID IN (SELECT "
+                        "SRC_ID FROM sources WHERE RUN_ID = ?)", (old[0],))
+                c.execute("DELETE FROM sources WHERE RUN_ID = ?", (old[0],))
+                c.execute("DELETE FROM runs WHERE RUN_ID = ?", (old[0],))
+
+            run_id = c.execute("INSERT INTO runs (OBS_ID, DL, TW, BS, GTR, "
+                    "DATE_OBS, TSTART, PATH, INGESTED, NSRC) VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", key + (date_obs,
+                    tstart, path, time.strftime("%Y-%m-%d %H:%M:%S",
+                    time.gmtime()), len(rows))).lastrowid
+
+            for row in rows :
+                src_id = c.execute("INSERT INTO sources (RUN_ID, {0}, CX, CY, "
+                        "CZ) VALUES (?, {1})".format(', '.join(SOURCE_COLUMNS),
+                        ', '.join(['?'] * (len(SOURCE_COLUMNS) + 3))),
+                        [run_id] + row).lastrowid
+                if row[-1] != None :
+                    cx, cy, cz = row[-3:]
+                    c.execute("INSERT INTO sources_index VALUES "
+                            "(?, ?, ?, ?, ?, ?, ?)", (src_id, cx, cx, cy, cy,
+                            cz, cz))
+
+        return len(rows)
+
+
+    def ingest_file(self, file, obs=None, params=None) :
+        """
+        Ingests the variable_sources.csv file of a run. The observation and
+        the parameters are read from the folder name when not given.
+        @param file: The source table file
+        @param obs: The observation ID
+        @param params: The parameters of the run, with DL, TW, BS and GTR
+        @return: The number of sources ingested
+        """
+        folder = os.path.dirname(os.path.abspath(file))
+        if obs == None or params == None :
+            folder_obs, folder_params = run_parameters(folder)
+            obs    = folder_obs if obs == None else obs
+            params = folder_params if params == None else params
+
+        sources = ascii.read(file, format='csv')
+        if len(sources) == 0 :
+            sources = []
+
+        return self.ingest(sources, obs, params, path=folder + '/')
+
+
+    def cone_search(self, ra, dec, radius, **params) :
+        """
+        Finds the sources within a radius of a position.
+        @param ra: The right ascension in degrees
+        @param dec: The declination in degrees
+        @param radius: The radius in arcseconds
+        @param params: The parameters DL, TW, BS or GTR the runs must have
+        @return: The sources, with their run and their separation SEP in
+                 arcseconds, by increasing separation
+        """
+        cx, cy, cz = [float(v) for v in unit_vector(ra, dec)]
+        # Chord of the radius, bounding the unit vectors along each axis
+        chord = 2 * np.sin(np.radians(radius / 3600) / 2)
+        cos_r = np.cos(np.radians(radius / 3600))
+
+        conditions = ["s.CX * ? + s.CY * ? + s.CZ * ? >= ?"]
+        values = [cx, cy, cz, cos_r]
+        for name, value in params.items() :
+            if name not in ('DL', 'TW', 'BS', 'GTR') :
+                raise ValueError("Unknown parameter {0}".format(name))
+            conditions.append("r.{0} = ?".format(name))
+            values.append(value)
+
+        rows = self.connection.execute("SELECT s.*, r.OBS_ID, r.DL, r.TW, "
+                "r.BS, r.GTR, r.DATE_OBS, r.TSTART, r.PATH, "
+                "s.CX * ? + s.CY * ? + s.CZ * ? AS COS_SEP "
+                "FROM sources_index i JOIN sources s ON s.SRC_ID = i.SRC_ID "
+                "JOIN runs r ON r.RUN_ID = s.RUN_ID "
+                "WHERE i.XMAX >= ? AND i.XMIN <= ? AND i.YMAX >= ? AND "
+                "i.YMIN <= ? AND i.ZMAX >= ? AND i.ZMIN <= ? AND {0} "
+                "ORDER BY COS_SEP DESC".format(' AND '.join(conditions)),
+                [cx, cy, cz, cx - chord, cx + chord, cy - chord, cy + chord,
+                cz - chord, cz + chord] + values).fetchall()
+
+        sources = []
+        for row in rows :
+            src = dict(row)
+            cos_sep = min(src.pop('COS_SEP'), 1.0)
+            src['SEP'] = float(np.degrees(np.arccos(cos_sep)) * 3600)
+            sources.append(src)
+
+        return sources
+
+
+    def flared_before(self, ra, dec, radius, obs=None, date_obs=None,
+            **params) :
+        """
+        Finds the previous detections of a position: the sources within a
+        radius in the other observations, or in the observations started
+        before a date.
+        @param ra: The right ascension in degrees
+        @param dec: The declination in degrees
+        @param radius: The radius in arcseconds
+        @param obs: The observation ID of the current detection, excluded
+        @param date_obs: The start date of the current observation, ISO
+                         format. The runs with no date are then excluded.
+        @param params: The parameters DL, TW, BS or GTR the runs must have
+        @return: The previous detections, by increasing separation
+        """
+        return [src for src in self.cone_search(ra, dec, radius, **params)
+                if (obs == None or src['OBS_ID'] != str(obs)) and
+                (date_obs == None or (src['DATE_OBS'] != None and
+                src['DATE_OBS'] < date_obs))]
+
+
+    def summary(self, **params) :
+        """
+        Gives the number of sources of each run.
+        @param params: The parameters DL, TW, BS or GTR the runs must have
+        @return: The runs, with their observation, parameters and number of
+                 sources, by observation
+        """
+        conditions = ["1"]
+        values = []
+        for name, value in params.items() :
+            if name not in ('DL', 'TW', 'BS', 'GTR') :
+                raise ValueError("Unknown parameter {0}".format(name))
+            conditions.append("{0} = ?".format(name))
+            values.append(value)
+
+        return [dict(row) for row in self.connection.execute("SELECT * FROM "
+                "runs WHERE {0} ORDER BY OBS_ID, DL, TW, BS, GTR".format(
+                ' AND '.join(conditions)), values)]
+
+########################################################################
+#                                                                      #
+# Main programme                                                       #
+#                                                                      #
+########################################################################
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Archive-wide catalogue of "
+            "the variable sources")
+    parser.add_argument("-db", "--database", dest="db",
+            help="Path to the catalogue", default=FileNames.CATALOGUE,
+            type=str)
+    parser.add_argument("-ingest", "--ingest", help="Source tables to "
+            "ingest, in <obs>/<DL>_<TW>_<BS>_<GTR>/ folders", nargs='+',
+            default=None, type=str)
+    parser.add_argument("-cone", "--cone", help="Cone search around RA, DEC "
+            "within a radius in arcseconds", nargs=3, default=None,
+            type=float, metavar=('RA', 'DEC', 'RADIUS'))
+    parser.add_argument("-summary", "--summary", help="Write the number of "
+            "sources of the runs having sources: observation, number of "
+            "sources, DL and TW", action='store_true')
+    parser.add_argument("-dl", "--detection-level", dest="DL", default=None,
+            type=float)
+    parser.add_argument("-tw", "--time-window", dest="TW", default=None,
+            type=float)
+    parser.add_argument("-bs", "--box-size", dest="BS", default=None,
+            type=int)
+    parser.add_argument("-gtr", "--good-time-ratio", dest="GTR", default=None,
+            type=float)
+    args = parser.parse_args()
+
+    params = {name : getattr(args, name) for name in ('DL', 'TW', 'BS', 'GTR')
+            if getattr(args, name) != None}
+
+    with Catalogue(args.db) as catalogue :
+        if args.ingest != None :
+            for file in args.ingest :
+                try :
+                    n = catalogue.ingest_file(file)
+                    print("{0}\t{1} sources".format(file, n), file=sys.stderr)
+                except Exception as e :
+                    print(" !!!!\nImpossible to ingest {0}: {1}".format(file,
+                            e), file=sys.stderr)
+
+        if args.cone != None :
+            print("OBS_ID DL TW BS GTR ID RA DEC SEP")
+            for src in catalogue.cone_search(*args.cone, **params) :
+                print("{0} {1:g} {2:g} {3} {4:g} {5} {6:.6f} {7:.6f} {8:.2f}"
+                        .format(src['OBS_ID'], src['DL'], src['TW'],
+                        src['BS'], src['GTR'], src['ID'], src['RA'],
+                        src['DEC'], src['SEP']))
+
+        if args.summary :
+            for run in catalogue.summary(**params) :
+                if run['NSRC'] > 0 :
+                    print("{0} {1} {2:g} {3:g}".format(run['OBS_ID'],
+                            run['NSRC'], run['DL'], run['TW']))
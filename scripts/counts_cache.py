@@ -0,0 +1,198 @@
+# coding=utf-8
+
+########################################################################
+#                                                                      #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                          #
+#                                                                      #
+# On-disk cache of the counts cubes                                    #
+#                                                                      #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com       #
+#                                                                      #
+########################################################################
+"""
+Cache of the counts cubes and projection ratios computed by the detector.
+An entry is identified by the content of the events and GTI files, the time
+window and the good time ratio, so that changing only the detection level or
+the box size reuses the counts of a previous run.
+"""
+
+# Built-in imports
+
+import os
+import json
+import fcntl
+import hashlib
+
+# Third-party imports
+
+import numpy as np
+
+# Version of the cached data, to be increased if the counting changes
+CACHE_VERSION = 2
+
+########################################################################
+
+
+def file_hash(file, block_size=2**23) :
+    """
+    Function computing the hash of the content of a file.
+    @param file: The file name
+    @param block_size: The size of the blocks read from the file
+    @return: The hexadecimal digest
+    """
+    h = hashlib.blake2b(digest_size=20)
+    with open(file, 'rb') as f :
+        for block in iter(lambda: f.read(block_size), b'') :
+            h.update(block)
+
+    return h.hexdigest()
+
+########################################################################
+
+
+class CountsCache(object):
+    """
+    Size-bounded on-disk cache of counts cubes, evicting the least recently
+    used entries.\n
+
+    Attributes:\n
+    folder:    The cache folder\n
+    max_size:  The maximal size of the cache, in bytes
+    """
+
+    def __init__(self, folder, max_size):
+        """
+        Constructor for CountsCache class. Creates the folder if needed.
+        @param folder: The cache folder
+        @param max_size: The maximal size of the cache, in bytes
+        """
+        super(CountsCache, self).__init__()
+
+        self.folder = os.path.expanduser(folder)
+        if self.folder[-1] != '/' :
+            self.folder += '/'
+        self.max_size = max_size
+        os.makedirs(self.folder, exist_ok=True)
+
+
+    def _hash(self, file) :
+        """
+        Returns the hash of a file, reusing the one stored in the cache if
+        the file has not been modified since.
+        """
+        stat = os.stat(file)
+        name = '{0} {1} {2}'.format(os.path.abspath(file), stat.st_size,
+                stat.st_mtime_ns)
+        hashes_file = self.folder + 'hashes.json'
+
+        hashes = self._read_hashes()
+        if name in hashes :
+            return hashes[name]
+
+        digest = file_hash(file)
+
+        # Other runs may share the cache: the hashes they added since the
+        # reading are kept by reading the file again under the lock
+        with open(self.folder + 'hashes.lock', 'w') as lock :
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            hashes = self._read_hashes()
+            hashes[name] = digest
+            tmp_file = hashes_file + '.{0}.tmp'.format(os.getpid())
+            with open(tmp_file, 'w') as f :
+                json.dump(hashes, f)
+            os.replace(tmp_file, hashes_file)
+
+        return digest
+
+
+    def _read_hashes(self) :
+        """
+        Returns the hashes stored in the cache, empty if there are none.
+        """
+        try :
+            with open(self.folder + 'hashes.json') as f :
+                return json.load(f)
+        except (IOError, ValueError) :
+            return {}
+
+
+    def key(self, events_file, gti_file, time_interval, acceptable_ratio) :
+        """
+        Returns the key of the counts of an observation.
+        @param events_file: The events file
+        @param gti_file: The GTI file
+        @param time_interval: The duration of a time window
+        @param acceptable_ratio: The good time ratio
+        """
+        text = '{0} {1} {2!r} {3!r} {4}'.format(self._hash(events_file),
+                self._hash(gti_file), float(time_interval),
+                float(acceptable_ratio), CACHE_VERSION)
+
+        return hashlib.sha1(text.encode()).hexdigest()
+
+
+    def load(self, key) :
+        """
+        Reads an entry of the cache.
+        @param key: The key of the entry
+        @return: The counts cube of each CCD, of shape (12, 64, 200, n_bins),
+                 and the projection ratios, or None if the entry is missing
+        """
+        file = self.folder + key + '.npz'
+        try :
+            with np.load(file) as data :
+                counts, projection_ratio = data['counts'], data['ratio']
+        except (IOError, ValueError, KeyError) :
+            return None
+
+        # Marking the entry as recently used
+        os.utime(file)
+
+        return counts, projection_ratio
+
+
+    def store(self, key, counts, projection_ratio) :
+        """
+        Writes an entry to the cache, then evicts the least recently used
+        entries if the cache is too large.
+        @param key: The key of the entry
+        @param counts: The counts cube of each CCD
+        @param projection_ratio: The projection ratio of each time window
+        """
+        counts = np.asarray(counts)
+        if counts.size != 0 and counts.max() < 2**31 :
+            counts = counts.astype(np.int32, copy=False)
+
+        file = self.folder + key + '.npz'
+        tmp_file = file + '.{0}.tmp'.format(os.getpid())
+        with open(tmp_file, 'wb') as f :
+            np.savez_compressed(f, counts=counts, ratio=projection_ratio)
+        os.replace(tmp_file, file)
+
+        self.evict()
+
+
+    def evict(self) :
+        """
+        Removes the least recently used entries until the cache fits into
+        its maximal size.
+        """
+        entries = []
+        for name in os.listdir(self.folder) :
+            if name.endswith('.npz') :
+                try :
+                    stat = os.stat(self.folder + name)
+                except OSError :
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        entries.sort()
+        total = sum([size for mtime, size, name in entries])
+        for mtime, size, name in entries :
+            if total <= self.max_size :
+                break
+            try :
+                os.remove(self.folder + name)
+            except OSError :
+                pass
+            total -= size
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+########################################################################
+#                                                                      #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                          #
+#                                                                      #
+# Cross-match of the variable sources with a reference catalogue       #
+#                                                                      #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com       #
+#                                                                      #
+########################################################################
+"""
+Cross-match of the detected variable sources with a local reference
+catalogue, such as the 3XMM catalogue in FITS or CSV format. The reference
+positions are loaded once into a k-d tree of their unit vectors, and all
+the sources are matched in one query: the nearest reference source within
+the radius, and the number of reference sources within it.
+"""
+
+# Built-in imports
+
+import os
+import time
+
+# Third-party imports
+
+import argparse
+import numpy as np
+from scipy.spatial import cKDTree
+from astropy.io import fits, ascii
+from astropy.table import Table, MaskedColumn, vstack
+
+# Internal imports
+
+import file_names as FileNames
+from catalogue import Catalogue, unit_vector, run_parameters
+
+# Candidate names of the columns of the reference catalogue, 3XMM first
+ID_COLUMNS  = ['IAUNAME', 'SRCID', 'NAME', 'ID']
+RA_COLUMNS  = ['SC_RA', 'RA', 'RA_DEG', 'RAJ2000']
+DEC_COLUMNS = ['SC_DEC', 'DEC', 'DEC_DEG', 'DEJ2000']
+
+# Reference catalogues already loaded, by file and columns
+_references = {}
+
+########################################################################
+
+
+def chord(radius) :
+    """
+    Function giving the distance between unit vectors separated by an angle.
+    @param radius: The angle in arcseconds
+    @return: The chord length
+    """
+    return 2 * np.sin(np.radians(np.asarray(radius) / 3600) / 2)
+
+########################################################################
+
+
+def find_column(names, candidates, column=None) :
+    """
+    Function choosing a column of the reference catalogue.
+    @param names: The columns of the catalogue
+    @param candidates: The usual names of the column, by preference
+    @param column: The name given by the user
+    @return: The name of the column
+    """
+    if column != None :
+        candidates = [column]
+    for name in candidates :
+        for n in names :
+            if n.upper() == name.upper() :
+                return n
+
+    raise KeyError("No column {0} in the reference catalogue".format(
+            ' or '.join(candidates)))
+
+########################################################################
+
+
+class Reference(object):
+    """
+    Reference catalogue indexed for the cross-match.\n
+
+    Attributes:\n
+    file:   The file of the catalogue\n
+    ids:    The identifiers of the reference sources, as strings\n
+    ra:     The right ascensions in degrees\n
+    dec:    The declinations in degrees\n
+    tree:   The k-d tree of the unit vectors of the reference sources
+    """
+
+    def __init__(self, file, id_column=None, ra_column=None,
+            dec_column=None):
+        """
+        Constructor for Reference class. Only the three columns used are
+        read from the file.
+        @param file: The FITS or CSV file of the catalogue
+        @param id_column: The column of the identifiers
+        @param ra_column: The column of the right ascensions, in degrees
+        @param dec_column: The column of the declinations, in degrees
+        """
+        super(Reference, self).__init__()
+
+        self.file = file
+        if file.lower().endswith(('.csv', '.csv.gz')) :
+            names = ascii.read(file, format='csv', data_end=1).colnames
+            columns = [find_column(names, ID_COLUMNS, id_column),
+                    find_column(names, RA_COLUMNS, ra_column),
+                    find_column(names, DEC_COLUMNS, dec_column)]
+            data = ascii.read(file, format='csv', include_names=columns)
+            ids, ra, dec = [np.asarray(data[c]) for c in columns]
+        else :
+            with fits.open(file, memmap=True) as hdulist :
+                data = hdulist[1].data
+                names = data.columns.names
+                columns = [find_column(names, ID_COLUMNS, id_column),
+                        find_column(names, RA_COLUMNS, ra_column),
+                        find_column(names, DEC_COLUMNS, dec_column)]
+                ids, ra, dec = [np.array(data[c]) for c in columns]
+
+        self.ids = np.char.strip(ids.astype(str))
+        self.ra  = ra.astype(np.float64)
+        self.dec = dec.astype(np.float64)
+        self.tree = cKDTree(np.column_stack(unit_vector(self.ra, self.dec)))
+
+
+    def __len__(self) :
+        return len(self.ids)
+
+
+    def match(self, ra, dec, radius) :
+        """
+        Matches positions with the nearest reference source within a radius.
+        @param ra: The right ascensions in degrees
+        @param dec: The declinations in degrees
+        @param radius: The radius in arcseconds, one for all the positions
+                       or one per position
+        @return: The index of the nearest reference source, -1 if none
+        @return: The separation in arcseconds, NaN if no match
+        @return: The number of reference sources within the radius
+        """
+        ra  = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+        dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64),
+                ra.shape)
+
+        index = np.full(ra.shape, -1, dtype=np.int64)
+        sep   = np.full(ra.shape, np.nan)
+        count = np.zeros(ra.shape, dtype=np.int64)
+
+        valid = np.isfinite(ra) & np.isfinite(dec)
+        if not valid.any() or len(self) == 0 :
+            return index, sep, count
+
+        points = np.column_stack(unit_vector(ra[valid], dec[valid]))
+        limits = chord(radius[valid])
+        dist, nearest = self.tree.query(points, k=1,
+                distance_upper_bound=limits.max())
+
+        # Nearest within the radius of each position
+        found = nearest < len(self)
+        found[found] = dist[found] <= limits[found]
+        index[valid] = np.where(found, nearest, -1)
+        sep[valid] = np.where(found, np.degrees(2 * np.arcsin(np.minimum(
+                dist / 2, 1))) * 3600, np.nan)
+        count[valid] = self.tree.query_ball_point(points, limits,
+                return_length=True)
+
+        return index, sep, count
+
+########################################################################
+
+
+def reference_catalogue(file, id_column=None, ra_column=None,
+        dec_column=None) :
+    """
+    Function returning a reference catalogue, loading it the first time only.
+    @param file: The FITS or CSV file of the catalogue
+    @param id_column: The column of the identifiers
+    @param ra_column: The column of the right ascensions, in degrees
+    @param dec_column: The column of the declinations, in degrees
+    @return: The Reference
+    """
+    key = (os.path.abspath(file), os.path.getmtime(file), id_column,
+            ra_column, dec_column)
+
+    if key not in _references :
+        _references[key] = Reference(file, id_column, ra_column, dec_column)
+
+    return _references[key]
+
+########################################################################
+
+
+def crossmatch_sources(sources, reference, radius) :
+    """
+    Function adding the cross-match with a reference catalogue to a source
+    table: the identifier REF_ID of the nearest reference source within the
+    radius, its separation REF_SEP in arcseconds and the number REF_N of
+    reference sources within the radius. REF_ID and REF_SEP are masked when
+    there is no match.
+    @param sources: The source table, with RA and DEC, modified in place
+    @param reference: The Reference
+    @param radius: The radius in arcseconds, or the name of a column of the
+                   source table giving the radius of each source
+    @return: The source table
+    """
+    if isinstance(radius, str) :
+        radius = np.asarray(sources[radius], dtype=np.float64)
+    ra  = np.ma.filled(np.ma.asarray(sources['RA'], dtype=np.float64), np.nan)
+    dec = np.ma.filled(np.ma.asarray(sources['DEC'], dtype=np.float64), np.nan)
+
+    index, sep, count = reference.match(ra, dec, radius)
+    no_match = index < 0
+    if len(reference) != 0 :
+        ids = reference.ids[np.maximum(index, 0)]
+    else :
+        ids = np.full(len(index), '')
+
+    sources['REF_ID']  = MaskedColumn(ids, mask=no_match)
+    sources['REF_SEP'] = MaskedColumn(np.round(sep, 2), mask=no_match)
+    sources['REF_N']   = count
+
+    return sources
+
+########################################################################
+
+
+def run_sources(files=None, database=None) :
+    """
+    Function gathering the sources of many runs in one table, with the
+    observation and the parameters of each run.
+    @param files: The variable_sources.csv files, in <obs>/<DL>_<TW>_<BS>_<GTR>/
+                  folders
+    @param database: The catalogue of the variable sources
+    @return: The table of all the sources
+    """
+    tables = []
+    if database != None :
+        with Catalogue(database) as catalogue :
+            rows = catalogue.connection.execute("SELECT r.OBS_ID, r.DL, "
+                    "r.TW, r.BS, r.GTR, s.ID, s.CCDNR, s.RA, s.DEC, s.R FROM "
+                    "sources s JOIN runs r ON r.RUN_ID = s.RUN_ID ORDER BY "
+                    "r.OBS_ID, r.DL, r.TW, r.BS, r.GTR, s.ID").fetchall()
+        names = ['OBS_ID', 'DL', 'TW', 'BS', 'GTR', 'ID', 'CCDNR', 'RA', 'DEC',
+                'R']
+        if len(rows) != 0 :
+            tables.append(Table(rows=[tuple(row) for row in rows],
+                    names=names))
+
+    for file in files or [] :
+        src = ascii.read(file, format='csv')
+        if len(src) == 0 :
+            continue
+        obs, params = run_parameters(os.path.dirname(os.path.abspath(file)))
+        run = Table()
+        run['OBS_ID'] = [obs] * len(src)
+        for name in ('DL', 'TW', 'BS', 'GTR') :
+            run[name] = [params[name]] * len(src)
+        for name in ('ID', 'CCDNR', 'RA', 'DEC', 'R') :
+            run[name] = src[name]
+        tables.append(run)
+
+    if len(tables) == 0 :
+        return Table(names=['OBS_ID', 'DL', 'TW', 'BS', 'GTR', 'ID', 'CCDNR',
+                'RA', 'DEC', 'R'], dtype=['U10', 'f8', 'f8', 'i8', 'f8', 'i8',
+                'i8', 'f8', 'f8', 'f8'])
+
+    return vstack(tables, metadata_conflicts='silent')
+
+########################################################################
+#                                                                      #
+# Main programme                                                       #
+#                                                                      #
+########################################################################
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Cross-match of the "
+            "variable sources of many runs with a reference catalogue")
+    parser.add_argument("-ref", "--reference", help="Reference catalogue, "
+            "FITS or CSV file", required=True, type=str)
+    parser.add_argument("-files", "--files", help="Source tables, in "
+            "<obs>/<DL>_<TW>_<BS>_<GTR>/ folders", nargs='+', default=None,
+            type=str)
+    parser.add_argument("-db", "--database", dest="db", help="Catalogue of "
+            "the variable sources, all its sources being matched",
+            default=None, type=str)
+    parser.add_argument("-r", "--radius", help="Matching radius in "
+            "arcseconds.\nDefault: 10", default=10.0, type=float)
+    parser.add_argument("-id", "--id-column", dest="id_column",
+            help="Identifier column of the reference catalogue",
+            default=None, type=str)
+    parser.add_argument("-ra", "--ra-column", dest="ra_column",
+            help="Right ascension column of the reference catalogue",
+            default=None, type=str)
+    parser.add_argument("-dec", "--dec-column", dest="dec_column",
+            help="Declination column of the reference catalogue",
+            default=None, type=str)
+    parser.add_argument("-out", "--output", dest="out", help="Output file",
+            default=FileNames.CROSSMATCH, type=str)
+    args = parser.parse_args()
+
+    if args.files == None and args.db == None :
+        parser.error("no sources: -files or -db is required")
+
+    original_time = time.time()
+
+    reference = reference_catalogue(args.reference, args.id_column,
+            args.ra_column, args.dec_column)
+    print(" Reference catalogue\t{0} sources\t{1:7.2f} s".format(
+            len(reference), time.time() - original_time))
+
+    sources = run_sources(args.files, args.db)
+    print(" Variable sources\t{0} sources\t{1:7.2f} s".format(len(sources),
+            time.time() - original_time))
+
+    crossmatch_sources(sources, reference, args.radius)
+    ascii.write(sources, args.out, format='csv', overwrite=True)
+    print(" Matched sources\t{0} sources\t{1:7.2f} s".format(
+            int(np.sum(sources['REF_N'] > 0)), time.time() - original_time))
@@ -39,6 +39,13 @@ from variability_utils import *
 import file_names as FileNames
 from file_utils import *
 from renderer import *
+from counts_cache import CountsCache
+from parallel_utils import parallel_counts_sweep, parallel_variability
+from streaming import streaming_variability
+from telemetry import Telemetry
+from background import background_model, threshold_map
+from catalogue import Catalogue
+from crossmatch import reference_catalogue, crossmatch_sources
 
 ########################################################################
 #                                                                      #
@@ -72,10 +79,48 @@ parser.add_argument("-dl", "--detection-level", dest="dl",
 parser.add_argument("-tw", "--time-window", dest="tw",
         help="The duration of the time windows.\n Default: 100",
         default=100.0, nargs='?', type=float)
+parser.add_argument("-tws", "--time-windows", dest="tws",
+        help="Durations of the time windows of a sweep. The events are binned "
+        "once and the outputs are written to one folder per time window.",
+        default=None, nargs='+', type=float)
 parser.add_argument("-gtr", "--good-time-ratio", dest="gtr",
         help="Ratio of acceptability for a time window. "
         "Shall be between 0.0 and 1.0.\nDefault: 1.0", default=1.0, nargs='?',
         type=float)
+parser.add_argument("-detection", "--detection", dest="detection",
+        help="Detection on each CCD separately, or on the mosaic of the 12 "
+        "CCDs with the bad columns masked, joining the areas across the CCD "
+        "boundaries.\nDefault: ccd", default='ccd', nargs='?', type=str,
+        choices=['ccd', 'mosaic'])
+parser.add_argument("-bg-regions", "--background-regions",
+        dest="bg_regions", help="Number of regions of a CCD along RAWX and "
+        "RAWY for the background model.\nDefault: 1 4", default=[1, 4],
+        nargs=2, type=int)
+parser.add_argument("-bg-nmad", "--background-nmad", dest="bg_nmad",
+        help="Number of MAD added to the background median in the lower "
+        "limit of detection.\nDefault: 0", default=0.0, nargs='?', type=float)
+parser.add_argument("-cache", "--cache", dest="cache",
+        help="Folder of the counts cache. The counts are reused when only "
+        "the detection level or the box size change.\nDefault: no cache",
+        default=None, nargs='?', type=str)
+parser.add_argument("-cache-size", "--cache-size", dest="cache_size",
+        help="Maximal size of the counts cache in GB.\nDefault: 20",
+        default=20.0, nargs='?', type=float)
+parser.add_argument("-memory", "--memory-limit", dest="memory",
+        help="Memory available to the streaming mode in GB. Counts exceeding "
+        "it are spilled to the output folder.\nDefault: 4",
+        default=4.0, nargs='?', type=float)
+parser.add_argument("-catalogue", "--catalogue", dest="catalogue",
+        help="Archive-wide catalogue the variable sources are added to, "
+        "shared by all the runs.\nDefault: no catalogue", default=None,
+        nargs='?', type=str)
+parser.add_argument("-crossmatch", "--crossmatch", dest="crossmatch",
+        help="Reference catalogue, FITS or CSV, the sources are matched with"
+        ". The 3XMM column names are used by default.\nDefault: none",
+        default=None, nargs='?', type=str)
+parser.add_argument("-match-radius", "--match-radius", dest="match_radius",
+        help="Radius of the cross-match in arcseconds.\nDefault: 10",
+        default=10.0, nargs='?', type=float)
 parser.add_argument("-mta", "--max-threads-allowed", dest="mta",
         help="Maximal number of CPUs the program is allowed to use. "
         "\nDefault: 12", nargs='?', default=12, type=int)
@@ -90,12 +135,37 @@ parser.add_argument("-obs", "--observation", dest="obs",
 # Boolean flags
 parser.add_argument("-r", "--render", help='Plot variability output, produce pdf',
         action='store_true')
+parser.add_argument("-thumbnail", "--thumbnail",
+        help="Write a low resolution PNG image of the variability and the "
+        "sources, fast to produce", action='store_true')
 parser.add_argument("-ds9", "--ds9",
         help="Plot variability output in emerging ds9 window",
         action="store_true")
 parser.add_argument("-nv", "--novar",
         help="Skip variability computation if already done",
         action="store_true")
+parser.add_argument("-background", "--background",
+        help="Raise the lower limit of detection to the robust median of the "
+        "variability of each CCD region, to reject the noisy CCDs",
+        action="store_true")
+parser.add_argument("-stream", "--stream",
+        help="Read the events by chunks and compute the variability within "
+        "the memory limit. The cache is not used.", action="store_true")
+
+# Telemetry
+parser.add_argument("-profile", "--profile", dest="profile",
+        help="Stage profiled, among extraction, gti, binning, variability, "
+        "transformation, median, background, detection, sky_conversion, "
+        "crossmatch, fits_writing and rendering.\nDefault: none",
+        default=None, nargs='?', type=str,
+        choices=['extraction', 'gti', 'binning', 'variability',
+        'transformation', 'median', 'background', 'detection',
+        'sky_conversion', 'crossmatch', 'fits_writing', 'rendering'])
+parser.add_argument("-profiler", "--profiler", dest="profiler",
+        help="Profiler of the stage: cprofile for the time spent in each "
+        "function, tracemalloc for the memory allocations.\n"
+        "Default: cprofile", default='cprofile', nargs='?', type=str,
+        choices=['cprofile', 'tracemalloc'])
 
 args = parser.parse_args()
 
@@ -104,183 +174,386 @@ if args.path[-1] != '/' :
     args.path = args.path + '/'
 if args.out != None and args.out[-1] != '/' :
     args.out = args.out + '/'
-if args.out == None :
-    args.out = args.path + '{}_{}_{}_{}/'.format(int(args.dl),
-            int(args.tw), args.bs, args.gtr)
+if args.tws == None :
+    args.tws = [args.tw]
+if args.out == None or len(args.tws) > 1 :
+    base = args.path if args.out == None else args.out
+    args.outs = [base + '{}_{}_{}_{}/'.format(int(args.dl), int(tw), args.bs,
+            args.gtr) for tw in args.tws]
+else :
+    args.outs = [args.out]
+args.out = args.outs[0]
 args.evts = args.path + args.evts
 args.gti  = args.path + args.gti
 args.img  = args.path + args.img
 
+# Stage records, written next to the log file of each output folder
+telemetry = Telemetry(args.profile, args.profiler, args.out)
+
 ########################################################################
 #                                                                      #
 # Functions                                                            #
 #                                                                      #
 ########################################################################
 
-def main_fct() :
+def variability_products(v_matrix, header, params, out, reg_f, log_f, var_f,
+        original_time) :
     """
-    Main function of the detector
+    Function detecting the variable sources and writing the output files for
+    the variability of a time window.
+    @param v_matrix: The V round matrix of each CCD
+    @param header: The events file header
+    @param params: The variability parameters written to the fits file
+    @param out: The output folder
+    @param reg_f: The region file
+    @param log_f: The log file
+    @param var_f: The variability file
+    @param original_time: The starting time of the programme
     """
-###
-# Preliminaries
-###
-    print(vars(args))
-
-    print("""
-        DETECTION LEVEL = {0}
-        TIME WINDOW     = {1}
-        BOX SIZE        = {2}
-        GOOD TIME RATIO = {3}
-        """.format(args.dl, args.tw, args.bs, args.gtr))
-
-    print(" Writing output to folder '{0}'".format(args.out))
 
-    # Counter for the overall execution time
-    original_time = time.time()
+    tw = params['TW']
 
-    # Opening the output files
-    log_f, var_f, reg_f = open_files(args.out)
-    original = sys.stdout
-    sys.stdout = Tee(sys.stdout, log_f)
+    # Aplying CCD configuration
+    with telemetry.stage('transformation', out, tw=tw) :
+        data_v = ccd_config(v_matrix)
+        img_v  = data_transformation(data_v, header)
 
     ###
-    # Skipping variability computation if already done
+    # Detecting variable areas and sources
     ###
-    vf = False
-    if args.novar :
-        print(" Checking if variability has been computed.")
-        var_f = args.out + FileNames.VARIABILITY
-        vf = os.path.isfile(var_f)
-        if vf :
-            print(" Using existing variability file {0}".format(var_f))
+
+    print(" Detecting variable sources\t {:7.2f} s".format(
+            time.time() - original_time))
+    with telemetry.stage('median', out, tw=tw) as counts :
+        median = np.median(v_matrix)
+        counts['pixels'] = int(np.size(v_matrix))
+
+    # Avoiding a too small median value for detection
+    print("\n\tMedian\t\t{0}".format(median))
+    if median < 0.75 :
+        median = 0.75
+        print(" Median switched to 0.75. \n")
+
+    # Lower limit of each pixel, from the background of its CCD region
+    lower_limit = median
+    if args.background :
+        with telemetry.stage('background', out, tw=tw) :
+            model = background_model(v_matrix, args.bg_regions)
+            lower_limit = threshold_map(model, args.bg_regions, median,
+                    args.bg_nmad)
+        ascii.write(Table(model), out + FileNames.BACKGROUND, format='csv',
+                overwrite=True)
+        for row in model[model['REGION'] < 0] :
+            print("\tCCD {0:<2}\t\tMedian {1:.3f}\tMAD {2:.3f}".format(
+                    row['CCDNR'], row['MEDIAN'], row['MAD']))
+
+    variable_areas = []
+
+    # Arguments of each CCD for the pool of threads
+    limits = [lower_limit] * 12 if np.ndim(lower_limit) == 0 else lower_limit
+    ccd_arguments = [(limits[ccd], args.bs, args.dl, v_matrix[ccd])
+            for ccd in range(12)]
+    print("\tBox counts\t{0}".format(args.dl * ((args.bs**2))))
+    # Performing parallel detection on each CCD, or on the whole mosaic
+    with telemetry.stage('detection', out, tw=tw) as counts :
+        if args.detection == 'mosaic' :
+            variable_areas = variable_areas_mosaic(lower_limit, args.bs,
+                    args.dl, v_matrix)
         else :
-            print(" No variability file. Applying detector.")
-    ###
-    # Starting variability computation
-    ###
+            with Pool(args.mta) as p:
+                variable_areas = p.starmap(variable_areas_detection,
+                        ccd_arguments)
+        counts['pixels'] = int(np.size(v_matrix))
+        counts['areas']  = sum([len(areas) for areas in variable_areas])
+
+    # Variable sources
+    with telemetry.stage('sky_conversion', out, tw=tw) as counts :
+        sources = variable_sources_position(variable_areas, args.obs,
+                args.path, reg_f, log_f, args.img)
+        counts['sources'] = len(sources)
+
+    # Known sources at the positions of the variable sources
+    if args.crossmatch != None :
+        with telemetry.stage('crossmatch', out, tw=tw) as counts :
+            crossmatch_sources(sources, reference_catalogue(args.crossmatch),
+                    args.match_radius)
+            counts['matched'] = int(np.sum(sources['REF_N'] > 0))
+        for src in sources :
+            if src['REF_N'] > 0 :
+                print("\tSource {0:<3}\t{1}\t{2:.2f}\"".format(src['ID'],
+                        src['REF_ID'], src['REF_SEP']))
+
+    ascii.write(sources, out + 'variable_sources.csv', format='csv',
+            overwrite=True)
+
+    # Adding the sources to the catalogue, replacing those of a previous run
+    if args.catalogue != None :
+        try :
+            with Catalogue(args.catalogue) as catalogue :
+                catalogue.ingest(sources, params['OBS_ID'], params,
+                        date_obs=header.get('DATE-OBS'),
+                        tstart=header.get('TSTART'), path=out)
+        except Exception as e :
+            print(" !!!!\nImpossible to add the sources to the catalogue "
+                    "{0}: {1}\n The run can be added later with 'catalogue.py "
+                    "-db {0} -ingest {2}'".format(args.catalogue, e,
+                    out + 'variable_sources.csv'))
+
+    print("\tNb of sources\t{0}\n".format(len(sources)))
+
+    # Writing data to fits file
+    with telemetry.stage('fits_writing', out, tw=tw) :
+        fits_writer(img_v, sources, args.img, params, var_f,
+                ccd_data=v_matrix)
+
+########################################################################
 
-    if not args.novar and not vf:
+def compute_variability(log_fs, original_time) :
+    """
+    Function computing the variability of each CCD for each time window. When
+    a cache folder is given, the counts are read from it if they have already
+    been computed for the same events, GTI, time window and good time ratio.
+    In streaming mode, the events are read by chunks within the memory limit.
+    @param log_fs: The log files, closed if the programme is aborted
+    @param original_time: The starting time of the programme
+    @return: The events file header
+    @return: The V round matrices of each CCD, one list per time window
+    """
+
+    if args.stream :
+        print(" Streaming the events list\t {:7.2f} s".format(
+                time.time() - original_time))
+        try :
+            header = fits.getheader(args.evts, 1)
+            with telemetry.stage('gti') as counts :
+                gti_list = extraction_deleted_periods(args.gti)
+                counts['gti'] = len(gti_list)
+            with telemetry.stage('variability', stream=True) as counts :
+                v_matrices = streaming_variability(args.evts, gti_list,
+                        args.tws, args.gtr, args.memory * 2**30, args.out)
+                counts['events'] = header['NAXIS2']
+                counts['pixels'] = 12 * 64 * 200 * len(args.tws)
+        except Exception as e:
+            print(" !!!!\nImpossible to compute the variability. ABORTING.")
+            for log_f in log_fs :
+                close_files(log_f, None)
+            exit(-2)
+
+        if args.obs == None :
+            args.obs = header['OBS_ID']
+
+        return header, v_matrices
+
+    # Looking for the counts in the cache
+    cache   = None
+    entries = [None for tw in args.tws]
+    if args.cache != None :
+        cache = CountsCache(args.cache, args.cache_size * 2**30)
+        keys  = [cache.key(args.evts, args.gti, tw, args.gtr)
+                for tw in args.tws]
+        entries = [cache.load(key) for key in keys]
+    missing = [k for k in range(len(args.tws)) if entries[k] is None]
+
+    if len(missing) == 0 :
+        print(" Reading the counts from the cache\t {:7.2f} s".format(
+                time.time() - original_time))
+        header = fits.getheader(args.evts, 1)
+        if args.obs == None :
+            args.obs = header['OBS_ID']
 
+    else :
         # Recovering the EVENTS list
         print(" Recovering the events list\t {:7.2f} s".format(
                 time.time() - original_time))
         try :
-            data, header = extraction_photons(args.evts)
+            with telemetry.stage('extraction') as counts :
+                data, header, (t0_observation, tf_observation) = \
+                        extraction_events(args.evts)
+                counts['events'] = sum([len(ccd) for ccd in data])
 
             if args.obs == None :
                 args.obs = header['OBS_ID']
 
         except Exception as e:
             print(" !!!!\nImpossible to extract photons. ABORTING.")
-            close_files(log_f, var_f, var_per_tw_f, detected_var_areas_f,
-                    tws_f, detected_var_sources_f)
+            for log_f in log_fs :
+                close_files(log_f, None)
             exit(-2)
 
-        # Parameters ready
-        params = {
-                  "CREATOR" : args.creator,
-                  "DATE"    : time.strftime("%Y-%m-%d %H:%M:%S",
-                                time.gmtime()),
-                  "OBS_ID"  : args.obs,
-                  "TW"      : args.tw,
-                  "GTR"     : args.gtr,
-                  "DL"      : args.dl,
-                  "BS"      : args.bs
-                 }
-
         # Recovering GTI list
         try:
             print(" Extracting data\t\t {:7.2f} s".format(
                     time.time() - original_time))
-            gti_list = extraction_deleted_periods(args.gti)
+            with telemetry.stage('gti') as counts :
+                gti_list = extraction_deleted_periods(args.gti)
+                counts['gti'] = len(gti_list)
 
         except Exception as e:
             print(" !!!!\nImpossible to extract gti. ABORTING.")
-            close_files(log_f, var_f, var_per_tw_f, detected_var_areas_f,
-                    tws_f, detected_var_sources_f)
+            for log_f in log_fs :
+                close_files(log_f, None)
             exit(-2)
 
-        time_windows = []
-        t0_observation = min([evt['TIME'] for ccd in data for evt in ccd])
-        tf_observation = max([evt['TIME'] for ccd in data for evt in ccd])
-
     ###
     # Computing variability
     ###
         print(" Computing variability\t\t {:7.2f} s".format(
                 time.time() - original_time))
-        # Computing v_matrix
-        v_matrix = []
 
-        var_calc_partial = partial(variability_computation, gti_list,
-                args.tw, args.gtr, t0_observation, tf_observation)
+        # Counting the good windows of the missing time windows, in shared
+        # counts cubes used in place by the variability
+        with telemetry.stage('binning') as stage_counts :
+            counts = parallel_counts_sweep(gti_list,
+                    [args.tws[k] for k in missing], args.gtr, t0_observation,
+                    tf_observation, data, args.mta)
+            stage_counts['events'] = sum([len(ccd) for ccd in data])
 
-        with Pool(args.mta) as p:
-            v_matrix = p.map(var_calc_partial, data)
+        for i, k in enumerate(missing) :
+            entries[k] = counts[i]
 
-        # Aplying CCD configuration
-        data_v = ccd_config(v_matrix)
-        img_v  = data_transformation(data_v, header)
+    try :
+        if cache != None :
+            for k in missing :
+                cache.store(keys[k], entries[k][0].array, entries[k][1])
 
-    ###
-    # Detecting variable areas and sources
-    ###
+        with telemetry.stage('variability',
+                cached=len(args.tws) - len(missing)) as counts :
+            v_matrices = parallel_variability(entries, args.gtr, args.mta)
+            counts['pixels']  = 12 * 64 * 200 * len(args.tws)
+            counts['windows'] = [len(entry[1]) for entry in entries]
 
-        print(" Detecting variable sources\t {:7.2f} s".format(
-                time.time() - original_time))
-        median = np.median([v_matrix[ccd][i][j]
-                for ccd in range(12) for i in range(len(v_matrix[ccd]))
-                for j in range(len(v_matrix[ccd][i]))])
-
-        # Avoiding a too small median value for detection
-        print("\n\tMedian\t\t{0}".format(median))
-        if median < 0.75 :
-            median = 0.75
-            print(" Median switched to 0.75. \n")
-
-        variable_areas = []
-
-        # Currying the function for the pool of threads
-        variable_areas_detection_partial = partial(variable_areas_detection,
-                median, args.bs, args.dl)
-        print("\tBox counts\t{0}".format(args.dl * ((args.bs**2))))
-        # Performing parallel detection on each CCD
-        with Pool(args.mta) as p:
-            variable_areas = p.map(variable_areas_detection_partial, v_matrix)
-
-        # Variable sources
-        sources = variable_sources_position(variable_areas, args.obs,
-                args.path, reg_f, log_f, args.img)
-        ascii.write(sources, args.out + 'variable_sources.csv', format='csv')
+    finally :
+        for k in missing :
+            entries[k][0].close(unlink=True)
+
+    return header, v_matrices
+
+########################################################################
+
+def main_fct() :
+    """
+    Main function of the detector
+    """
+###
+# Preliminaries
+###
+    print(vars(args))
+
+    print("""
+        DETECTION LEVEL = {0}
+        TIME WINDOW     = {1}
+        BOX SIZE        = {2}
+        GOOD TIME RATIO = {3}
+        """.format(args.dl, ' '.join([str(tw) for tw in args.tws]), args.bs,
+        args.gtr))
+
+    for out in args.outs :
+        print(" Writing output to folder '{0}'".format(out))
+
+    # Counter for the overall execution time
+    original_time = time.time()
+
+    # Opening the output files, one set per time window
+    files = [open_files(out) for out in args.outs]
+    log_fs = [f[0] for f in files]
+    original = sys.stdout
+    sys.stdout = Tee(original, *log_fs)
 
-        print("\tNb of sources\t{0}\n".format(len(sources)))
+    ###
+    # Skipping variability computation if already done
+    ###
+    vf = False
+    if args.novar :
+        print(" Checking if variability has been computed.")
+        vf = all([os.path.isfile(var_f) for log_f, var_f, reg_f in files])
+        if vf :
+            print(" Using existing variability files {0}".format(
+                    ' '.join([f[1] for f in files])))
+        else :
+            print(" No variability file. Applying detector.")
+    ###
+    # Starting variability computation
+    ###
 
-        # Writing data to fits file
-        fits_writer(img_v, sources, args.img, params, var_f)
+    if not vf:
+
+        header, v_matrices = compute_variability(log_fs, original_time)
+
+        # Detecting and writing the outputs of each time window
+        for k, tw in enumerate(args.tws) :
+            log_f, var_f, reg_f = files[k]
+            sys.stdout = Tee(original, log_f)
+
+            # Parameters ready
+            params = {
+                      "CREATOR" : args.creator,
+                      "DATE"    : time.strftime("%Y-%m-%d %H:%M:%S",
+                                    time.gmtime()),
+                      "OBS_ID"  : args.obs,
+                      "TW"      : tw,
+                      "GTR"     : args.gtr,
+                      "DL"      : args.dl,
+                      "BS"      : args.bs,
+                      "DETECT"  : args.detection,
+                      "BGMODEL" : args.background,
+                      "BGREGX"  : args.bg_regions[0],
+                      "BGREGY"  : args.bg_regions[1],
+                      "BGNMAD"  : args.bg_nmad
+                     }
+
+            if len(args.tws) > 1 :
+                print(" Time window {0} s".format(tw))
+            variability_products(v_matrices[k], header, params, args.outs[k],
+                    reg_f, log_f, var_f, original_time)
+
+        sys.stdout = Tee(original, *log_fs)
 
 ###
 # Plotting variability
 ###
 
-    # Renderer
-    if args.render :
+    # Figures of each time window, the variability file being read once
+    tasks = []
+    for k, (log_f, var_f, reg_f) in enumerate(files) :
+        out = args.outs[k]
+        outputs = []
+        if args.render :
+            outputs += [(out + FileNames.OUTPUT_IMAGE, False),
+                        (out + FileNames.OUTPUT_IMAGE_SRCS, True)]
+        if args.thumbnail :
+            outputs.append((out + FileNames.OUTPUT_THUMBNAIL, True))
+        if len(outputs) != 0 :
+            tasks.append((var_f, outputs, 10))
 
+    # Renderer
+    if len(tasks) != 0 :
         print(" Rendering variability image\t {:7.2f} s".format(
                 time.time() - original_time))
 
-        render_variability(var_f, args.out + FileNames.OUTPUT_IMAGE,
-                sources=False, maximum_value=10)
-        render_variability(var_f, args.out + FileNames.OUTPUT_IMAGE_SRCS,
-                sources=True, maximum_value=10)
+        with telemetry.stage('rendering', figures=sum([len(task[1])
+                for task in tasks])) :
+            for var_f, error in render_pool(tasks, args.mta) :
+                if error != None :
+                    print(" !!!!\nImpossible to render {0}: {1}".format(
+                            var_f, error))
 
     # ds9
     if args.ds9 :
-        ds9_renderer(var_f, reg_f)
+        for log_f, var_f, reg_f in files :
+            ds9_renderer(var_f, reg_f)
 
     # Ending program
     print(" # Total execution time OBS {0} : {1:.2f} s\n".format(
             args.obs, (time.time() - original_time)))
-    log_f.close()
+    sys.stdout = original
+    for log_f in log_fs :
+        log_f.close()
+
+    # Stage records of each time window, with the stages shared by all of them
+    for k, tw in enumerate(args.tws) :
+        telemetry.write(args.outs[k] + FileNames.TELEMETRY, tw=tw,
+                obs=args.obs, stages=[record for record in telemetry.records
+                if record.get('tw', tw) == tw])
 
 ########################################################################
 #                                                                      #
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+########################################################################
+#                                                                      #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                          #
+#                                                                      #
+# edet2sky replacement for testing without SAS                         #
+#                                                                      #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com       #
+#                                                                      #
+########################################################################
+"""
+Stand-in for the SAS task edet2sky, used by setting
+EXOD_EDET2SKY="python3 /path/to/edet2sky_stub.py".
+It places the CCDs as in ccd_config, rotates them by PA_PNT around the
+reference pixel of the calibration image, and writes the coordinates in the
+edet2sky output format. The positions are approximate.
+"""
+
+# Built-in imports
+
+import sys
+
+# Third-party imports
+
+import numpy as np
+from astropy import wcs
+from astropy.io import fits
+
+# Internal imports
+
+import mosaic
+
+# Size of a raw pixel, in sky pixels of 0.05 arcsec
+RAW_PIXEL = 4.1 / 0.05
+
+########################################################################
+
+
+def parse_arguments(argv) :
+    """
+    Reads the key=value arguments of the command line.
+    """
+    pars = {}
+    for arg in argv :
+        if '=' in arg :
+            key, value = arg.split('=', 1)
+            pars[key] = value.strip("'\"")
+
+    return pars
+
+########################################################################
+
+
+def mosaic_position(ccd, rawx, rawy) :
+    """
+    Returns the position of raw coordinates in the 384 x 400 mosaic.
+    @param ccd: CCD numbers, starting at 1
+    @param rawx: RAWX coordinates, starting at 1
+    @param rawy: RAWY coordinates, starting at 1
+    """
+    return mosaic.mosaic_position(np.asarray(ccd) - 1, np.asarray(rawx) - 1,
+            np.asarray(rawy) - 1)
+
+########################################################################
+
+
+if __name__ == '__main__':
+
+    pars = parse_arguments(sys.argv[1:])
+    rawx = np.array(pars['X'].split(), dtype=float)
+    rawy = np.array(pars['Y'].split(), dtype=float)
+    ccd  = np.array(pars['ccd'].split(), dtype=int)
+
+    header = fits.getheader(pars['calinfoset'])
+    angle  = np.radians(header['PA_PNT'])
+
+    # Offsets from the centre of the mosaic, rotated by the position angle
+    row, col = mosaic_position(ccd, rawx, rawy)
+    dx = (col - 199.5) * RAW_PIXEL
+    dy = (191.5 - row) * RAW_PIXEL
+    x = header['REFXCRPX'] + np.cos(angle) * dx - np.sin(angle) * dy
+    y = header['REFYCRPX'] + np.sin(angle) * dx + np.cos(angle) * dy
+
+    w = wcs.WCS(naxis=2)
+    w.wcs.crpix = [header['REFXCRPX'], header['REFYCRPX']]
+    w.wcs.cdelt = [header['REFXCDLT'], header['REFYCDLT']]
+    w.wcs.crval = [header['REFXCRVL'], header['REFYCRVL']]
+    w.wcs.ctype = [header['REFXCTYP'], header['REFYCTYP']]
+    ra, dec = w.wcs_pix2world(x, y, 1)
+
+    print('# Sky X        Y pixel')
+    for k in range(len(x)) :
+        print('{0:.2f} {1:.2f}'.format(x[k], y[k]))
+    print('# RA (deg)   DEC (deg)')
+    for k in range(len(x)) :
+        print('{0:.6f} {1:.6f}'.format(ra[k], dec[k]))
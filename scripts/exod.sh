@@ -125,7 +125,8 @@ variability(){
   ###
   # writing detector and renderer commands to file that will be run in parallel
   echo "python3 -W"ignore" $SCRIPTS/detector.py -path $path \
-    -bs $BS -dl $DL -tw $TW -gtr $GTR -mta 1 --render" >> \
+    -bs $BS -dl $DL -tw $TW -gtr $GTR -mta 1 --render \
+    -catalogue $FOLDER/$(var CATALOGUE)" >> \
     $FOLDER/process_det_${DL}_${TW}_${BS}_${GTR}
   ((++count))
 }
@@ -136,6 +137,8 @@ lightcurves(){
   echo "Observation Source DL TW P_chisq P_KS" >> \
     $FOLDER/sources_variability_${DL}_${TW}_${BS}_${GTR}
 
+  # Observations with sources, from the source tables of the detector. The
+  # catalogue is only an index, a run missing from it is still processed
   for obs in ${observations[@]}; do
     var_src=$obs/${DL}_${TW}_${BS}_${GTR}/variable_sources.csv
     if [ -f $var_src ]; then
@@ -164,10 +167,15 @@ lightcurves(){
     tw=${array[3]}
     echo "Number of sources $obs : $src"
 
+    # All the light curves of the observation, in one pass over the events
+    echo "python3 -W"ignore" $SCRIPTS/lightcurve_extractor.py \
+      -path $FOLDER/$obs -dl $DL -tw $TW -gtr $GTR -bs $BS" >> \
+      $FOLDER/process_lcx_${DL}_${TW}_${BS}_${GTR}
+
     count=1
     while [[ $count -le $src ]] ; do
       echo "bash $SCRIPTS/lightcurve.sh -f $FOLDER -s $SCRIPTS -o $obs \
-        -dl $DL -tw $TW -gtr $GTR -bs $BS -id $count" >> \
+        -dl $DL -tw $TW -gtr $GTR -bs $BS -id $count -x" >> \
         $FOLDER/process_lc_${DL}_${TW}_${BS}_${GTR}
       ((++count))
     done
@@ -190,6 +198,7 @@ count=1
 logs=(detected_sources_${DL}_${TW}_${BS}_${GTR} \
   process_flt_${DL}_${TW}_${BS}_${GTR} process_det_${DL}_${TW}_${BS}_${GTR} \
   process_ren_${DL}_${TW}_${BS}_${GTR} process_lc_${DL}_${TW}_${BS}_${GTR} \
+  process_lcx_${DL}_${TW}_${BS}_${GTR} \
   sources_variability_${DL}_${TW}_${BS}_${GTR} \
   variable_sources_${DL}_${TW}_${BS}_${GTR})
 for l in ${logs[@]} ; do if [ -f $l ]; then rm $l; fi; done
@@ -226,14 +235,16 @@ time {
   waitForFinish 'python'
 
   Title "Creating big pdf with observations"
-  files=$(ls */${DL}_${TW}_${BS}_${GTR}/sources.pdf)
-  gs -dBATCH -dNOPAUSE -q -sDEVICE=pdfwrite \
-    -sOutputFile=$FOLDER/variability_observations_${DL}_${TW}_${BS}_${GTR}.pdf \
-    ${files[@]}
+  # One page per observation, drawn from the variability files
+  python3 -W"ignore" $SCRIPTS/render_all.py -path ${observations[@]} \
+    -dirs ${DL}_${TW}_${BS}_${GTR} -mta $CPUS \
+    -out $FOLDER/variability_observations_${DL}_${TW}_${BS}_${GTR}.pdf
 
   # Generating lightcurves
   Title "Generating lightcurves"
   lightcurves
+  bash $SCRIPTS/parallel.sh $FOLDER/process_lcx_${DL}_${TW}_${BS}_${GTR} $CPUS
+  waitForFinish 'python'
   bash $SCRIPTS/parallel.sh $FOLDER/process_lc_${DL}_${TW}_${BS}_${GTR} $CPUS
   sleep 10; waitForFinish 'evince'
   sleep 10; waitForFinish 'arfgen'
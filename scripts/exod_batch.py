@@ -0,0 +1,538 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+################################################################################
+#                                                                              #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                                  #
+#                                                                              #
+# Batch processing of the observations                                         #
+#                                                                              #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com               #
+#                                                                              #
+################################################################################
+"""
+Batch processing of a folder of observations, replacing exod.sh. The
+filtering, detector, rendering and lightcurve jobs of every observation are
+run as a dependency graph on a pool of processes: a job starts as soon as the
+jobs it depends on are finished, with a timeout, a memory limit and a number
+of retries. The status of the jobs is written to a state file, so that an
+interrupted run is resumed by launching it again.
+"""
+
+# Built-in imports
+
+import sys
+import os
+import time
+import glob
+import json
+import signal
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Third-party imports
+
+import argparse
+
+# Internal imports
+
+import file_names as FileNames
+from renderer import render_pages
+
+################################################################################
+#                                                                              #
+# Jobs                                                                         #
+#                                                                              #
+################################################################################
+
+class Job(object):
+    """
+    Datastructure describing a job of the batch.\n
+
+    Attributes:\n
+    name:     Unique name of the job\n
+    command:  Shell command, or Python function without arguments\n
+    deps:     Names of the jobs that have to succeed before this one\n
+    outputs:  Files produced by the job. If they all exist, the job is not run\n
+    timeout:  Maximal duration of the job, in seconds\n
+    memory:   Maximal virtual memory of the job, in GB\n
+    retries:  Number of times the job is run again after a failure\n
+    expand:   Function returning new jobs once this one has succeeded\n
+    tolerant: If True, the job runs once its dependencies have ended, even
+              if some of them failed
+    """
+
+    def __init__(self, name, command, deps=(), outputs=(), timeout=None,
+            memory=None, retries=0, expand=None, tolerant=False):
+        """
+        Constructor for Job class.
+        """
+        super(Job, self).__init__()
+
+        self.name     = name
+        self.command  = command
+        self.deps     = list(deps)
+        self.outputs  = list(outputs)
+        self.timeout  = timeout
+        self.memory   = memory
+        self.retries  = retries
+        self.expand   = expand
+        self.tolerant = tolerant
+        self.attempts = 0
+
+
+    def __str__(self):
+        return self.name
+
+
+    def outputs_exist(self) :
+        """
+        Returns True if the job has outputs and they all exist.
+        """
+        return len(self.outputs) != 0 and \
+                all([os.path.isfile(f) for f in self.outputs])
+
+################################################################################
+
+def run_job(job, log_folder) :
+    """
+    Function running a job, its output being written to a log file.
+    @param job: The job
+    @param log_folder: The folder of the log files of the jobs
+    @return: The return code of the job, or 'timeout'
+    """
+    log_file = log_folder + job.name + '.log'
+
+    if callable(job.command) :
+        with open(log_file, 'a') as log_f :
+            try :
+                job.command()
+                return 0
+            except Exception as e :
+                log_f.write('{0}: {1}\n'.format(type(e).__name__, e))
+                return 1
+
+    command = job.command
+    if job.memory != None :
+        # Limiting the address space of the job, in kB
+        command = 'ulimit -v {0}; {1}'.format(int(job.memory * 2**20),
+                command)
+
+    with open(log_file, 'a') as log_f :
+        log_f.write('\n# {0} attempt {1}\n# {2}\n'.format(
+                time.strftime("%Y-%m-%d %H:%M:%S"), job.attempts, command))
+        log_f.flush()
+        process = subprocess.Popen(['bash', '-c', command], stdout=log_f,
+                stderr=subprocess.STDOUT, start_new_session=True)
+        try :
+            return process.wait(timeout=job.timeout)
+        except subprocess.TimeoutExpired :
+            # Killing the job and all its children
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            return 'timeout'
+
+################################################################################
+#                                                                              #
+# Scheduler                                                                    #
+#                                                                              #
+################################################################################
+
+class Scheduler(object):
+    """
+    Scheduler running a dependency graph of jobs on a pool of processes.\n
+
+    Attributes:\n
+    jobs:        Dictionary of the jobs, indexed by name\n
+    state:       Dictionary of the status of each job, indexed by name\n
+    ended:       Dictionary of the status of the jobs ended in this run\n
+    state_file:  JSON file where the state is written after each job\n
+    log_folder:  Folder of the log files of the jobs
+    """
+
+    def __init__(self, state_file, log_folder):
+        """
+        Constructor for Scheduler class. Reads the state of a previous run,
+        whose jobs are only skipped if they are done and their outputs exist.
+        """
+        super(Scheduler, self).__init__()
+
+        self.jobs       = {}
+        self.ended      = {}
+        self.state_file = state_file
+        self.log_folder = log_folder
+        if self.log_folder[-1] != '/' :
+            self.log_folder += '/'
+        os.makedirs(self.log_folder, exist_ok=True)
+
+        try :
+            with open(self.state_file) as f :
+                self.state = json.load(f)
+        except (IOError, ValueError) :
+            self.state = {}
+
+
+    def add(self, job) :
+        """
+        Adds a job to the graph.
+        """
+        self.jobs[job.name] = job
+
+
+    def status(self, name) :
+        return self.state.get(name, {}).get('status')
+
+
+    def set_status(self, job, status, **info) :
+        """
+        Updates the status of a job and writes the state file.
+        """
+        entry = self.state.setdefault(job.name, {})
+        entry.update(info, status=status, attempts=job.attempts)
+        if status in ('done', 'failed', 'cancelled') :
+            self.ended[job.name] = status
+
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f :
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.state_file)
+
+
+    def run(self, n_processes) :
+        """
+        Runs the jobs, each job starting as soon as its dependencies have
+        succeeded. Jobs depending on a failed job are not run, unless they
+        are tolerant.
+        @param n_processes: The number of jobs run at the same time
+        @return: The number of failed jobs
+        """
+        pending = list(self.jobs.values())
+        running = {}
+        n_failed = 0
+
+        with ThreadPoolExecutor(n_processes) as executor :
+            while len(pending) != 0 or len(running) != 0 :
+
+                # Starting the jobs that are ready. Only the jobs ended in this
+                # run count, a dependency failed in a previous run being
+                # run again
+                waiting = []
+                for job in pending :
+                    deps = [self.ended.get(dep) for dep in job.deps]
+                    failed = any([s in ('failed', 'cancelled') for s in deps])
+                    if failed and not job.tolerant :
+                        print(" Cancelled {0}".format(job))
+                        self.set_status(job, 'cancelled')
+                        n_failed += 1
+                    elif not all([s in ('done', 'failed', 'cancelled')
+                            for s in deps]) :
+                        waiting.append(job)
+                    elif (self.status(job.name) == 'done' and
+                            (len(job.outputs) == 0 or job.outputs_exist())) \
+                            or job.outputs_exist() :
+                        self.finish(job, None)
+                        pending += self.expand(job)
+                    elif len(running) < n_processes :
+                        job.attempts += 1
+                        print(" {0} Starting {1}".format(
+                                time.strftime("%H:%M:%S"), job))
+                        self.set_status(job, 'running', start=time.time())
+                        running[executor.submit(run_job, job,
+                                self.log_folder)] = job
+                    else :
+                        waiting.append(job)
+                pending = waiting
+
+                if len(running) == 0 :
+                    if len(pending) != 0 :
+                        # Jobs depending on jobs that do not exist
+                        for job in pending :
+                            print(" Missing dependencies for {0}".format(job))
+                            self.set_status(job, 'cancelled')
+                        n_failed += len(pending)
+                    break
+
+                # Waiting for a job to end
+                done, not_done = wait(list(running),
+                        return_when=FIRST_COMPLETED)
+                for future in done :
+                    job = running.pop(future)
+                    code = future.result()
+                    if code == 0 :
+                        self.finish(job, time.time())
+                        pending += self.expand(job)
+                    elif job.attempts <= job.retries :
+                        print(" {0} Retrying {1} ({2})".format(
+                                time.strftime("%H:%M:%S"), job, code))
+                        self.set_status(job, 'retrying', code=code)
+                        pending.append(job)
+                    else :
+                        print(" {0} FAILED {1} ({2}), see {3}{1}.log".format(
+                                time.strftime("%H:%M:%S"), job, code,
+                                self.log_folder))
+                        self.set_status(job, 'failed', code=code)
+                        n_failed += 1
+
+        return n_failed
+
+
+    def finish(self, job, end) :
+        """
+        Marks a job as succeeded.
+        """
+        info = {}
+        if end != None :
+            info['end'] = end
+            info['duration'] = end - self.state[job.name].get('start', end)
+            print(" {0} Finished {1}".format(time.strftime("%H:%M:%S"), job))
+        self.set_status(job, 'done', **info)
+
+
+    def expand(self, job) :
+        """
+        Adds the jobs created by a succeeded job.
+        @return: The new jobs
+        """
+        if job.expand == None :
+            return []
+        new_jobs = [j for j in job.expand() if j.name not in self.jobs]
+        for j in new_jobs :
+            self.add(j)
+
+        return new_jobs
+
+################################################################################
+#                                                                              #
+# EXOD jobs                                                                    #
+#                                                                              #
+################################################################################
+
+def observation_jobs(obs, args) :
+    """
+    Function creating the jobs of an observation.
+    @param obs: The observation ID
+    @param args: The arguments of the programme
+    @return: The list of jobs
+    """
+    path = args.folder + obs + '/'
+    out  = path + args.suffix + '/'
+    pars = "-bs {0} -dl {1:g} -tw {2:g} -gtr {3}".format(args.bs, args.dl,
+            args.tw, args.gtr)
+    xmatch = "" if args.crossmatch == None else \
+            " -crossmatch {0} -match-radius {1:g}".format(args.crossmatch,
+            args.match_radius)
+    lims = {'timeout' : args.timeout, 'memory' : args.memory,
+            'retries' : args.retries}
+
+    flt = Job('flt_' + obs, "bash {0}filtering.sh -f {1} -s {0} -o {2}".format(
+            args.scripts, args.folder, obs),
+            outputs=[path + FileNames.CLEAN_FILE], **lims)
+
+    det = Job('det_' + obs, "python3 -W ignore {0}detector.py -path {1} {2} "
+            "-mta 1 -detection {3} -catalogue {4}{5}".format(args.scripts,
+            path, pars, args.detection, args.catalogue, xmatch),
+            deps=[flt.name],
+            outputs=[out + FileNames.VARIABILITY, out + 'variable_sources.csv'],
+            **lims)
+
+    # The figures are drawn from the variability file by the renderer, a
+    # second detector run on the folder would overwrite its log
+    if args.thumbnails :
+        render, figure = "-thumbnail", FileNames.OUTPUT_THUMBNAIL
+    else :
+        render, figure = "-pdf", FileNames.OUTPUT_IMAGE_SRCS
+    ren = Job('ren_' + obs, "python3 -W ignore {0}renderer.py -files {1} "
+            "-mta 1 {2}".format(args.scripts, out + FileNames.VARIABILITY,
+            render), deps=[det.name], outputs=[out + figure], **lims)
+
+    def lightcurve_jobs() :
+        n_sources = number_of_sources(out)
+        if n_sources == 0 :
+            return []
+        # All the light curves of the observation, in one pass over the events
+        lcx = Job('lcx_' + obs, "python3 -W ignore {0}lightcurve_extractor.py "
+                "-path {1} {2}".format(args.scripts, path, pars),
+                deps=[det.name], **lims)
+        return [lcx] + [Job('lc_{0}_{1}'.format(obs, n), "bash "
+                "{0}lightcurve.sh -f {1} -s {0} -o {2} {3} -id {4} -x".format(
+                args.scripts, args.folder, obs, pars, n), deps=[lcx.name],
+                **lims) for n in range(1, n_sources + 1)]
+
+    # The lightcurves are created once the sources are known, without
+    # waiting for the figures
+    det.expand = lightcurve_jobs
+
+    return [flt, det, ren]
+
+################################################################################
+
+def number_of_sources(out) :
+    """
+    Function reading the number of detected sources of an observation.
+    @param out: The output folder of the detector
+    """
+    try :
+        with open(out + 'variable_sources.csv') as f :
+            return max(len([l for l in f if l.strip() != '']) - 1, 0)
+    except IOError :
+        return 0
+
+################################################################################
+
+def merge_pdf(files, output) :
+    """
+    Function merging pdf files with ghostscript.
+    """
+    if len(files) == 0 :
+        return
+    subprocess.run(['gs', '-dBATCH', '-dNOPAUSE', '-q', '-sDEVICE=pdfwrite',
+            '-sOutputFile=' + output] + sorted(files), check=True)
+
+################################################################################
+
+def sources_variability(args) :
+    """
+    Function writing the probabilities of constancy of all the lightcurves to
+    a single file.
+    """
+    output = args.folder + 'sources_variability_' + args.suffix
+    with open(output, 'w') as out_f :
+        out_f.write("Observation Source DL TW P_chisq P_KS\n")
+        for log in sorted(glob.glob(args.folder +
+                '0*/lcurve_{0:g}/*xronos.log'.format(args.tw))) :
+            obs = log[len(args.folder):].split('/')[0]
+            src = 'J' + os.path.basename(log).split('J', 1)[-1].split('_')[0]
+            probs = {'Chi-Square' : '', 'Kolm.-Smir.' : ''}
+            with open(log) as f :
+                for line in f :
+                    for key in probs :
+                        if key + ' Prob of constancy' in line :
+                            probs[key] = line.split()[4]
+            out_f.write('{0} {1} {2:g} {3:g} {4} {5}\n'.format(obs, src,
+                    args.dl, args.tw, probs['Chi-Square'],
+                    probs['Kolm.-Smir.']))
+
+################################################################################
+#                                                                              #
+# Main programme                                                               #
+#                                                                              #
+################################################################################
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--folder", help="Folder of the observations",
+            default='/mnt/data/Ines/data', type=str)
+    parser.add_argument("-s", "--scripts", help="Folder of the EXOD scripts",
+            default=os.path.dirname(os.path.abspath(__file__)), type=str)
+    parser.add_argument("-obs", "--observations", help="Observations to "
+            "process. Default: all the folders starting with 0", nargs='+',
+            default=None, type=str)
+    parser.add_argument("-dl", "--detection-level", dest="dl", default=8,
+            type=float)
+    parser.add_argument("-tw", "--time-window", dest="tw", default=100,
+            type=float)
+    parser.add_argument("-gtr", "--good-time-ratio", dest="gtr", default=1.0,
+            type=float)
+    parser.add_argument("-bs", "--box-size", dest="bs", default=3, type=int)
+    parser.add_argument("-detection", "--detection", dest="detection",
+            help="Detection on each CCD or on the mosaic of the CCDs",
+            default='ccd', choices=['ccd', 'mosaic'], type=str)
+    parser.add_argument("-catalogue", "--catalogue", help="Catalogue of "
+            "the variable sources of all the observations. Default: "
+            "exod_catalogue.db in the folder", default=None, type=str)
+    parser.add_argument("-crossmatch", "--crossmatch", help="Reference "
+            "catalogue the sources are matched with, FITS or CSV",
+            default=None, type=str)
+    parser.add_argument("-match-radius", "--match-radius",
+            dest="match_radius", help="Radius of the cross-match in "
+            "arcseconds", default=10.0, type=float)
+    parser.add_argument("-cpus", "--cpus", help="Number of jobs run at the "
+            "same time", default=12, type=int)
+    parser.add_argument("-timeout", "--timeout", help="Maximal duration of a "
+            "job, in seconds", default=None, type=float)
+    parser.add_argument("-memory", "--memory", help="Maximal virtual memory "
+            "of a job, in GB", default=None, type=float)
+    parser.add_argument("-retries", "--retries", help="Number of retries of a "
+            "failed job", default=1, type=int)
+    parser.add_argument("--restart", help="Ignore the state of a previous run",
+            action='store_true')
+    parser.add_argument("--thumbnails", help="Render PNG thumbnails instead "
+            "of the PDF figures", action='store_true')
+    parser.add_argument("--no-lightcurves", dest="lightcurves",
+            help="Do not create the lightcurves", action='store_false')
+    args = parser.parse_args()
+
+    for arg in ('folder', 'scripts') :
+        if getattr(args, arg)[-1] != '/' :
+            setattr(args, arg, getattr(args, arg) + '/')
+
+    if args.catalogue == None :
+        args.catalogue = args.folder + FileNames.CATALOGUE
+
+    # Same naming as the detector output folders
+    args.suffix = '{0}_{1}_{2}_{3}'.format(int(args.dl), int(args.tw), args.bs,
+            args.gtr)
+
+    if args.observations == None :
+        args.observations = sorted([os.path.basename(p[:-1]) for p in
+                glob.glob(args.folder + '0*/')])
+
+    print("\tFOLDER          = {0}".format(args.folder))
+    print("\tSCRIPTS         = {0}\n".format(args.scripts))
+    print("\tDETECTION LEVEL = {0}".format(args.dl))
+    print("\tTIME WINDOW     = {0}".format(args.tw))
+    print("\tGOOD TIME RATIO = {0}".format(args.gtr))
+    print("\tBOX SIZE        = {0}".format(args.bs))
+    print("\tCPUS            = {0}".format(args.cpus))
+    print("\tOBSERVATIONS    = {0}\n".format(len(args.observations)))
+
+    state_file = args.folder + 'exod_batch_{0}.json'.format(args.suffix)
+    if args.restart and os.path.isfile(state_file) :
+        os.remove(state_file)
+    scheduler = Scheduler(state_file, args.folder + 'logs_' + args.suffix)
+
+    ###
+    # Building the graph
+    ###
+
+    for obs in args.observations :
+        jobs = observation_jobs(obs, args)
+        if not args.lightcurves :
+            jobs[1].expand = None
+        for job in jobs :
+            scheduler.add(job)
+
+    ren_jobs = ['ren_' + obs for obs in args.observations]
+    scheduler.add(Job('pdf_observations', lambda : render_pages([[f]
+            for f in sorted(glob.glob(args.folder + '0*/{0}/{1}'.format(
+            args.suffix, FileNames.VARIABILITY)))], args.folder +
+            'variability_observations_{0}.pdf'.format(args.suffix),
+            n_workers=args.cpus), deps=ren_jobs, tolerant=True))
+
+    def lightcurves_summary() :
+        lc_jobs = [name for name in scheduler.jobs if name.startswith('lc_')]
+        return [Job('summary', lambda : (sources_variability(args),
+                merge_pdf(glob.glob(args.folder + '0*/lcurve_{0:g}/*.pdf'
+                .format(args.tw)), args.folder + 'lightcurves_{0}.pdf'.format(
+                args.suffix))), deps=lc_jobs, tolerant=True)]
+
+    if args.lightcurves :
+        # Barrier after which all the lightcurve jobs are known
+        det_jobs = ['det_' + obs for obs in args.observations]
+        scheduler.add(Job('lightcurves', lambda : None, deps=det_jobs,
+                expand=lightcurves_summary, tolerant=True))
+
+    ###
+    # Running
+    ###
+
+    start = time.time()
+    n_failed = scheduler.run(args.cpus)
+
+    print("\nTotal execution time for {0} obs. : {1:.2f} s".format(
+            len(args.observations), time.time() - start))
+    if n_failed != 0 :
+        print(" {0} jobs failed or were cancelled, see {1}".format(n_failed,
+                state_file), file=sys.stderr)
+        exit(1)
@@ -17,13 +17,19 @@
 
 # Created files
 LOG = "log.txt"
+TELEMETRY = "telemetry.json"
 
 VARIABILITY = "variability_file.fits"
 REGION = "ds9_variable_sources.reg"
+SKY_TRANSFORM = "raw2sky_transform.npz"
+BACKGROUND = "background.csv"
+CATALOGUE = "exod_catalogue.db"
+CROSSMATCH = "crossmatch.csv"
 
 OUTPUT_IMAGE = "variability.pdf"
 OUTPUT_IMAGE_SRCS = "sources.pdf"
 OUTPUT_IMAGE_ALL = "variability_whole.pdf"
+OUTPUT_THUMBNAIL = "sources.png"
 
 # Observation files
 
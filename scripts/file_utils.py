@@ -28,12 +28,12 @@ from astropy import wcs
 from astropy.io import fits
 import numpy as np
 import scipy.ndimage as nd
-import skimage
-import skimage.transform
 
 # Internal imports
 
 import file_names as FileNames
+from reprojection import reprojection, transformation_geometry
+from mosaic import assemble
 
 
 ########################################################################
@@ -227,6 +227,17 @@ class Source(object):
         self.r = self.skyr * 0.05 # arcseconds
 
 
+    def set_sky_coord(self, x, y, ra, dec) :
+        """
+        Sets the sky pixel and equatorial coordinates, rounded as in the
+        edet2sky output.
+        """
+        self.x   = round(float(x), 2)
+        self.y   = round(float(y), 2)
+        self.ra  = round(float(ra), 6)
+        self.dec = round(float(dec), 6)
+
+
     def sky_coord(self, path, img, log_f) :
         """
         Calculate sky coordinates with the sas task edet2sky.
@@ -301,22 +312,10 @@ def read_sources_from_file(file_path, comment_token='#', separator=';') :
 def ccd_config(data_matrix) :
     """
     Provides PN CCD configuration to arrange the variability data
+    @param data_matrix: The maps of the 12 CCDs, of shape (12, 64, 200, ...)
+    @return: The mosaic, of shape (384, 400, ...)
     """
-    data_v = []
-
-    # XMM-Newton EPIC-pn CCD arrangement
-    ccds = [[8,7,6,9,10,11],[5,4,3,0,1,2]]
-
-    # Building data matrix
-    for c in ccds[0] :
-        data_v.extend(np.flipud(data_matrix[c]))
-    i = 0
-    for c in ccds[1] :
-        m = np.flip(data_matrix[c])
-        for j in range(64) :
-            data_v[i] = np.append(data_v[i], m[63 - j])
-            i += 1
-    return data_v
+    return assemble(data_matrix)
 
 ########################################################################
 #                                                                      #
@@ -327,31 +326,30 @@ def ccd_config(data_matrix) :
 def data_transformation(data, header) :
     """
     Performing geometrical transformations from raw coordinates to
-    sky coordinates
+    sky coordinates. The resampling matrix is computed once per geometry and
+    reused for the next maps of the observation.
+    @param data: variability matrix
+    @param header: header of the clean events file
+    @return: transformed variability data
+    """
+    data = np.asarray(data, dtype=np.float64)
+
+    return reprojection(header, data.shape)(data)
+
+########################################################################
+
+def data_transformation_reference(data, header) :
+    """
+    Performing geometrical transformations from raw coordinates to
+    sky coordinates with successive rotation, resizing and padding of the
+    image. Reference for data_transformation, needing scikit-image.
     @param data: variability matrix
     @param header: header of the clean events file
     @return: transformed variability data
     """
+    import skimage.transform
 
-    # Header information
-    angle = header['PA_PNT']
-    dlim = [header['REFXLMIN'], header['REFXLMAX'],
-            header['REFYLMIN'], header['REFYLMAX']]
-
-    xproj = [float(header['TDMIN6']), float(header['TDMAX6'])] # projected x limits
-    yproj = [float(header['TDMIN7']), float(header['TDMAX7'])] # projected y limits
-    xlims = [float(header['TLMIN6']), float(header['TLMAX6'])] # legal x limits
-    ylims = [float(header['TLMIN7']), float(header['TLMAX7'])] # legal y limits
-
-    # scaling factor
-    sx = 648 / (xlims[1] - xlims[0])
-    sy = 648 / (ylims[1] - ylims[0])
-    # pads (padding)
-    padX = (int((xproj[0] - xlims[0])*sx), int((xlims[1] - xproj[1])*sx))
-    padY = (int((yproj[0] - ylims[0])*sy), int((ylims[1] - yproj[1])*sy))
-    # shape (resizing)
-    pixX = 648 - (padX[0] + padX[1])
-    pixY = 648 - (padY[0] +padY[1])
+    angle, padY, padX, (pixY, pixX) = transformation_geometry(header)
 
     # Transformations
     ## Rotation
@@ -25,6 +25,12 @@ from os.path import sys
 from astropy.io import fits
 from astropy import wcs
 from astropy.table import Table
+import numpy as np
+
+########################################################################
+
+# Columns of the events used by the detector
+EVENTS_DTYPE = [('TIME', 'f8'), ('RAWX', 'i2'), ('RAWY', 'i2')]
 
 
 ########################################################################
@@ -66,6 +72,53 @@ def extraction_photons(events_file):
 
 ########################################################################
 
+
+def extraction_events(events_file):
+    """
+    Function extracting the E round list from its FITS events file as
+    columns. Only the TIME, RAWX, RAWY and CCDNR columns are read, and the
+    events are split by CCD with a single stable sort.
+    @param events_file: The events FITS file
+    @return: The E round list, as one record array view per CCD sorted by TIME
+    @return: The events file header
+    @return: The t0 and tf instants of the observation
+    @raise Exception: An exception from astropy if something went wrong
+    """
+
+    with fits.open(events_file, memmap=True) as hdulist :
+        events = hdulist[1].data
+        header = hdulist[1].header
+
+        time  = np.asarray(events['TIME'], dtype=np.float64)
+        rawx  = np.asarray(events['RAWX'], dtype=np.int16)
+        rawy  = np.asarray(events['RAWY'], dtype=np.int16)
+        ccdnr = np.asarray(events['CCDNR'], dtype=np.int16)
+
+    # Keeping the events of the 12 EPIC-pn CCDs
+    cdt = (ccdnr >= 1) & (ccdnr <= 12)
+    time, rawx, rawy, ccdnr = time[cdt], rawx[cdt], rawy[cdt], ccdnr[cdt]
+
+    # Sorting by CCD, then by TIME
+    order = np.lexsort((time, ccdnr))
+
+    columns = np.empty(len(order), dtype=EVENTS_DTYPE)
+    columns['TIME'] = time[order]
+    columns['RAWX'] = rawx[order]
+    columns['RAWY'] = rawy[order]
+
+    # Boundaries of each CCD in the sorted columns
+    bounds = np.searchsorted(ccdnr[order], np.arange(1, 14))
+    events_filtered = [columns[bounds[i]:bounds[i+1]] for i in range(12)]
+
+    if len(time) != 0 :
+        t_range = (time.min(), time.max())
+    else :
+        t_range = (None, None)
+
+    return events_filtered, header, t_range
+
+########################################################################
+
 # Deprecated
 def extraction_info(events_file) :
     hdulist = fits.open(events_file)
@@ -91,7 +144,7 @@ def extraction_deleted_periods(gti_file):
 
 ########################################################################
 
-def fits_writer(data, sources, image, pars, file) :
+def fits_writer(data, sources, image, pars, file, ccd_data=None) :
     """
     Function writing the variability and sources to a fits file
     @param data: image of the variability data
@@ -99,6 +152,8 @@ def fits_writer(data, sources, image, pars, file) :
     @param image: image obtained with evselect, needed for the header
     @param pars: variability parameters used in the variability computation
     @param file: output file name
+    @param ccd_data: variability of each CCD, of shape (12, 64, 200), written
+                     to the CCD_VARIABILITY extension
     """
 
     hdulist    = fits.open(image)
@@ -111,6 +166,18 @@ def fits_writer(data, sources, image, pars, file) :
     head_var_f.append(card=('GTR', pars['GTR'], 'EXOD Good time ratio'))
     head_var_f.append(card=('DL', pars['DL'], 'EXOD Detection level'))
     head_var_f.append(card=('BS', pars['BS'], '[pix] EXOD Box size'))
+    # Detection settings, needed to detect again from the CCD variability
+    if 'DETECT' in pars :
+        head_var_f.append(card=('DETECT', pars['DETECT'],
+                'EXOD Detection on each CCD or on the mosaic'))
+        head_var_f.append(card=('BGMODEL', pars['BGMODEL'],
+                'EXOD Lower limit from the background model'))
+        head_var_f.append(card=('BGREGX', pars['BGREGX'],
+                'EXOD Background regions along RAWX'))
+        head_var_f.append(card=('BGREGY', pars['BGREGY'],
+                'EXOD Background regions along RAWY'))
+        head_var_f.append(card=('BGNMAD', pars['BGNMAD'],
+                'EXOD Background MAD in the lower limit'))
 
     # data_var_f = Table(names=('VARIABILITY', 'RAWX', 'RAWY', 'CCDNR'),
     # dtype=('f8', 'i2', 'i2', 'i2'))
@@ -121,8 +188,33 @@ def fits_writer(data, sources, image, pars, file) :
     hdul_src = fits.BinTableHDU(data=sources)
     hdul_f.append(hdul_var)
     hdul_f.append(hdul_src)
+    if ccd_data is not None :
+        hdul_f.append(fits.ImageHDU(data=np.asarray(ccd_data),
+                name='CCD_VARIABILITY'))
 
     # Writing to file
     hdul_f.writeto(file, overwrite=True)
 
     return True
+
+########################################################################
+
+
+def variability_reader(file) :
+    """
+    Function reading the variability and sources from a fits file written by
+    fits_writer
+    @param file: variability file name
+    @return: image of the variability data
+    @return: variability of each CCD, of shape (12, 64, 200)
+    @return: detected variable sources
+    @return: header of the variability image
+    @raise KeyError: if the file has no CCD_VARIABILITY extension
+    """
+    with fits.open(file) as hdulist :
+        data     = np.array(hdulist[0].data)
+        header   = hdulist[0].header
+        sources  = Table(hdulist[1].data)
+        ccd_data = np.array(hdulist['CCD_VARIABILITY'].data, dtype=np.float64)
+
+    return data, ccd_data, sources, header
@@ -0,0 +1,139 @@
+# coding=utf-8
+
+########################################################################
+#                                                                      #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                          #
+#                                                                      #
+# Good time intervals                                                  #
+#                                                                      #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com       #
+#                                                                      #
+########################################################################
+"""
+Exposure of the time windows from the good time intervals. The intervals are
+merged and sorted once, and the good time of every window is obtained from
+the cumulative good time at its two edges, whatever the number of intervals
+starting or stopping within the window.
+"""
+
+# Third-party imports
+
+import numpy as np
+
+########################################################################
+
+
+def merge_intervals(start, stop) :
+    """
+    Function sorting a list of intervals and merging the overlapping ones.
+    @param start: The start time of each interval
+    @param stop:  The stop time of each interval
+    @return: The start and stop arrays of the disjoint sorted intervals
+    """
+    start = np.asarray(start, dtype=np.float64)
+    stop  = np.asarray(stop, dtype=np.float64)
+
+    # Removing empty intervals
+    keep  = stop > start
+    start = start[keep]
+    stop  = stop[keep]
+    if len(start) == 0 :
+        return start, stop
+
+    order = np.argsort(start, kind='stable')
+    start = start[order]
+    stop  = stop[order]
+
+    # An interval starts a new group if it begins after all previous ones end
+    reach = np.maximum.accumulate(stop)
+    new_group = np.empty(len(start), dtype=bool)
+    new_group[0]  = True
+    new_group[1:] = start[1:] > reach[:-1]
+
+    first = np.flatnonzero(new_group)
+    last  = np.append(first[1:], len(start)) - 1
+
+    return start[first], reach[last]
+
+########################################################################
+
+
+class GoodTime(object):
+    """
+    Cumulative good time of an observation.\n
+
+    Attributes:\n
+    start:       The start time of each disjoint interval\n
+    stop:        The stop time of each disjoint interval\n
+    cumulative:  The good time elapsed before each interval
+    """
+
+    def __init__(self, start, stop):
+        """
+        Constructor for GoodTime class.
+        @param start: The start time of each interval
+        @param stop:  The stop time of each interval
+        """
+        super(GoodTime, self).__init__()
+
+        self.start, self.stop = merge_intervals(start, stop)
+        self.cumulative = np.concatenate(([0.0],
+                np.cumsum(self.stop - self.start)[:-1]))
+
+
+    @classmethod
+    def from_gti(cls, gti) :
+        """
+        Builds the good time from a GTI table with START and STOP columns.
+        """
+        return cls(gti['START'], gti['STOP'])
+
+
+    def total(self) :
+        """
+        Returns the total good time.
+        """
+        return float(np.sum(self.stop - self.start))
+
+
+    def elapsed(self, t) :
+        """
+        Returns the good time elapsed before each instant.
+        @param t: Array of instants
+        """
+        t = np.asarray(t, dtype=np.float64)
+        if len(self.start) == 0 :
+            return np.zeros(t.shape)
+
+        k = np.searchsorted(self.start, t, side='right') - 1
+        inside = np.clip(t - self.start[np.maximum(k, 0)], 0,
+                (self.stop - self.start)[np.maximum(k, 0)])
+
+        return np.where(k < 0, 0.0, self.cumulative[np.maximum(k, 0)] + inside)
+
+
+    def exposure(self, time_windows, time_interval) :
+        """
+        Returns the good time of each time window.
+        @param time_windows:  The start time of each time window
+        @param time_interval: The duration of a time window
+        """
+        time_windows = np.asarray(time_windows, dtype=np.float64)
+
+        return self.elapsed(time_windows + time_interval) - \
+                self.elapsed(time_windows)
+
+########################################################################
+
+
+def good_time_fraction(gti, time_windows, time_interval) :
+    """
+    Function computing the fraction of good time of each time window.
+    @param  gti:     G round, the list of TW cut-off the observation
+    @param  time_windows: The start time of each time window
+    @param  time_interval:   The duration of a time window
+    @return: The projection ratio of each time window
+    """
+    good_time = GoodTime.from_gti(gti)
+
+    return good_time.exposure(time_windows, time_interval) / time_interval
@@ -63,6 +63,7 @@ if [[ $1 == "-h" ]] || [[ $1 == "--help" ]] ; then
 	<DL>         : Detection level used for the variable sources detection\n\
 	<TW>         : Time window used for the variable sources detection\n\
 	<output_log> : full path to the log of the detection\n\
+	-x           : light curves already written by lightcurve_extractor.py\n\
 	"
 	exit
 else
@@ -76,6 +77,7 @@ TW=100
 BS=3
 GTR=1.0
 ID=1
+EXTRACTED=0
 
 # Input variables
 while [[ $# -gt 0 ]]; do
@@ -98,6 +100,8 @@ case "$1" in
   shift; shift ;;
   -s|--scripts)           SCRIPTS=${2:-$SCRIPTS}
   shift; shift ;;
+  -x|--extracted)         EXTRACTED=1
+  shift ;;
 esac
 done
 
@@ -239,6 +243,16 @@ echo -e "\n\t$src\n"
 # Background extraction region
 ###
 
+# Regions used by lightcurve_extractor.py, written to the light curves
+if [ $EXTRACTED -eq 1 ]; then
+srcexp=$(python3 -c "from astropy.io import fits; \
+  print(fits.getval('$path_out/${src}_lc_${TW}_src.lc', 'REGION', 1))")
+bgdexp=$(python3 -c "from astropy.io import fits; \
+  print(fits.getval('$path_out/${src}_lc_${TW}_bgd.lc', 'REGION', 1))")
+bgdvalid=$(python3 -c "from astropy.io import fits; print(fits.getheader( \
+  '$path_out/${src}_lc_${TW}_bgd.lc', 1).get('BGDVALID', True))")
+else
+bgdvalid=True
 if [ ! -f $nosrc_file ]; then
 evselect table=$clean_file withfilteredset=Y filteredset=$nosrc_file \
   destruct=Y keepfilteroutput=T expression="region($fbk_file:REGION,X,Y)" -V 0
@@ -248,6 +262,7 @@ bgdXY=$(ebkgreg withsrclist=no withcoords=yes imageset=$img_file \
   x=$RAd y=$DEC r=$srcRas coordtype=EQPOS | grep 'X,Y Sky Coord.' \
   | head -1 | awk '{print$5$6}')
 bgdexp="(X,Y) in CIRCLE($bgdXY,$srcR)"
+fi
 
 sleep 1
 echo -e "\nExtracting data obs. $OBS source $src with the following \
@@ -266,6 +281,7 @@ if [ ! -f $path/PN_gti.wi ]; then
 fi
 
 #if [ ! -f $path_out/${src}_lc_0.0734_src.lc ] || [ ! -f $path_out/${src}_lc_${TW}_src.lc ] || [ ! -f $path_out/${src}_lccorr_0.0734.lc ]; then
+if [ $EXTRACTED -eq 0 ]; then
 title3 "evselect 0.0734 s"
 evselect table=$clean_file energycolumn=PI expression="$srcexp" \
   withrateset=yes rateset=$path_out/${src}_lc_0.0734_src.lc \
@@ -281,11 +297,18 @@ evselect table=$clean_file energycolumn=PI expression="$srcexp" \
 evselect table=$nosrc_file energycolumn=PI expression="$bgdexp" \
   withrateset=yes rateset=$path_out/${src}_lc_${TW}_bgd.lc timebinsize=$TW \
   maketimecolumn=yes makeratecolumn=yes -V 0
+fi
 
 title3 "epiclccorr"
+# The background is not subtracted when no region free of sources was found
+if [ "$bgdvalid" == "False" ]; then
+  echo "Invalid background region, the background is not subtracted"
+  bgdset="withbkgset=no"
+else
+  bgdset="bkgtslist=$path_out/${src}_lc_0.0734_bgd.lc withbkgset=yes"
+fi
 epiclccorr srctslist=$path_out/${src}_lc_0.0734_src.lc eventlist=$clean_file \
-  outset=$path_out/${src}_lccorr_0.0734.lc \
-  bkgtslist=$path_out/${src}_lc_0.0734_bgd.lc withbkgset=yes \
+  outset=$path_out/${src}_lccorr_0.0734.lc $bgdset \
   applyabsolutecorrections=yes -V 0
 #fi
 
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+########################################################################
+#                                                                      #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                          #
+#                                                                      #
+# Light curves of all the variable sources of an observation           #
+#                                                                      #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com       #
+#                                                                      #
+########################################################################
+"""
+Extraction of the source and background light curves of all the variable
+sources of an observation, at all the time binnings, in one pass over the
+events file. The events file is read by chunks. In each chunk the events
+are sorted along X, so that only the events within the X range of a
+circular region are tested against it. The times of the events of each
+region are kept, and the light curves are binned at the end. The light
+curves are written in the format of the evselect rate files read by
+lcurve.py, with the names used by lightcurve.sh.
+"""
+
+# Built-in imports
+
+import os
+import glob
+import time
+from decimal import Decimal, ROUND_DOWN
+
+# Third-party imports
+
+import argparse
+import numpy as np
+from astropy.io import fits, ascii
+
+# Internal imports
+
+import file_names as FileNames
+from gti_utils import merge_intervals
+
+# Frame time of the EPIC-pn full frame mode, binning of the fast light curves
+FRAME_TIME = 0.0734
+
+# Number of rows of the events file read at once
+CHUNK_ROWS = 2000000
+
+########################################################################
+
+
+def source_name(ra, dec) :
+    """
+    Function giving the name of a source from its position, as written by
+    lightcurve.sh: J<hhmmss>+<ddmmss>, with '_' for '+' and the sexagesimal
+    values truncated.
+    @param ra: The right ascension in degrees
+    @param dec: The declination in degrees
+    @return: The name of the source
+    """
+    ra  = (Decimal(str(ra)) / 15).quantize(Decimal('1e-5'), ROUND_DOWN)
+    dec = Decimal(str(dec))
+    link = '-' if dec < 0 else '_'
+    dec = abs(dec)
+
+    fields = []
+    for value in (ra, dec) :
+        degrees = int(value)
+        minutes = int((value - degrees) * 60)
+        seconds = int(((value - degrees) * 60 - minutes) * 60)
+        fields.append('{0:02d}{1:02d}{2:02d}'.format(degrees, minutes,
+                seconds))
+
+    return 'J' + fields[0] + link + fields[1]
+
+########################################################################
+
+
+def region_exclusions(fbktsr_file) :
+    """
+    Function reading the circles of the sources of an observation, excluded
+    from the background, from the REGION extension of the FBKTSR source list.
+    @param fbktsr_file: The FBKTSR file
+    @return: The X, Y and radius of the circles, in sky pixels
+    """
+    with fits.open(fbktsr_file) as hdulist :
+        region = hdulist['REGION'].data
+        shape  = np.char.upper(np.char.strip(region['SHAPE'].astype(str)))
+        cdt = np.char.find(shape, 'CIRCLE') >= 0
+        x, y, r = [np.asarray(region[c], dtype=np.float64)[cdt]
+                for c in ('X', 'Y', 'R')]
+
+    # Shape parameters may be vectors, the first element being the circle
+    x, y, r = [v.reshape(len(v), -1)[:, 0] for v in (x, y, r)]
+
+    return x, y, r
+
+########################################################################
+
+
+def circle_overlap(x, y, r, ex, ey, er) :
+    """
+    Function checking which circles overlap a set of excluded circles.
+    @param x, y, r: The circles, of shape (n,)
+    @param ex, ey, er: The excluded circles, of shape (m,)
+    @return: The overlap of each pair, of shape (n, m)
+    """
+    dist = np.hypot(np.subtract.outer(x, ex), np.subtract.outer(y, ey))
+
+    return dist < np.add.outer(r, er)
+
+########################################################################
+
+
+def background_regions(sources, exclusions, image_file=None, distance=3.0,
+        n_angles=16) :
+    """
+    Function choosing the background region of each source: a circle of the
+    radius of the source, at the nearest free position on rings around it.
+    Positions overlapping a source or an excluded circle are rejected. With
+    the image of the observation, the positions whose circle is not fully
+    covered by the detector are rejected, and the position with the lowest
+    number of counts of the nearest ring is kept. Without a free position,
+    the position of the first ring overlapping the fewest excluded circles
+    is kept and the region is marked as invalid, its events within the
+    excluded circles being rejected by region_times.
+    @param sources: The source table, with X, Y and SKYR in sky pixels
+    @param exclusions: The X, Y and radius of the excluded circles
+    @param image_file: The image of the observation, binned in sky pixels
+    @param distance: The distance of the first ring, in source radii
+    @param n_angles: The number of positions on a ring
+    @return: The X, Y and radius of the background regions
+    @return: Whether each background region is free
+    """
+    x = np.asarray(sources['X'], dtype=np.float64)
+    y = np.asarray(sources['Y'], dtype=np.float64)
+    r = np.asarray(sources['SKYR'], dtype=np.float64)
+    ex, ey, er = [np.concatenate([a, b]) for a, b in zip((x, y, r),
+            exclusions)]
+
+    image = None
+    if image_file != None and os.path.isfile(image_file) :
+        with fits.open(image_file) as hdulist :
+            image  = np.asarray(hdulist[0].data, dtype=np.float64)
+            header = hdulist[0].header
+        # Sky pixel of the centre of the first image pixel, and binning, from
+        # the physical coordinates written by evselect
+        if 'CDELT1L' in header :
+            origin  = [header['CRVAL{0}L'.format(a)] + (1 - header[
+                    'CRPIX{0}L'.format(a)]) * header['CDELT{0}L'.format(a)]
+                    for a in (1, 2)]
+            binning = [header['CDELT1L'], header['CDELT2L']]
+        elif 'LTM1_1' in header :
+            origin  = [(1 - header['LTV{0}'.format(a)]) /
+                    header['LTM{0}_{0}'.format(a)] for a in (1, 2)]
+            binning = [1 / header['LTM1_1'], 1 / header['LTM2_2']]
+        else :
+            print(" !!!!\nNo physical coordinates in {0}, the image is not "
+                    "used".format(image_file))
+            image = None
+
+    def image_circle(cx, cy, cr) :
+        """
+        Values of the image pixels whose centre is within a circle.
+        """
+        col = (cx - origin[0]) / binning[0]
+        row = (cy - origin[1]) / binning[1]
+        rc, rr = cr / abs(binning[0]), cr / abs(binning[1])
+        c0, c1 = max(int(np.floor(col - rc)), 0), int(np.ceil(col + rc)) + 1
+        r0, r1 = max(int(np.floor(row - rr)), 0), int(np.ceil(row + rr)) + 1
+        rows, cols = np.mgrid[r0:min(r1, image.shape[0]),
+                c0:min(c1, image.shape[1])]
+        inside = ((cols - col) * binning[0])**2 + \
+                ((rows - row) * binning[1])**2 <= cr**2
+
+        return image[rows[inside], cols[inside]]
+
+    angles = np.arange(n_angles) * 2 * np.pi / n_angles
+    bx, by, br = x.copy(), y.copy(), r.copy()
+    valid = np.ones(len(x), dtype=bool)
+
+    for i in range(len(x)) :
+        for d in distance * np.array([1.0, 1.5, 2.0, 3.0, 4.0]) :
+            cx = x[i] + d * r[i] * np.cos(angles)
+            cy = y[i] + d * r[i] * np.sin(angles)
+            free = ~circle_overlap(cx, cy, np.full(n_angles, r[i]), ex, ey,
+                    er).any(axis=1)
+            counts = np.zeros(n_angles)
+
+            if image is not None :
+                for k in np.where(free)[0] :
+                    values = image_circle(cx[k], cy[k], r[i])
+                    if len(values) == 0 or (values <= 0).mean() > 0.1 :
+                        free[k] = False
+                    counts[k] = values.sum()
+
+            if free.any() :
+                k = np.where(free)[0][np.argmin(counts[free])]
+                bx[i], by[i] = cx[k], cy[k]
+                break
+        else :
+            print(" !!!!\nNo free background region for source {0}, the "
+                    "background is marked as invalid".format(sources['ID'][i]))
+            cx = x[i] + distance * r[i] * np.cos(angles)
+            cy = y[i] + distance * r[i] * np.sin(angles)
+            overlaps = circle_overlap(cx, cy, np.full(n_angles, r[i]), ex, ey,
+                    er).sum(axis=1)
+            k = np.argmin(overlaps)
+            bx[i], by[i] = cx[k], cy[k]
+            valid[i] = False
+
+    return bx, by, br, valid
+
+########################################################################
+
+
+def region_times(events_file, x, y, r, exclusions, background, tstart, tstop,
+        chunk_rows=CHUNK_ROWS) :
+    """
+    Function reading the times of the events of circular regions, in one
+    pass over the events file. The events of the background regions within
+    the excluded circles are rejected.
+    @param events_file: The events file, with TIME, X and Y columns
+    @param x, y, r: The regions, in sky pixels
+    @param exclusions: The X, Y and radius of the excluded circles
+    @param background: Whether each region is a background region
+    @param tstart: The start of the light curves
+    @param tstop: The end of the light curves
+    @param chunk_rows: The number of rows read at once
+    @return: The sorted times of the events of each region
+    """
+    ex, ey, er = exclusions
+    # Excluded circles overlapping each background region
+    overlaps = circle_overlap(x, y, r, ex, ey, er) & background[:, None]
+    times = [[] for i in range(len(x))]
+
+    with fits.open(events_file, memmap=True) as hdulist :
+        events = hdulist[1].data
+        for i in range(0, len(events), chunk_rows) :
+            chunk = events[i:i + chunk_rows]
+            t  = np.asarray(chunk['TIME'], dtype=np.float64)
+            ev_x = np.asarray(chunk['X'], dtype=np.float64)
+            ev_y = np.asarray(chunk['Y'], dtype=np.float64)
+            del chunk
+
+            cdt = (t >= tstart) & (t < tstop)
+            order = np.argsort(ev_x[cdt], kind='stable')
+            t, ev_x, ev_y = t[cdt][order], ev_x[cdt][order], ev_y[cdt][order]
+
+            first = np.searchsorted(ev_x, x - r, side='left')
+            last  = np.searchsorted(ev_x, x + r, side='right')
+            for k in range(len(x)) :
+                sx, sy = ev_x[first[k]:last[k]], ev_y[first[k]:last[k]]
+                inside = (sx - x[k])**2 + (sy - y[k])**2 <= r[k]**2
+                for e in np.where(overlaps[k])[0] :
+                    inside &= (sx - ex[e])**2 + (sy - ey[e])**2 > er[e]**2
+                times[k].append(t[first[k]:last[k]][inside])
+
+    return [np.sort(np.concatenate(ts)) for ts in times]
+
+########################################################################
+
+
+def exposure_fraction(edges, gti) :
+    """
+    Function computing the fraction of each time bin within the good time
+    intervals.
+    @param edges: The edges of the time bins
+    @param gti: The start and stop of the good time intervals, None if the
+                whole time range is good
+    @return: The fraction of each bin
+    """
+    if gti == None :
+        return np.ones(len(edges) - 1)
+
+    # Good time elapsed since the start at each edge
+    good = np.zeros(len(edges))
+    for start, stop in zip(*gti) :
+        good += np.clip(edges - start, 0, stop - start)
+
+    return np.diff(good) / np.diff(edges)
+
+########################################################################
+
+
+def write_rate_file(file, times, binning, tstart, tstop, gti, keywords) :
+    """
+    Function writing a light curve in the format of the evselect rate files:
+    a RATE extension with the TIME of the centre of each bin, the RATE and
+    its ERROR in counts per second, and the fractional exposure FRACEXP.
+    @param file: The output file
+    @param times: The sorted times of the events
+    @param binning: The time binning in seconds
+    @param tstart: The start of the light curve
+    @param tstop: The end of the light curve
+    @param gti: The start and stop of the good time intervals
+    @param keywords: The keywords added to the header of the extension
+    """
+    n_bins = max(int(np.ceil((tstop - tstart) / binning)), 1)
+    edges  = tstart + np.arange(n_bins + 1) * binning
+    counts = np.bincount(np.minimum(((times - tstart) / binning).astype(
+            np.int64), n_bins - 1), minlength=n_bins)
+
+    columns = [
+        fits.Column(name='TIME', format='D', unit='s',
+                array=edges[:-1] + binning / 2),
+        fits.Column(name='RATE', format='E', unit='count/s',
+                array=counts / binning),
+        fits.Column(name='ERROR', format='E', unit='count/s',
+                array=np.sqrt(counts) / binning),
+        fits.Column(name='FRACEXP', format='E',
+                array=exposure_fraction(edges, gti))]
+
+    hdu = fits.BinTableHDU.from_columns(columns, name='RATE')
+    hdu.header['TIMEDEL']  = (binning, 'Length of a time bin')
+    hdu.header['TIMEPIXR'] = (0.5, 'TIME is the centre of the bins')
+    hdu.header['TSTART']   = (tstart, 'Start of the light curve')
+    hdu.header['TSTOP']    = (tstop, 'End of the light curve')
+    for key, value in keywords.items() :
+        hdu.header[key] = value
+
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(file, overwrite=True)
+
+########################################################################
+
+
+def extract_lightcurves(events_file, sources, out_folder, binnings,
+        gti_file=None, backgrounds=None, exclusions=None, image_file=None,
+        obs=None, chunk_rows=CHUNK_ROWS) :
+    """
+    Function extracting the source and background light curves of all the
+    sources at all the binnings, in one pass over the events file. The files
+    are named <name>_lc_<binning>_src.lc and <name>_lc_<binning>_bgd.lc.
+    @param events_file: The clean events file
+    @param sources: The source table written by the detector
+    @param out_folder: The output folder
+    @param binnings: The time binnings in seconds
+    @param gti_file: The good time intervals, for the fractional exposure
+    @param backgrounds: The X, Y and radius of the background region of each
+                        source, and optionally whether it is valid, chosen by
+                        background_regions if None. The light curves of the
+                        invalid regions have BACKSCAL = 0 and BGDVALID = F
+    @param exclusions: The X, Y and radius of circles excluded from the
+                       background, in addition to the sources
+    @param image_file: The image of the observation, for background_regions
+    @param obs: The observation ID
+    @param chunk_rows: The number of rows of the events file read at once
+    @return: The names of the sources and the files written
+    """
+    if out_folder[-1] != '/' :
+        out_folder = out_folder + '/'
+    os.makedirs(out_folder, exist_ok=True)
+
+    header = fits.getheader(events_file, 1)
+    tstart, tstop = float(header['TSTART']), float(header['TSTOP'])
+    if obs == None :
+        obs = header.get('OBS_ID')
+
+    gti = None
+    if gti_file != None :
+        data = fits.getdata(gti_file, 1)
+        gti = merge_intervals(np.asarray(data['START'], dtype=np.float64),
+                np.asarray(data['STOP'], dtype=np.float64))
+
+    x = np.asarray(sources['X'], dtype=np.float64)
+    y = np.asarray(sources['Y'], dtype=np.float64)
+    r = np.asarray(sources['SKYR'], dtype=np.float64)
+    if exclusions == None :
+        exclusions = (np.zeros(0), np.zeros(0), np.zeros(0))
+    if backgrounds == None :
+        backgrounds = background_regions(sources, exclusions, image_file)
+    if len(backgrounds) < 4 :
+        backgrounds = list(backgrounds) + [np.ones(len(x), dtype=bool)]
+
+    # Sources then backgrounds, the sources being excluded from the latter
+    all_exclusions = [np.concatenate([a, b]) for a, b in zip((x, y, r),
+            exclusions)]
+    times = region_times(events_file, np.concatenate([x, backgrounds[0]]),
+            np.concatenate([y, backgrounds[1]]), np.concatenate([r,
+            backgrounds[2]]), all_exclusions, np.arange(2 * len(x)) >= len(x),
+            tstart, tstop, chunk_rows)
+
+    names, files = [], []
+    for i, src in enumerate(sources) :
+        name = source_name(src['RA'], src['DEC'])
+        names.append(name)
+        print("\t{0:<3} {1}\tsource {2} events\tbackground {3} events".format(
+                src['ID'], name, len(times[i]), len(times[len(x) + i])))
+
+        for kind, k in (('src', i), ('bgd', len(x) + i)) :
+            cx, cy, cr = (x[i], y[i], r[i]) if kind == 'src' else \
+                    [b[i] for b in backgrounds[:3]]
+            keywords = {'OBS_ID' : obs, 'OBJECT' : name,
+                    'SRC_ID' : int(src['ID']),
+                    'REGION' : "(X,Y) in CIRCLE({0:.2f},{1:.2f},{2:.2f})"
+                    .format(cx, cy, cr),
+                    'BACKSCAL' : (np.pi * cr**2, 'Area of the region in sky '
+                    'pixels')}
+            # A background overlapping the excluded circles is not used
+            if kind == 'bgd' :
+                keywords['BGDVALID'] = (bool(backgrounds[3][i]),
+                        'Background region free of sources')
+                if not backgrounds[3][i] :
+                    keywords['BACKSCAL'] = (0.0, 'Invalid background region')
+            for binning in binnings :
+                file = out_folder + '{0}_lc_{1:g}_{2}.lc'.format(name,
+                        binning, kind)
+                write_rate_file(file, times[k], binning, tstart, tstop, gti,
+                        keywords)
+                files.append(file)
+
+    return names, files
+
+########################################################################
+#                                                                      #
+# Main programme                                                       #
+#                                                                      #
+########################################################################
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Source and background "
+            "light curves of all the variable sources of an observation, in "
+            "one pass over the events")
+    parser.add_argument("-path", help="Path to the observation folder",
+            required=True, type=str)
+    parser.add_argument("-evts", help="Name of the clean events file",
+            default=FileNames.CLEAN_FILE, type=str)
+    parser.add_argument("-gti", help="Name of the GTI file",
+            default=FileNames.GTI_FILE, type=str)
+    parser.add_argument("-img", help="Name of the image file",
+            default=FileNames.IMG_FILE, type=str)
+    parser.add_argument("-dl", "--detection-level", dest="dl", default=8,
+            type=float)
+    parser.add_argument("-tw", "--time-window", dest="tw", default=100,
+            type=float)
+    parser.add_argument("-bs", "--box-size", dest="bs", default=3, type=int)
+    parser.add_argument("-gtr", "--good-time-ratio", dest="gtr", default=1.0,
+            type=float)
+    parser.add_argument("-binnings", "--binnings", help="Time binnings in "
+            "seconds.\nDefault: the frame time {0} s and the time window"
+            .format(FRAME_TIME), nargs='+', default=None, type=float)
+    parser.add_argument("-ids", "--ids", help="Identifiers of the sources. "
+            "Default: all", nargs='+', default=None, type=int)
+    parser.add_argument("-bgd", "--background", dest="bgd", help="CSV file "
+            "of the background regions, with ID, X, Y and R in sky pixels. "
+            "Default: chosen around each source", default=None, type=str)
+    parser.add_argument("-fbktsr", "--fbktsr", help="FBKTSR source list "
+            "whose sources are excluded from the background. Default: the "
+            "FBKTSR file of the observation folder, if any", default=None,
+            type=str)
+    parser.add_argument("-out", help="Output folder. Default: "
+            "lcurve_<TW> in the observation folder", default=None, type=str)
+    parser.add_argument("-chunk", "--chunk-rows", dest="chunk",
+            help="Number of events read at once", default=CHUNK_ROWS,
+            type=int)
+    args = parser.parse_args()
+
+    if args.path[-1] != '/' :
+        args.path = args.path + '/'
+    if args.binnings == None :
+        args.binnings = [FRAME_TIME, args.tw]
+    if args.out == None :
+        args.out = args.path + 'lcurve_{0:g}/'.format(args.tw)
+    if args.fbktsr == None :
+        fbktsr = sorted(glob.glob(args.path + '*PNS*FBKTSR*'))
+        args.fbktsr = fbktsr[0] if len(fbktsr) != 0 else None
+
+    original_time = time.time()
+
+    src_file = args.path + '{0}_{1}_{2}_{3}/variable_sources.csv'.format(
+            int(args.dl), int(args.tw), args.bs, args.gtr)
+    sources = ascii.read(src_file, format='csv')
+    if args.ids != None :
+        sources = sources[np.isin(sources['ID'], args.ids)]
+
+    exclusions = None
+    if args.fbktsr != None :
+        exclusions = region_exclusions(args.fbktsr)
+        print(" Excluded regions\t{0}\t{1}".format(len(exclusions[0]),
+                args.fbktsr))
+
+    backgrounds = None
+    if args.bgd != None :
+        bgd = ascii.read(args.bgd, format='csv')
+        index = {int(i) : k for k, i in enumerate(bgd['ID'])}
+        rows = [index[int(i)] for i in sources['ID']]
+        backgrounds = [np.asarray(bgd[c], dtype=np.float64)[rows]
+                for c in ('X', 'Y', 'R')]
+
+    print(" Extracting {0} sources at {1} s".format(len(sources),
+            ' s, '.join(['{0:g}'.format(b) for b in args.binnings])))
+
+    if len(sources) != 0 :
+        names, files = extract_lightcurves(args.path + args.evts, sources,
+                args.out, args.binnings, gti_file=args.path + args.gti,
+                backgrounds=backgrounds, exclusions=exclusions,
+                image_file=args.path + args.img, chunk_rows=args.chunk)
+        print(" {0} light curves written to {1}".format(len(files),
+                args.out))
+
+    print(" # Total time {0:.2f} s".format(time.time() - original_time))
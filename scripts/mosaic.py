@@ -0,0 +1,151 @@
+# coding=utf-8
+
+########################################################################
+#                                                                      #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                          #
+#                                                                      #
+# EPIC-pn CCD mosaic                                                   #
+#                                                                      #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com       #
+#                                                                      #
+########################################################################
+"""
+Arrangement of the 12 EPIC-pn CCDs into the 384 x 400 mosaic. The mosaic
+pixel of each CCD pixel, and the CCD pixel of each mosaic pixel, are
+precomputed as index arrays, so that a stack of per-CCD maps is assembled
+into the mosaic and a mosaic is scattered back to the CCDs in one operation.
+The CCDs are numbered from 0 to 11 and the raw coordinates start at 0.
+"""
+
+# Third-party imports
+
+import numpy as np
+
+# XMM-Newton EPIC-pn CCD arrangement: the top half of the mosaic, from
+# left to right, is flipped along RAWX, the bottom half is flipped along
+# both axes and placed on the right of the top half
+CCDS = [[8,7,6,9,10,11],[5,4,3,0,1,2]]
+
+CCD_SHAPE    = (64, 200)
+MOSAIC_SHAPE = (384, 400)
+
+########################################################################
+
+
+def mosaic_position(ccd, rawx, rawy) :
+    """
+    Function giving the position of CCD pixels in the mosaic. Non-integer
+    raw coordinates give non-integer positions.
+    @param ccd: The CCD indices, from 0 to 11
+    @param rawx: The RAWX coordinates, from 0 to 63
+    @param rawy: The RAWY coordinates, from 0 to 199
+    @return: The rows and columns in the mosaic
+    """
+    ccd  = np.asarray(ccd, dtype=np.int64)
+    rawx = np.asarray(rawx)
+    rawy = np.asarray(rawy)
+
+    # Position of each CCD in its half, and half of each CCD
+    slot = np.zeros(12, dtype=np.int64)
+    top  = np.zeros(12, dtype=bool)
+    for half, ccds in enumerate(CCDS) :
+        slot[ccds] = np.arange(len(ccds))
+        top[ccds]  = half == 0
+
+    row = np.where(top[ccd], CCD_SHAPE[0] * slot[ccd] + CCD_SHAPE[0] - 1 -
+            rawx, CCD_SHAPE[0] * slot[ccd] + rawx)
+    col = np.where(top[ccd], rawy, MOSAIC_SHAPE[1] - 1 - rawy)
+
+    return row, col
+
+########################################################################
+
+# Flattened mosaic position of each CCD pixel, of shape (12, 64, 200), and
+# flattened CCD pixel of each mosaic position, of shape (384, 400)
+_ccd, _rawx, _rawy = np.indices((12,) + CCD_SHAPE)
+_row, _col = mosaic_position(_ccd, _rawx, _rawy)
+
+SCATTER_INDEX = _row * MOSAIC_SHAPE[1] + _col
+GATHER_INDEX  = np.empty(MOSAIC_SHAPE[0] * MOSAIC_SHAPE[1], dtype=np.int64)
+GATHER_INDEX[SCATTER_INDEX.ravel()] = np.arange(SCATTER_INDEX.size)
+GATHER_INDEX  = GATHER_INDEX.reshape(MOSAIC_SHAPE)
+
+del _ccd, _rawx, _rawy, _row, _col
+
+########################################################################
+
+
+def ccd_position(row, col) :
+    """
+    Function giving the CCD pixels of mosaic positions.
+    @param row: The rows in the mosaic
+    @param col: The columns in the mosaic
+    @return: The CCD indices, RAWX and RAWY coordinates
+    """
+    flat = GATHER_INDEX[np.asarray(row, dtype=np.int64),
+            np.asarray(col, dtype=np.int64)]
+    ccd, rest = np.divmod(flat, CCD_SHAPE[0] * CCD_SHAPE[1])
+    rawx, rawy = np.divmod(rest, CCD_SHAPE[1])
+
+    return ccd, rawx, rawy
+
+########################################################################
+
+
+def raw_position(ccd, row, col) :
+    """
+    Function giving the raw coordinates of mosaic positions in the frame of
+    given CCDs, inverse of mosaic_position. The positions outside the CCDs
+    give raw coordinates outside their limits.
+    @param ccd: The CCD indices, from 0 to 11
+    @param row: The rows in the mosaic
+    @param col: The columns in the mosaic
+    @return: The RAWX and RAWY coordinates
+    """
+    ccd = np.asarray(ccd, dtype=np.int64)
+    row = np.asarray(row)
+    col = np.asarray(col)
+
+    slot = np.zeros(12, dtype=np.int64)
+    top  = np.zeros(12, dtype=bool)
+    for half, ccds in enumerate(CCDS) :
+        slot[ccds] = np.arange(len(ccds))
+        top[ccds]  = half == 0
+
+    rawx = np.where(top[ccd], CCD_SHAPE[0] * slot[ccd] + CCD_SHAPE[0] - 1 -
+            row, row - CCD_SHAPE[0] * slot[ccd])
+    rawy = np.where(top[ccd], col, MOSAIC_SHAPE[1] - 1 - col)
+
+    return rawx, rawy
+
+########################################################################
+
+
+def assemble(stack) :
+    """
+    Function assembling per-CCD maps into the mosaic.
+    @param stack: The maps of the 12 CCDs, of shape (12, 64, 200, ...)
+    @return: The mosaic, of shape (384, 400, ...)
+    """
+    stack = np.asarray(stack)
+    if stack.shape[:3] != (12,) + CCD_SHAPE :
+        raise ValueError("Stack of shape {0} instead of (12, 64, 200, ...)"
+                .format(stack.shape))
+
+    return stack.reshape((-1,) + stack.shape[3:])[GATHER_INDEX]
+
+########################################################################
+
+
+def scatter(mosaic) :
+    """
+    Function splitting a mosaic into per-CCD maps.
+    @param mosaic: The mosaic, of shape (384, 400, ...)
+    @return: The maps of the 12 CCDs, of shape (12, 64, 200, ...)
+    """
+    mosaic = np.asarray(mosaic)
+    if mosaic.shape[:2] != MOSAIC_SHAPE :
+        raise ValueError("Mosaic of shape {0} instead of (384, 400, ...)"
+                .format(mosaic.shape))
+
+    return mosaic.reshape((-1,) + mosaic.shape[2:])[SCATTER_INDEX]
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+########################################################################
+#                                                                      #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                          #
+#                                                                      #
+# Online variability computation                                       #
+#                                                                      #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com       #
+#                                                                      #
+########################################################################
+"""
+Incremental variability computation, fed with batches of time-ordered
+events. The running maximum, minimum and a histogram of the counts of each
+pixel are updated every time a time window closes, and the variable areas of
+the current variability map are passed to a callback. The replay driver
+feeds an existing events file by chunks.
+"""
+
+# Built-in imports
+
+import sys
+import os
+import time
+
+# Third-party imports
+
+import numpy as np
+import argparse
+
+# Internal imports
+
+from variability_utils import neighbourhood_sum, variable_areas_detection
+from gti_utils import GoodTime
+import file_names as FileNames
+
+########################################################################
+#                                                                      #
+# Online variability                                                   #
+#                                                                      #
+########################################################################
+
+class OnlineVariability(object):
+    """
+    Running variability of the 12 CCDs.\n
+
+    Attributes:\n
+    start_time:        The t0 instant of the observation\n
+    time_interval:     The duration of a time window\n
+    acceptable_ratio:  The good time ratio a window needs to be used\n
+    good_time:         The good time of the observation, None if all the
+                       time is good\n
+    current:           Index of the time window being filled\n
+    n_windows:         Number of time windows used in the statistics\n
+    n_late:            Number of events received after their window closed\n
+    maximum, minimum:  The running maximum and minimum counts of each pixel\n
+    histogram:         The number of windows with each count, for each pixel,
+                       extended up to max_count. Larger counts are added to
+                       the last bin, so the median is exact as long as it is
+                       below max_count\n
+    partial:           The counts of the windows partially in the good time,
+                       corrected by their good time ratio, kept exactly
+    """
+
+    def __init__(self, start_time, time_interval, box_size, detection_level,
+            acceptable_ratio=1.0, gti=None, callback=None, max_count=127):
+        """
+        Constructor for OnlineVariability class.
+        @param start_time: The t0 instant of the observation
+        @param time_interval: The duration of a time window
+        @param box_size: The size of the detection box
+        @param detection_level: The detection level
+        @param acceptable_ratio: The acceptability ratio for a TW
+        @param gti: G round, the list of TW cut-off the observation
+        @param callback: Function called with (window index, window start,
+                         V round matrices, list of the variable areas of each
+                         CCD) each time a window closes
+        @param max_count: The largest count of the histograms
+        """
+        super(OnlineVariability, self).__init__()
+
+        self.start_time       = start_time
+        self.time_interval    = time_interval
+        self.box_size         = box_size
+        self.detection_level  = detection_level
+        self.acceptable_ratio = acceptable_ratio
+        self.good_time        = GoodTime.from_gti(gti) if gti is not None \
+                else None
+        self.callback         = callback
+        self.max_count        = max_count
+
+        self.current   = 0
+        self.n_windows = 0
+        self.n_late    = 0
+        self.raw       = np.zeros((12, 66, 202), dtype=np.int64)
+        self.maximum   = np.zeros((12, 64, 200))
+        self.minimum   = np.full((12, 64, 200), np.inf)
+        self.histogram = np.zeros((12, 64, 200, min(16, max_count + 1)),
+                dtype=np.uint32)
+        self.partial   = []
+
+
+    def window_ends(self, first, last) :
+        """
+        Returns the end of the time windows first to last - 1, computed as in
+        time_window_grid.
+        """
+        return self.start_time + np.arange(first, last) * self.time_interval \
+                + self.time_interval
+
+
+    def push(self, time, rawx, rawy, ccdnr) :
+        """
+        Adds a batch of events, closing the windows that end before the last
+        event of the batch.
+        @param time: The TIME column of the events
+        @param rawx: The RAWX column of the events
+        @param rawy: The RAWY column of the events
+        @param ccdnr: The CCDNR column of the events
+        @return: The number of windows closed
+        """
+        if len(time) == 0 :
+            return 0
+
+        order = np.argsort(time, kind='stable')
+        time  = np.asarray(time, dtype=np.float64)[order]
+        rawx  = np.asarray(rawx, dtype=np.int64)[order]
+        rawy  = np.asarray(rawy, dtype=np.int64)[order]
+        ccdnr = np.asarray(ccdnr, dtype=np.int64)[order]
+
+        # Events of the windows already closed
+        if self.current > 0 :
+            late = time <= self.window_ends(self.current - 1, self.current)[0]
+            self.n_late += int(np.sum(late))
+            time, rawx, rawy, ccdnr = time[~late], rawx[~late], rawy[~late], \
+                    ccdnr[~late]
+            if len(time) == 0 :
+                return 0
+
+        # Window of each event, the windows being closed on their right edge
+        last = max(int(np.ceil((time[-1] - self.start_time) /
+                self.time_interval)) + 1, self.current + 1)
+        n = self.current + np.searchsorted(self.window_ends(self.current,
+                last), time, side='left')
+
+        # Filling the windows one after the other, the last one staying open
+        bounds = np.searchsorted(n, np.arange(self.current, n[-1] + 1),
+                side='right')
+        first = 0
+        n_closed = 0
+        for end in bounds :
+            self.add(rawx[first:end], rawy[first:end], ccdnr[first:end])
+            first = end
+            if self.current < n[-1] :
+                self.close()
+                n_closed += 1
+
+        return n_closed
+
+
+    def add(self, rawx, rawy, ccdnr) :
+        """
+        Adds events to the current window.
+        """
+        cdt = (ccdnr >= 1) & (ccdnr <= 12) & (0 <= rawx) & (rawx < 66) & \
+                (0 <= rawy) & (rawy < 202)
+        flat = ((ccdnr[cdt] - 1) * 66 + rawx[cdt]) * 202 + rawy[cdt]
+        self.raw += np.bincount(flat, minlength=self.raw.size).reshape(
+                self.raw.shape)
+
+
+    def close(self) :
+        """
+        Closes the current window, updates the statistics and calls the
+        callback with the variable areas.
+        """
+        window_start = self.start_time + self.current * self.time_interval
+
+        ratio = 1.0
+        if self.good_time != None :
+            ratio = self.good_time.exposure([window_start],
+                    self.time_interval)[0] / self.time_interval
+
+        if ratio >= self.acceptable_ratio :
+            # Counts spread over the 3x3 neighbourhood of each pixel
+            counts = neighbourhood_sum(self.raw.transpose(1, 2, 0))
+            counts = counts.transpose(2, 0, 1) / ratio
+            self.update(counts, ratio != 1)
+
+        self.raw[...] = 0
+        self.current += 1
+
+        if ratio >= self.acceptable_ratio and self.callback != None :
+            v_matrix = self.variability()
+            self.callback(self.current - 1, window_start, v_matrix,
+                    self.detect(v_matrix))
+
+
+    def update(self, counts, corrected=False) :
+        """
+        Adds the counts of a window to the running statistics. The counts
+        corrected by a good time ratio are not integers, and are kept apart
+        from the histograms.
+        """
+        self.maximum = np.maximum(self.maximum, counts)
+        self.minimum = np.minimum(self.minimum, counts)
+        self.n_windows += 1
+
+        if corrected :
+            self.partial.append(np.array(counts, dtype=np.float64))
+            return
+
+        index = np.minimum(np.rint(counts), self.max_count).astype(np.int64)
+
+        # Extending the histograms up to the largest count seen
+        n_values = self.histogram.shape[-1]
+        if index.max() >= n_values :
+            size = min(max(2 * n_values, int(index.max()) + 1),
+                    self.max_count + 1)
+            self.histogram = np.concatenate((self.histogram,
+                    np.zeros(self.histogram.shape[:-1] + (size - n_values,),
+                    dtype=np.uint32)), axis=-1)
+
+        flat = self.histogram.reshape(-1, self.histogram.shape[-1])
+        flat[np.arange(len(flat)), index.ravel()] += 1
+
+
+    def median(self) :
+        """
+        Returns the median count of each pixel, as np.median would compute it
+        on the histogrammed counts and the corrected counts of the partial
+        windows.
+        """
+        n = self.n_windows
+        cumul = np.cumsum(self.histogram, axis=-1)
+        if len(self.partial) == 0 :
+            low  = np.sum(cumul < (n - 1) // 2 + 1, axis=-1)
+            high = np.sum(cumul < n // 2 + 1, axis=-1)
+            return (low + high) / 2
+
+        # Number of windows up to each integer count, and up to each
+        # corrected count
+        partial = np.stack(self.partial)
+        n_values = cumul.shape[-1]
+        int_cumul = cumul + np.sum(partial[..., np.newaxis] <=
+                np.arange(n_values), axis=0)
+        index = np.minimum(np.floor(partial), n_values - 1).astype(np.int64)
+        part_cumul = np.take_along_axis(cumul, np.moveaxis(index, 0, -1),
+                axis=-1)
+        part_cumul = np.moveaxis(part_cumul, -1, 0) + np.sum(
+                partial[np.newaxis] <= partial[:, np.newaxis], axis=1)
+
+        def order(rank) :
+            """
+            Value of the given rank, the smallest count reached by rank + 1
+            windows.
+            """
+            reached = int_cumul >= rank + 1
+            value = np.where(reached.any(axis=-1), np.argmax(reached,
+                    axis=-1), np.inf)
+            return np.minimum(value, np.where(part_cumul >= rank + 1,
+                    partial, np.inf).min(axis=0))
+
+        return (order((n - 1) // 2) + order(n // 2)) / 2
+
+
+    def variability(self) :
+        """
+        Returns the V round matrix of each CCD, computed as in
+        variability_statistic from the running statistics.
+        """
+        if self.n_windows <= 1 :
+            return np.ones((12, 64, 200))
+
+        median = self.median()
+        deviation = np.maximum(self.maximum - median,
+                np.absolute(self.minimum - median))
+
+        return np.divide(deviation, median, out=self.maximum.copy(),
+                where=median != 0)
+
+
+    def detect(self, v_matrix) :
+        """
+        Returns the variable areas of each CCD, with the median variability
+        as lower limit, as the detector does.
+        """
+        median = max(np.median(v_matrix), 0.75)
+
+        return [variable_areas_detection(median, self.box_size,
+                self.detection_level, v_matrix[ccd]) for ccd in range(12)]
+
+
+    def finish(self, end_time) :
+        """
+        Closes the last windows of the observation. As in time_window_grid,
+        the last window is dropped if its missing fraction is above the
+        acceptable ratio.
+        @param end_time: The tf instant of the observation
+        """
+        n_bins = int(np.ceil((end_time - self.start_time) / self.time_interval))
+        stop_time = self.start_time + n_bins * self.time_interval
+        if (stop_time - end_time) / self.time_interval > \
+                self.acceptable_ratio :
+            n_bins = n_bins - 1
+
+        while self.current < n_bins :
+            self.close()
+
+########################################################################
+#                                                                      #
+# Replay driver                                                        #
+#                                                                      #
+########################################################################
+
+if __name__ == '__main__':
+
+    from astropy.io import fits
+    from fits_extractor import extraction_deleted_periods
+    from streaming import event_chunks, time_range
+
+    parser = argparse.ArgumentParser(description="Replays an events file "
+            "by chunks through the online variability computation")
+    parser.add_argument("-path", help="Path to the folder containing the "
+            "observation files", type=str)
+    parser.add_argument("-evts", help="Name of the clean observation file",
+            type=str, nargs='?', default=FileNames.CLEAN_FILE)
+    parser.add_argument("-gti", help="Name of the GTI file",
+            type=str, nargs='?', default=FileNames.GTI_FILE)
+    parser.add_argument("-bs", "--box-size", dest="bs", default=5, nargs='?',
+            type=int)
+    parser.add_argument("-dl", "--detection-level", dest="dl", default=10,
+            nargs='?', type=float)
+    parser.add_argument("-tw", "--time-window", dest="tw", default=100.0,
+            nargs='?', type=float)
+    parser.add_argument("-gtr", "--good-time-ratio", dest="gtr", default=1.0,
+            nargs='?', type=float)
+    parser.add_argument("-chunk", "--chunk-rows", dest="chunk",
+            help="Number of events of a batch.\nDefault: 10000",
+            default=10000, nargs='?', type=int)
+    parser.add_argument("-alerts", help="File where the variable areas of "
+            "each window are written", default=None, type=str)
+    args = parser.parse_args()
+
+    if args.path[-1] != '/' :
+        args.path = args.path + '/'
+    evts = args.path + args.evts
+    gti  = extraction_deleted_periods(args.path + args.gti)
+
+    original_time = time.time()
+    t0, tf = time_range(evts, 2**20)
+
+    alerts_f = None
+    if args.alerts != None :
+        alerts_f = open(args.alerts, 'w')
+        alerts_f.write('WINDOW,START,CCD,CENTER_X,CENTER_Y,NPIX\n')
+
+    def alert(window, start, v_matrix, variable_areas) :
+        n_areas = sum([len(areas) for areas in variable_areas])
+        if n_areas != 0 :
+            print(" Window {0:<5} t = {1:.1f}\t{2} variable areas".format(
+                    window, start, n_areas))
+        if alerts_f != None :
+            for ccd, areas in enumerate(variable_areas) :
+                for area in areas :
+                    alerts_f.write('{0},{1},{2},{3},{4},{5}\n'.format(window,
+                            start, ccd + 1, area['CENTER_X'],
+                            area['CENTER_Y'], area['NPIX']))
+
+    online = OnlineVariability(t0, args.tw, args.bs, args.dl, args.gtr, gti,
+            alert)
+    for chunk in event_chunks(evts, args.chunk) :
+        online.push(*chunk)
+    online.finish(tf)
+
+    if alerts_f != None :
+        alerts_f.close()
+    if online.n_late != 0 :
+        print(" {0} events received after their window closed".format(
+                online.n_late), file=sys.stderr)
+
+    print(" # Replayed {0} windows in {1:.2f} s".format(online.current,
+            time.time() - original_time))
@@ -0,0 +1,419 @@
+# coding=utf-8
+
+########################################################################
+#                                                                      #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                          #
+#                                                                      #
+# Parallel computation of the counts and variability                   #
+#                                                                      #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com       #
+#                                                                      #
+########################################################################
+"""
+Parallel counting of the events of the 12 CCDs. The event columns and the
+counts cube are placed in shared memory, and the work is divided into
+CCD x time-chunk units of similar numbers of events, so that more than 12
+workers can be used and that a bright CCD is shared between workers. Each
+unit fills a disjoint slice of the counts cube.
+"""
+
+# Built-in imports
+
+from functools import partial
+from multiprocessing import Pool, shared_memory
+
+# Third-party imports
+
+import numpy as np
+
+# Internal imports
+
+from variability_utils import count_columns, rebin_counts, sweep_plan, \
+        projection_ratios, variability_from_counts
+
+# Number of units per worker, for the load balancing
+UNITS_PER_WORKER = 4
+
+# Maximal number of time windows of a unit, bounding the memory of a worker
+MAX_UNIT_BINS = 512
+
+# Number of pixel rows of a CCD per variability unit
+ROWS_PER_UNIT = 16
+
+# Shared arrays attached by the worker, indexed by name
+_shared = {}
+
+########################################################################
+#                                                                      #
+# Shared arrays                                                        #
+#                                                                      #
+########################################################################
+
+
+class SharedArray(object):
+    """
+    Numpy array stored in shared memory.\n
+
+    Attributes:\n
+    shm:    The shared memory block\n
+    array:  The numpy array using the block
+    """
+
+    def __init__(self, shape, dtype, name=None):
+        """
+        Constructor for SharedArray class. Creates a new block if no name is
+        given, or attaches to an existing block otherwise.
+        @param shape: The shape of the array
+        @param dtype: The type of the array
+        @param name: The name of an existing block
+        """
+        super(SharedArray, self).__init__()
+
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+
+        if name == None :
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else :
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        self.array = np.ndarray(self.shape, dtype=self.dtype,
+                buffer=self.shm.buf)
+
+
+    def descriptor(self) :
+        """
+        Returns the (name, shape, dtype) needed to attach to the array.
+        """
+        return self.shm.name, self.shape, self.dtype.str
+
+
+    def shrink(self, shape) :
+        """
+        Uses the start of the block as an array of a smaller shape.
+        @param shape: The new shape, of at most as many elements
+        """
+        self.shape = tuple(shape)
+        self.array = np.ndarray(self.shape, dtype=self.dtype,
+                buffer=self.shm.buf)
+
+
+    def close(self, unlink=False) :
+        """
+        Releases the array, and removes the block if unlink is True.
+        """
+        self.array = None
+        self.shm.close()
+        if unlink :
+            self.shm.unlink()
+
+########################################################################
+
+
+def _attach(descriptors) :
+    """
+    Pool initializer attaching the worker to the shared arrays.
+    @param descriptors: Dictionary of the (name, shape, dtype) of the arrays
+    """
+    for key, (name, shape, dtype) in descriptors.items() :
+        _shared[key] = SharedArray(shape, dtype, name)
+
+########################################################################
+#                                                                      #
+# Work units                                                           #
+#                                                                      #
+########################################################################
+
+
+def share_events(data) :
+    """
+    Function copying the event columns of the 12 CCDs into shared memory.
+    The events of each CCD are sorted by time.
+    @param data: E round, the list of the events of each CCD
+    @return: The shared TIME, RAWX and RAWY columns
+    @return: The index of the first event of each CCD, of length 13
+    """
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(evts) for evts in data])
+
+    time = SharedArray((offsets[-1],), np.float64)
+    rawx = SharedArray((offsets[-1],), np.int16)
+    rawy = SharedArray((offsets[-1],), np.int16)
+
+    for ccd, evts in enumerate(data) :
+        if len(evts) == 0 :
+            continue
+        k = slice(offsets[ccd], offsets[ccd + 1])
+        t = np.asarray(evts['TIME'], dtype=np.float64)
+        order = np.argsort(t, kind='stable')
+        time.array[k] = t[order]
+        rawx.array[k] = np.asarray(evts['RAWX'])[order]
+        rawy.array[k] = np.asarray(evts['RAWY'])[order]
+
+    return (time, rawx, rawy), offsets
+
+########################################################################
+
+
+def count_units(time, offsets, time_windows, time_interval, n_workers) :
+    """
+    Function dividing the counting of the events into CCD x time-chunk units
+    of similar numbers of events.
+    @param time: The TIME column, sorted within each CCD
+    @param offsets: The index of the first event of each CCD
+    @param time_windows: The start time of each time window
+    @param time_interval: The duration of a time window
+    @param n_workers: The number of workers
+    @return: List of (ccd, first window, last window + 1, first event,
+             last event + 1), the largest units first
+    """
+    n_bins = len(time_windows)
+    ends   = np.asarray(time_windows) + time_interval
+    target = max(offsets[-1] / (UNITS_PER_WORKER * n_workers), 1)
+
+    units = []
+    for ccd in range(len(offsets) - 1) :
+        t = time[offsets[ccd]:offsets[ccd + 1]]
+        # Number of events up to the end of each window
+        cumul = np.searchsorted(t, ends, side='right')
+
+        n_chunks = int(np.ceil(len(t) / target))
+        cuts = np.searchsorted(cumul, np.arange(1, n_chunks) * len(t) /
+                n_chunks)
+        cuts = np.unique(np.concatenate(([0], cuts,
+                np.arange(0, n_bins, MAX_UNIT_BINS), [n_bins])))
+
+        for lo, hi in zip(cuts[:-1], cuts[1:]) :
+            first = cumul[lo - 1] if lo > 0 else 0
+            units.append((ccd, lo, hi, offsets[ccd] + first,
+                    offsets[ccd] + cumul[hi - 1]))
+
+    units.sort(key=lambda unit : unit[4] - unit[3], reverse=True)
+
+    return units
+
+########################################################################
+
+
+def _count_unit(unit, time_windows, time_interval) :
+    """
+    Worker counting the events of a unit into the shared counts cube.
+    """
+    ccd, lo, hi, first, last = unit
+    counts = count_columns(_shared['time'].array[first:last],
+            _shared['rawx'].array[first:last],
+            _shared['rawy'].array[first:last], time_windows[lo:hi],
+            time_interval)
+    _shared['counts'].array[ccd, :, :, lo:hi] = counts
+
+########################################################################
+
+
+def _variability_unit(unit, acceptable_ratio) :
+    """
+    Worker computing the variability of some rows of a CCD.
+    """
+    k, ccd, row, projection_ratio = unit
+    rows = slice(row, row + ROWS_PER_UNIT)
+    _shared['v_%d' % k].array[ccd, rows] = variability_from_counts(
+            _shared['counts_%d' % k].array[ccd, rows], projection_ratio,
+            acceptable_ratio)
+
+########################################################################
+#                                                                      #
+# Parallel computation                                                 #
+#                                                                      #
+########################################################################
+
+
+def parallel_counts(data, time_windows, time_interval, n_workers) :
+    """
+    Function counting the events of the 12 CCDs in parallel.
+    @param data: E round, the list of the events of each CCD
+    @param time_windows: The start time of each time window
+    @param time_interval: The duration of a time window
+    @param n_workers: The number of processes
+    @return: The shared counts cube, of shape (12, 64, 200, n_bins). It is
+             released by the caller with close(unlink=True)
+    """
+    time_windows = np.asarray(time_windows, dtype=np.float64)
+    (time, rawx, rawy), offsets = share_events(data)
+    counts = SharedArray((len(data), 64, 200, len(time_windows)), np.int32)
+    arrays = {'time' : time, 'rawx' : rawx, 'rawy' : rawy, 'counts' : counts}
+
+    try :
+        units = count_units(time.array, offsets, time_windows, time_interval,
+                n_workers)
+        descriptors = {key : a.descriptor() for key, a in arrays.items()}
+        with Pool(n_workers, _attach, (descriptors,)) as p :
+            count_partial = partial(_count_unit, time_windows=time_windows,
+                    time_interval=time_interval)
+            for _ in p.imap_unordered(count_partial, units) :
+                pass
+
+    except :
+        counts.close(unlink=True)
+        raise
+
+    finally :
+        for a in (time, rawx, rawy) :
+            a.close(unlink=True)
+
+    return counts
+
+########################################################################
+
+
+def parallel_variability(counts, acceptable_ratio, n_workers) :
+    """
+    Function computing the variability of the 12 CCDs for several time
+    windows in parallel, over units of a few pixel rows. The shared counts
+    cubes are used in place, the other cubes are copied to shared memory.
+    @param counts: The list of (counts cube, projection ratios) of each time
+                   window, the cubes being SharedArray or numpy arrays of
+                   shape (12, 64, 200, n_bins)
+    @param acceptable_ratio: The acceptability ratio for a TW - good time ratio
+    @param n_workers: The number of processes
+    @return: The V round matrices of each CCD, one list per time window
+    """
+    arrays = {}
+    owned  = []
+    units  = []
+    try :
+        for k, (counted_events, projection_ratio) in enumerate(counts) :
+            if not isinstance(counted_events, SharedArray) :
+                cube = SharedArray(counted_events.shape, counted_events.dtype)
+                owned.append(cube)
+                cube.array[...] = counted_events
+                counted_events = cube
+            arrays['counts_%d' % k] = counted_events
+            arrays['v_%d' % k] = SharedArray(counted_events.shape[:3],
+                    np.float64)
+            owned.append(arrays['v_%d' % k])
+            units += [(k, ccd, row, projection_ratio)
+                    for ccd in range(counted_events.shape[0])
+                    for row in range(0, 64, ROWS_PER_UNIT)]
+
+        descriptors = {key : a.descriptor() for key, a in arrays.items()}
+        with Pool(n_workers, _attach, (descriptors,)) as p :
+            variability_partial = partial(_variability_unit,
+                    acceptable_ratio=acceptable_ratio)
+            for _ in p.imap_unordered(variability_partial, units) :
+                pass
+
+        v_matrices = [list(arrays['v_%d' % k].array.copy())
+                for k in range(len(counts))]
+
+    finally :
+        for a in owned :
+            a.close(unlink=True)
+
+    return v_matrices
+
+########################################################################
+
+
+def keep_windows(cube, cdt) :
+    """
+    Function keeping the good time windows of a shared counts cube in place.
+    The CCDs are moved one by one to the start of the block, each CCD being
+    written before the next ones are read.
+    @param cube: The shared counts cube, of shape (12, 64, 200, n_bins)
+    @param cdt: The indices of the good time windows, increasing
+    @return: The shared counts cube, of shape (12, 64, 200, n_good)
+    """
+    if len(cdt) == cube.shape[-1] :
+        return cube
+
+    full = cube.array
+    cube.shrink(cube.shape[:-1] + (len(cdt),))
+    for ccd in range(cube.shape[0]) :
+        cube.array[ccd] = full[ccd][..., cdt]
+
+    return cube
+
+########################################################################
+
+
+def good_windows(base_counts, factor, n_bins, cdt) :
+    """
+    Function rebinning a counted counts cube to a time window into a new
+    shared counts cube, keeping its good time windows. The CCDs are rebinned
+    one by one, bounding the temporary arrays.
+    @param base_counts: The counts cube of the counted time window
+    @param factor: The number of counted windows in a time window
+    @param n_bins: The number of time windows
+    @param cdt: The indices of the good time windows
+    @return: The shared counts cube, of shape (12, 64, 200, n_good)
+    """
+    good = SharedArray(base_counts.shape[:-1] + (len(cdt),), base_counts.dtype)
+    for ccd in range(base_counts.shape[0]) :
+        good.array[ccd] = rebin_counts(base_counts[ccd], factor,
+                n_bins)[..., cdt]
+
+    return good
+
+########################################################################
+
+
+def parallel_counts_sweep(gti, time_intervals, acceptable_ratio, start_time,
+        end_time, data, n_workers) :
+    """
+    Function counting the events of the 12 CCDs for several time windows in
+    parallel, the time windows being obtained as in counts_sweep. Only the
+    windows of projection ratio above the acceptability ratio are kept.
+    @param  gti:     G round, the list of TW cut-off the observation
+    @param  time_intervals:  The list of durations of the time windows
+    @param  acceptable_ratio:  The acceptability ratio for a TW - good time ratio
+    @param  start_time:  The t0 instant of the observation
+    @param  end_time: THe tf instant of the observation
+    @param  data:    E round, the list of the events of each CCD
+    @param  n_workers: The number of processes
+    @return: The list of (shared counts cube, projection ratios), one per time
+             window, the cubes being of shape (12, 64, 200, n_good). They are
+             released by the caller with close(unlink=True)
+    """
+    counted, grids, sources = sweep_plan(time_intervals, acceptable_ratio,
+            start_time, end_time)
+
+    counts = [None for tw in time_intervals]
+    base_counts = None
+    try :
+        for b, (windows, base) in enumerate(counted) :
+            base_counts = parallel_counts(data, windows, base, n_workers)
+
+            # The counted cube becomes the cube of its own time window, which
+            # is therefore processed once the others have been rebinned
+            users = sorted([k for k in range(len(time_intervals))
+                    if sources[k][0] == b], key=lambda k : sources[k][1] == 1)
+
+            for k in users :
+                tw, factor = time_intervals[k], sources[k][1]
+                n_bins = len(grids[k])
+                projection_ratio = projection_ratios(gti, grids[k], tw)
+                cdt = np.where(projection_ratio >= acceptable_ratio)[0]
+
+                if factor == 1 and k == users[-1] :
+                    cube, base_counts = keep_windows(base_counts, cdt), None
+                else :
+                    cube = good_windows(base_counts.array, factor, n_bins,
+                            cdt)
+
+                counts[k] = (cube, projection_ratio[cdt])
+
+            if base_counts != None :
+                base_counts.close(unlink=True)
+                base_counts = None
+
+    except :
+        for entry in counts :
+            if entry != None :
+                entry[0].close(unlink=True)
+        raise
+
+    finally :
+        if base_counts != None :
+            base_counts.close(unlink=True)
+
+    return counts
@@ -12,7 +12,8 @@
 #                                                                              #
 ################################################################################
 """
-Detecting variable sources for existing variability file by changing the detection level
+Detecting variable sources for existing variability file by changing the
+detection level and the box size
 """
 
 # Built-in imports
@@ -20,18 +21,11 @@ Detecting variable sources for existing variability file by changing the detecti
 import sys
 import os
 import time
-from functools import partial
-from affine import Affine
-from shutil import copy2
 
 # Third-party imports
 
-from math import *
-from multiprocessing import Pool
-from astropy.io import fits
-from astropy import wcs
-from astropy.coordinates import SkyCoord
-from astropy import units as u
+from astropy.io import ascii
+from astropy.table import Table
 import numpy as np
 import argparse
 
@@ -41,162 +35,188 @@ from fits_extractor import *
 from variability_utils import *
 import file_names as FileNames
 from file_utils import *
-from detector import *
-
-###
-# Argument parser
-###
-
-parser = argparse.ArgumentParser()
-parser.add_argument("evts", help="Path to the filtered events file", type=str)
-parser.add_argument("init", help="Path to the initial input file", type=str)
-parser.add_argument("fin", help="Path to the final file", type=str)
-parser.add_argument("-obs", "--observation", dest="obs", help="Observation ID", default="", nargs='?', type=str)
-parser.add_argument("-bs", "--box-size", dest="bs", help="Size of the detection box in pixel^2.", default=5, nargs='?', type=int)
-parser.add_argument("-dl", "--detection-level", dest="dl", help="The number of times the median variability is required to trigger a detection.", default=10, nargs='?', type=float)
-parser.add_argument("-tw", "--time-window", dest="tw", help="The duration of the time windows.", default=100.0, nargs='?', type=float)
-parser.add_argument("-gtr", "--good-time-ratio", dest="gtr", help="Ratio of acceptability for a time window. Shall be between 0.0 and 1.0.", default=0.9, nargs='?', type=float)
-parser.add_argument("-mta", "--max-threads-allowed", dest="mta", help="Maximal number of CPUs the program is allowed to use.", nargs='?', default=12, type=int)
-parser.add_argument("-ol", "--output-log", dest="ol", help="tName of the general output file.", nargs='?', default="detected_sources", type=str)
-args = parser.parse_args()
-
-if args.init[-1] != '/' :
-    args.init += '/'
-if args.fin[-1] != '/' :
-    args.fin += '/'
-
-###
-# Reading variability function
-###
-
-def read_file(file_path, counter=False, comment_token='#', separator=';') :
-    """
-    Function returning the content
-    @param counter: True if it is the counters that are loaded, False if it is the variability
-    @return: A list
-    """
-
-    data = np.zeros([12,64,200])
-    ccd = 0; i = 0; j = 0
-    with open(file_path) as f:
-        for line in f:
-            if comment_token not in line :
-                data[ccd][i][j] = line
-                if j < 199 :
-                    j += 1
-                elif j == 199 and i < 63 :
-                    j = 0; i += 1
-                elif j == 199 and i == 63 :
-                    j = 0; i = 0; ccd += 1
-    return data
-
-
-###
-# Starting
-###
-
-print('\n\t  RELEVEL Obs. {0}\n\t{1}'.format(args.obs,'-'*27))
-
-original_time = time.time()
-original_date = time.strftime("%d/%m/%Y %H:%M:%S", time.gmtime())
-
-print('\n\n\tbox size = {0}\n\tdetection level = {1}\n\ttime window = {2}\n\tsignificance level = {3}\n'.format(args.bs, args.dl, args.tw, args.gtr))
-
-
-###
-# Opening existing files
-###
-
-log_f, var_f, var_per_tw_f, detected_var_areas_f, tws_f, detected_var_sources_f = open_files(sys.argv[3])
-var_f.close()
-output_log = open(args.ol, 'a')
-
-copy2(args.init + FileNames.VARIABILITY, args.fin + FileNames.VARIABILITY)
-
-v_matrix = read_file(args.fin + FileNames.VARIABILITY)
-
-hdulist = fits.open(args.evts)
-if len(hdulist) == 1 :
-    os.system("bash /mnt/data/Ines/progs/filtering.sh /mnt/data/Ines/data/DR5 {0} /mnt/xmmcat/3xmm_pievli".format(args.obs))
-header, dmin, dmax = extraction_info(args.evts)
-
-log_f = open(sys.argv[2] + FileNames.LOG, "w+")
-log_f.write('Command:\n\t')
-log_f.write(' '.join([arg for arg in sys.argv]))
-log_f.write('\n')
-log_f.write("Creation of output files over.\n")
-
-
-####
-#
-#   Detecting variable areas and sources
-#
-####
-
-print('Detecting variable areas\t %.3f secondes' % (time.time() - original_time))
-median = np.median([v_matrix[ccd][i][j] for ccd in range(12) for i in range(len(v_matrix[ccd])) for j in range(len(v_matrix[ccd][i]))])
-
-# Avoiding a too small median value for detection
-print('\nMedian\t\t',median)
-if median < 0.75 :
-    median = 0.75
-    log_f.write('Median switched to 0.75. \n')
-
-variable_areas = []
+from background import background_model, threshold_map
 
-# Function for the pool of threads
-variable_areas_detection_partial = partial(variable_areas_detection, median, args.bs, args.dl)
-print('Box counts\t', args.dl * ((args.bs**2) * median))
-
-# Performing parallel detection on each CCD
-with Pool(args.mta) as p:
-    variable_areas = p.map(variable_areas_detection_partial, v_matrix)
-
-# Conversion pixels CCD en pixels ciel
-w = wcs.WCS(header)
-w.wcs.crpix = [header['REFXCRPX'], header['REFYCRPX']]
-w.wcs.cdelt = [header['REFXCDLT']/15, header['REFYCDLT']]
-w.wcs.crval = [header['REFXCRVL']/15, header['REFYCRVL']]
-w.wcs.ctype = [header['REFXCTYP'], header['REFYCTYP']]
-angle = header['PA_PNT']
-
-# Writing sources to their files
-cpt_source = 0
-
-for ccd in range(12) :
-    for source in variable_areas[ccd] :
-
-        center_x = sum([p[0] for p in source]) / len(source)
-        center_y = sum([p[1] for p in source]) / len(source)
-
-        R = round(sqrt( (max([abs(p[0] - center_x) for p in source]))**2 + (max([abs(p[1] - center_y) for p in source]))**2 ))
-
-        position = Source(cpt_source, ccd, center_x, center_y, R)
-        (src_x, src_y) = transformation(position.x, position.y, dmax, dmin, angle)
-
-        ra, dec = w.wcs_pix2world(src_x, src_y, 1)
-        c   = SkyCoord(ra=ra*u.degree, dec=dec*u.degree)
-        ra  = '{:.0f} {:.0f} {:.2f}'.format(c.ra.dms[0], c.ra.dms[1], c.ra.dms[2])
-        dec = '{:.0f} {:.0f} {:.2f}'.format(c.dec.dms[0], c.dec.dms[1], c.dec.dms[2])
-
-        # Avoiding bad pixels
-        if [ccd, int(center_x)] not in [[4,11], [4,12], [4,13], [5,12], [10,28]] :
-            cpt_source += 1
-            detected_var_sources_f.write('{0};{1};{2};{3};{4};{5};{6}\n'.format(cpt_source, ccd + 1, center_x, center_y, R, ra, dec))
+################################################################################
+#                                                                              #
+# Functions                                                                    #
+#                                                                              #
+################################################################################
 
-        for p in source :
-            detected_var_areas_f.write('{0};{1};{2};{3}\n'.format(cpt_source, ccd + 1, p[0], p[1]))
+def relevel(v_matrix, dls, bss, obs, path, img, log_f, out_folder,
+        detection='ccd', background=None) :
+    """
+    Function detecting the variable sources of a variability matrix for
+    several detection levels and box sizes, with the detection settings of
+    the detector.
+    @param v_matrix: The V round matrix of each CCD, of shape (12, 64, 200)
+    @param dls: The list of detection levels
+    @param bss: The list of box sizes
+    @param obs: The observation ID
+    @param path: The path to the observation folder
+    @param img: The image file, used for the sky coordinates
+    @param log_f: The log file
+    @param out_folder: Function returning the output folder for a (DL, BS) pair
+    @param detection: The detection on each CCD, 'ccd', or on the mosaic
+    @param background: The (regions, n_mad) of the background model raising
+                       the lower limit, None for the global lower limit
+    @return: Dictionary of the source tables, indexed by (DL, BS)
+    """
 
-print('Nb of sources\t',cpt_source)
-log_f.write('Nb of sources\t{0}\n'.format(cpt_source))
+    median = np.median(v_matrix)
+    print('\tMedian\t\t{0}'.format(median))
+    # Avoiding a too small median value for detection
+    if median < 0.75 :
+        median = 0.75
+        print(' Median switched to 0.75.')
+
+    # Lower limit of each pixel, from the background of its CCD region
+    lower_limit = median
+    if background != None :
+        regions, n_mad = background
+        model = background_model(v_matrix, regions)
+        lower_limit = threshold_map(model, regions, median, n_mad)
+    limits = [lower_limit] * 12 if np.ndim(lower_limit) == 0 else lower_limit
+
+    tables = {}
+    for bs in bss :
+        for dl in dls :
+            if detection == 'mosaic' :
+                variable_areas = variable_areas_mosaic(lower_limit, bs, dl,
+                        v_matrix)
+            else :
+                variable_areas = [variable_areas_detection(limits[ccd], bs,
+                        dl, v_matrix[ccd]) for ccd in range(12)]
+
+            out = out_folder(dl, bs)
+            if not os.path.exists(out) :
+                os.makedirs(out)
+            if background != None :
+                ascii.write(Table(model), out + FileNames.BACKGROUND,
+                        format='csv', overwrite=True)
+
+            tables[(dl, bs)] = variable_sources_position(variable_areas, obs,
+                    path, out + FileNames.REGION, log_f, img)
+            print('\tDL {0:<6} BS {1:<3} Nb of sources\t{2}'.format(dl, bs,
+                    len(tables[(dl, bs)])))
+
+    return tables
 
+################################################################################
+#                                                                              #
+# Main programme                                                               #
+#                                                                              #
+################################################################################
 
-####
-#
-#   End of the programme
-#
-####
-output_log.write('{0} {1} {2} {3}\n'.format(args.obs, cpt_source, args.dl, args.tw))
-log_f.write("# TOTAL EXECUTION TIME : %s seconds\n" % (time.time() - original_time))
-close_files(log_f, var_f, var_per_tw_f, detected_var_areas_f, tws_f, detected_var_sources_f)
-print(" # Total execution time Obs. {0} : {1} seconds\n".format(args.obs, (time.time() - original_time)))
+if __name__ == '__main__':
+
+    ###
+    # Argument parser
+    ###
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("init", help="Path to the folder containing the "
+            "initial variability file", type=str)
+    parser.add_argument("-path", help="Path to the folder containing the "
+            "observation files. Default: parent folder of init", default=None,
+            type=str)
+    parser.add_argument("-img", help="Name of the image file",
+            type=str, nargs='?', default=FileNames.IMG_FILE)
+    parser.add_argument("-obs", "--observation", dest="obs",
+            help="Observation ID", default=None, nargs='?', type=str)
+    parser.add_argument("-bs", "--box-size", dest="bs",
+            help="Sizes of the detection box in pixel^2.", default=[5],
+            nargs='+', type=int)
+    parser.add_argument("-dl", "--detection-level", dest="dl",
+            help="The number of times the median variability is required to "
+            "trigger a detection.", default=[10], nargs='+', type=float)
+    parser.add_argument("-creator", "--creator", dest="creator",
+            help="User creating the variability files", nargs='?',
+            default=os.environ.get('USER', ''), type=str)
+    parser.add_argument("-ol", "--output-log", dest="ol",
+            help="Name of the general output file.", nargs='?', default=None,
+            type=str)
+    args = parser.parse_args()
+
+    if args.init[-1] != '/' :
+        args.init += '/'
+    if args.path == None :
+        args.path = os.path.dirname(os.path.dirname(args.init)) + '/'
+    if args.path[-1] != '/' :
+        args.path += '/'
+    args.img = args.path + args.img
+
+    original_time = time.time()
+
+    ###
+    # Reading the existing variability file
+    ###
+
+    var_file = args.init + FileNames.VARIABILITY
+    try :
+        img_v, v_matrix, src, header = variability_reader(var_file)
+    except KeyError :
+        print(" !!!!\nNo CCD variability in {0}. Run the detector again to "
+                "produce it. ABORTING.".format(var_file), file=sys.stderr)
+        exit(-2)
+
+    if args.obs == None :
+        args.obs = header['OBS_ID']
+    tw, gtr = header['TW'], header['GTR']
+
+    # Detection settings of the detector, absent from the older files
+    detection = header.get('DETECT', 'ccd')
+    regions   = [header.get('BGREGX', 1), header.get('BGREGY', 4)]
+    n_mad     = header.get('BGNMAD', 0.0)
+    background = (regions, n_mad) if header.get('BGMODEL', False) else None
+
+    print('\n\t  RELEVEL Obs. {0}\n\t{1}'.format(args.obs,'-'*27))
+    print('\n\tdetection levels = {0}\n\tbox sizes = {1}\n\ttime window = {2}'
+            '\n\tgood time ratio = {3}\n\tdetection = {4}\n\tbackground = {5}'
+            '\n'.format(args.dl, args.bs, tw, gtr, detection, background))
+
+    def out_folder(dl, bs) :
+        return args.path + '{}_{}_{}_{}/'.format(int(dl), int(tw), bs, gtr)
+
+    ###
+    # Detecting variable sources
+    ###
+
+    log_f = open(args.init + FileNames.LOG, 'a')
+    tables = relevel(v_matrix, args.dl, args.bs, args.obs, args.path,
+            args.img, log_f, out_folder, detection, background)
+    log_f.close()
+
+    ###
+    # Writing the output files
+    ###
+
+    for (dl, bs), sources in tables.items() :
+        out = out_folder(dl, bs)
+        params = {
+                  "CREATOR" : args.creator,
+                  "DATE"    : time.strftime("%Y-%m-%d %H:%M:%S",
+                                time.gmtime()),
+                  "OBS_ID"  : args.obs,
+                  "TW"      : tw,
+                  "GTR"     : gtr,
+                  "DL"      : dl,
+                  "BS"      : bs,
+                  "DETECT"  : detection,
+                  "BGMODEL" : background != None,
+                  "BGREGX"  : regions[0],
+                  "BGREGY"  : regions[1],
+                  "BGNMAD"  : n_mad
+                 }
+        ascii.write(sources, out + 'variable_sources.csv', format='csv',
+                overwrite=True)
+        fits_writer(img_v, sources, args.img, params,
+                out + FileNames.VARIABILITY, ccd_data=v_matrix)
+
+        if args.ol != None :
+            with open(args.ol, 'a') as output_log :
+                output_log.write('{0} {1} {2} {3}\n'.format(args.obs,
+                        len(sources), dl, tw))
+
+    print(" # Total execution time Obs. {0} : {1:.2f} s\n".format(args.obs,
+            (time.time() - original_time)))
@@ -93,11 +93,11 @@ variabilitectron(){
 	# writing detector and renderer commands to file that will be run in parallel
 
 	if [[ $count -lt $nb_img ]]; then
-		echo "python3 -W"ignore" $SCRIPTS/relevel.py $events_file $path/${DL0}_${TW}_${GTR}_${BS0} $path/${DLf}_${TW}_${GTR}_${BSf} -obs $obs -bs $BSf -dl $DLf -tw $TW -gtr $GTR -mta 1 -ol $FOLDER/variable_sources_${DLf}_${TW}_${BSf}" >> $FOLDER/process_rel_${DLf}_${TW}_${BSf}
+		echo "python3 -W"ignore" $SCRIPTS/relevel.py $path/${DL0}_${TW}_${BS0}_${GTR} -path $path -obs $obs -bs $BSf -dl $DLf -ol $FOLDER/variable_sources_${DLf}_${TW}_${BSf}" >> $FOLDER/process_rel_${DLf}_${TW}_${BSf}
 		echo "python3 -W"ignore" $SCRIPTS/renderer.py $path/${DLf}_${TW}_${GTR}_${BSf} $events_file -obs $obs -tw $TW -dl $DLf" >> $FOLDER/process_ren_${DLf}_${TW}_${BSf}
 
   else
-    echo -n "python3 -W"ignore" $SCRIPTS/relevel.py $events_file $path/${DL0}_${TW}_${GTR}_${BS0} $path/${DLf}_${TW}_${GTR}_${BSf} -obs $obs -bs $BSf -dl $DLf -tw $TW -gtr $GTR -mta 1 -ol $FOLDER/variable_sources_${DLf}_${TW}_${BSf} ; " >> $FOLDER/process_rel_${DLf}_${TW}_${BSf}
+    echo -n "python3 -W"ignore" $SCRIPTS/relevel.py $path/${DL0}_${TW}_${BS0}_${GTR} -path $path -obs $obs -bs $BSf -dl $DLf -ol $FOLDER/variable_sources_${DLf}_${TW}_${BSf} ; " >> $FOLDER/process_rel_${DLf}_${TW}_${BSf}
     echo "echo 'False' > $FOLDER/waiting_rel" >> $FOLDER/process_rel_${DLf}_${TW}_${BSf}
     echo -n "python3 -W"ignore" $SCRIPTS/renderer.py $path/${DLf}_${TW}_${GTR}_${BSf} $events_file -obs $obs -tw $TW -dl $DLf ; " >> $FOLDER/process_ren_${DLf}_${TW}_${BSf}
     echo "echo 'False' > $FOLDER/waiting_ren" >> $FOLDER/process_ren_${DLf}_${TW}_${BSf}
@@ -15,30 +15,41 @@ from renderer import *
 ###
 # Parsing arguments
 ###
-parser = argparse.ArgumentParser()
+parser = argparse.ArgumentParser(description="Comparison of the variability "
+        "computed with several parameters. With several observations, one "
+        "page per observation is written to a multi-page PDF file.")
 
 # Path to files
-parser.add_argument("-path", help="Path to the folder containing the observation files", type=str)
-parser.add_argument("-out", help="Name of the output file", default=FileNames.OUTPUT_IMAGE_ALL, type=str)
+parser.add_argument("-path", help="Path to the folders containing the observation files", nargs='+', type=str)
+parser.add_argument("-dirs", help="Parameter folders of the observations, "
+        "one panel each", nargs='+', default=['5_3_3_1.0', '6_10_3_1.0',
+        '7_30_3_1.0', '8_100_3_1.0'], type=str)
+parser.add_argument("-out", help="Name of the output file, in the observation "
+        "folder for a single observation", default=FileNames.OUTPUT_IMAGE_ALL,
+        type=str)
+parser.add_argument("-mta", "--max-threads-allowed", dest="mta",
+        help="Number of threads reading the variability files", default=4,
+        type=int)
+parser.add_argument("-dpi", "--dpi", help="Resolution of the figures",
+        default=500, type=int)
+parser.add_argument("--no-sources", dest="sources",
+        help="Do not plot the detected sources", action='store_false')
 
 args = parser.parse_args()
 
 # Modifying arguments
-if args.path[-1] != '/' :
-    args.path = args.path + '/'
-args.out = args.path + args.out
+args.path = [path if path[-1] == '/' else path + '/' for path in args.path]
+if len(args.path) == 1 and not os.path.isabs(args.out) :
+    args.out = args.path[0] + args.out
 
-# Dd=efining paths to files
-
-file0 = args.path + '/5_3_3_1.0/'   + FileNames.VARIABILITY
-file1 = args.path + '/6_10_3_1.0/'  + FileNames.VARIABILITY
-file2 = args.path + '/7_30_3_1.0/'  + FileNames.VARIABILITY
-file3 = args.path + '/8_100_3_1.0/' + FileNames.VARIABILITY
+# Defining paths to files, one group per observation
+groups = [[path + d + '/' + FileNames.VARIABILITY for d in args.dirs]
+        for path in args.path]
 
 ###
 # Applying renderer
 ###
 
-render_variability_all(file0, file1, file2, file3, args.out)
+n_pages = render_pages(groups, args.out, args.sources, args.mta, args.dpi)
 
-print(args.out)
+print(args.out, n_pages)
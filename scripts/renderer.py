@@ -19,6 +19,10 @@ Renderer's main programme
 from os.path import sys
 import os
 import shutil
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import islice
 
 # Third-party imports
 
@@ -28,6 +32,7 @@ import matplotlib
 matplotlib.use("Pdf")
 from matplotlib import colors, image, transforms, gridspec
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
 #import matplotlib.gridspec as gridspec
 from pylab import figure, cm
 #from matplotlib.colors import LogNorm
@@ -41,68 +46,95 @@ from astropy.io import fits
 import file_names as FileNames
 from file_utils import *
 
-def render_variability(var_file, output_file, sources=True, pars=None,
-        maximum_value=None) :
-    """
-    Function producing output pdf plots from the computed variability.
-    @param var_file: fits file containing variability and sources data
-    @param output_file: The path to the PDF file to be created
-    @param sources: If the detected sources are plotted or not
-    @param pars: observation parameters
-    @param maximum_value: The maximal value for the logarithmic scale
-    """
+# Keywords defining the WCS transformation of a variability image
+WCS_KEYWORDS = ['OBS_ID', 'REFXCRPX', 'REFYCRPX', 'REFXCDLT', 'REFYCDLT',
+        'REFXCRVL', 'REFYCRVL', 'REFXCTYP', 'REFYCTYP']
 
-    ###
-    # Plot settings
-    ###
-
-    # Opening variability file
-    hdulist = fits.open(var_file)
-
-    data   = hdulist[0].data
-    src    = hdulist[1].data
-    header = hdulist[0].header
+########################################################################
 
-    hdulist.close()
+def variability_wcs(header, wcs_cache=None) :
+    """
+    Function computing the WCS transformation of a variability image. The
+    transformations are shared by the images of an observation through the
+    cache.
+    @param header: The header of the image
+    @param wcs_cache: Dictionary of the transformations already computed,
+                      or None
+    @return: The WCS transformation
+    """
+    key = tuple([header.get(keyword) for keyword in WCS_KEYWORDS])
+    if wcs_cache != None and key in wcs_cache :
+        return wcs_cache[key]
 
     # Obtaining the WCS transformation parameters
-
     w = wcs.WCS(header)
 
     w.wcs.crpix = [header['REFXCRPX'], header['REFYCRPX']]
     w.wcs.cdelt = [header['REFXCDLT']/15, header['REFYCDLT']]
     w.wcs.crval = [header['REFXCRVL']/15, header['REFYCRVL']]
     w.wcs.ctype = [header['REFXCTYP'], header['REFYCTYP']]
-    angle = header['PA_PNT']       # Degrees
 
-    # Image limit
-    dlim = [header['REFXLMIN'], header['REFXLMAX'], header['REFYLMIN'],
-            header['REFYLMAX']]
+    # The first transformation stored is shared, if several threads
+    # computed it at once
+    if wcs_cache != None :
+        w = wcs_cache.setdefault(key, w)
 
+    return w
 
-    # Limite maximale de l'échelle des couleurs pour la normalisation par logarithme
-    if maximum_value == None :
-        maximum_value = max([max(tmp) for tmp in data])
+########################################################################
+
+class VariabilityProduct(object):
+    """
+    Content of a variability file, loaded once for all its figures.\n
+
+    Attributes:\n
+    data:     The variability image\n
+    sources:  The table of the detected sources\n
+    header:   The header of the image\n
+    wcs:      The WCS transformation of the image\n
+    limits:   The limits of the image in sky pixels, as imshow extent
+    """
 
-    ###
-    # Plotting
-    ###
+    def __init__(self, var_file, wcs_cache=None):
+        """
+        Constructor for VariabilityProduct class.
+        @param var_file: fits file containing variability and sources data
+        @param wcs_cache: Dictionary of the WCS transformations shared by
+                          the products, or None
+        """
+        super(VariabilityProduct, self).__init__()
 
-    # Plotting the variability data
-    plt.subplot(111, projection=w)
+        with fits.open(var_file) as hdulist :
+            self.data    = np.asarray(hdulist[0].data)
+            self.sources = hdulist[1].data
+            self.header  = hdulist[0].header
 
-    im = plt.imshow(data, cmap=cm.inferno, norm=colors.LogNorm(vmin=1.0,
-            vmax=maximum_value), extent=dlim)
+        header = self.header
+        self.wcs = variability_wcs(header, wcs_cache)
 
-    ax = plt.gca()
-    ax.set_facecolor('k')
-    cbar = plt.colorbar(im)
+        # Image limit
+        self.limits = [header['REFXLMIN'], header['REFXLMAX'],
+                header['REFYLMIN'], header['REFYLMAX']]
+
+########################################################################
 
-    # Plotting the sources
-    if sources :
-        if len(src) != 0 :
-            # Position of the sources
-            plt.plot(src['X'], src['Y'], 'wo', alpha = 1, fillstyle='none')
+def variability_figure(product, maximum_value) :
+    """
+    Function drawing the variability image of a product, without sources.
+    @param product: The VariabilityProduct
+    @param maximum_value: The maximal value for the logarithmic scale
+    @return: The figure and its axes
+    """
+    header = product.header
+
+    fig = plt.figure()
+    ax  = fig.add_subplot(111, projection=product.wcs)
+
+    im = ax.imshow(product.data, cmap=cm.inferno, norm=colors.LogNorm(
+            vmin=1.0, vmax=maximum_value), extent=product.limits)
+
+    ax.set_facecolor('k')
+    cbar = fig.colorbar(im, ax=ax)
 
     ra  = ax.coords[0]
     dec = ax.coords[1]
@@ -113,80 +145,227 @@ def render_variability(var_file, output_file, sources=True, pars=None,
             width=1)
 
     # Labels
-    plt.xlabel('RA', fontsize=10)
-    plt.ylabel('DEC', fontsize=10)
+    ax.set_xlabel('RA', fontsize=10)
+    ax.set_ylabel('DEC', fontsize=10)
     cbar.ax.set_ylabel('Variability', fontsize=10)
 
     # Title
-    #if pars != None :
-    plt.title('OBS {0}'.format(header['OBS_ID']), fontsize=14)
-    plt.text(0.5, 0.95, "TW {0} s    DL {1}   BS {2}".format(header['TW'],
+    ax.set_title('OBS {0}'.format(header['OBS_ID']), fontsize=14)
+    ax.text(0.5, 0.95, "TW {0} s    DL {1}   BS {2}".format(header['TW'],
             header['DL'], header['BS']), color='white', fontsize=10,
             horizontalalignment='center', transform = ax.transAxes)
 
-    plt.savefig(output_file, pad_inches=0, bbox_inches='tight', dpi=500)
+    return fig, ax
 
 ########################################################################
 
-def render_variability_all(var_file0, var_file1, var_file2, var_file3,
-        output_file, sources=True, pars=None, maximum_value=10) :
+def variability_thumbnail(product, output_file, sources, maximum_value,
+        size=256) :
+    """
+    Function writing a low resolution PNG image of the variability, without
+    axes. The image is reduced by taking the maximum of blocks of pixels, so
+    that small variable areas stay visible.
+    @param product: The VariabilityProduct
+    @param output_file: The path to the PNG file
+    @param sources: If the detected sources are marked or not
+    @param maximum_value: The maximal value for the logarithmic scale
+    @param size: The maximal number of pixels of a side of the image
+    """
+    data = np.nan_to_num(product.data.astype(np.float64))
+
+    # Block maximum
+    factor = max(int(np.ceil(max(data.shape) / size)), 1)
+    shape = -(-np.array(data.shape) // factor)
+    padded = np.zeros(shape * factor)
+    padded[:data.shape[0], :data.shape[1]] = data
+    image = padded.reshape(shape[0], factor, shape[1], factor).max(axis=(1, 3))
+
+    cmap = cm.inferno.copy()
+    cmap.set_bad('k')
+    rgba = cmap(colors.LogNorm(vmin=1.0, vmax=maximum_value, clip=True)(
+            np.ma.masked_less_equal(image, 0)))
+
+    # Circles around the sources, the first row being the top of the image
+    if sources and len(product.sources) != 0 :
+        xmin, xmax, ymin, ymax = product.limits
+        col = (product.sources['X'] - xmin) / (xmax - xmin) * data.shape[1]
+        row = (ymax - product.sources['Y']) / (ymax - ymin) * data.shape[0]
+        y, x = np.indices(image.shape)
+        for r, c in zip(row / factor, col / factor) :
+            ring = np.absolute(np.hypot(y + 0.5 - r, x + 0.5 - c) - 4) < 0.75
+            rgba[ring] = (1, 1, 1, 1)
+
+    plt.imsave(output_file, rgba)
 
-    var_files = [var_file0, var_file1, var_file2, var_file3]
+########################################################################
 
-    # Starting loop on the different parameters
-    fig, axes = plt.subplots(nrows=2, ncols=2, figsize=(9.5,8))
-    gs1 = gridspec.GridSpec(2, 2, wspace=0.05, hspace=0.05)
+def render_products(var_file, outputs, maximum_value=10, dpi=500,
+        thumbnail_size=256) :
+    """
+    Function producing several figures of a variability file, which is read
+    once. The PDF figures share one drawing, the sources being added after
+    the figures without them. The PNG files are low resolution thumbnails.
+    @param var_file: fits file containing variability and sources data
+    @param outputs: List of (output file, sources plotted or not)
+    @param maximum_value: The maximal value for the logarithmic scale, the
+                          maximum of the data if None
+    @param dpi: The resolution of the PDF figures
+    @param thumbnail_size: The maximal side of the thumbnails in pixels
+    """
+    product = VariabilityProduct(var_file)
 
-    for i in range(len(var_files)) :
+    if maximum_value == None :
+        maximum_value = np.nanmax(product.data)
+
+    thumbnails = [(f, src) for f, src in outputs if f.endswith('.png')]
+    figures = sorted([(f, src) for f, src in outputs
+            if not f.endswith('.png')], key=lambda output : output[1])
+
+    for output_file, sources in thumbnails :
+        variability_thumbnail(product, output_file, sources, maximum_value,
+                thumbnail_size)
+
+    if len(figures) == 0 :
+        return
+
+    fig, ax = variability_figure(product, maximum_value)
+    try :
+        plotted = False
+        for output_file, sources in figures :
+            # Plotting the sources
+            if sources and not plotted and len(product.sources) != 0 :
+                ax.plot(product.sources['X'], product.sources['Y'], 'wo',
+                        alpha = 1, fillstyle='none')
+                plotted = True
+            fig.savefig(output_file, pad_inches=0, bbox_inches='tight',
+                    dpi=dpi)
+    finally :
+        plt.close(fig)
 
-        hdulist = fits.open(var_files[i])
+########################################################################
 
-        data   = hdulist[0].data
-        src    = hdulist[1].data
-        header = hdulist[0].header
+def _render_task(task) :
+    """
+    Function rendering the outputs of a variability file in a worker.
+    @param task: The arguments of render_products
+    @return: The variability file, and the error message if it failed
+    """
+    try :
+        render_products(*task)
+    except Exception as e :
+        return task[0], '{0}: {1}'.format(type(e).__name__, e)
 
-        hdulist.close()
+    return task[0], None
 
-        # Obtaining the WCS transformation parameters
+########################################################################
 
-        w = wcs.WCS(header)
+def render_pool(tasks, n_workers=1) :
+    """
+    Function rendering several variability files, in a pool of workers.
+    @param tasks: List of the arguments of render_products
+    @param n_workers: The number of workers, the files being rendered in
+                      this process if 1
+    @return: List of (variability file, error message or None)
+    """
+    n_workers = max(min(n_workers, len(tasks)), 1)
+    if n_workers == 1 :
+        return [_render_task(task) for task in tasks]
 
-        w.wcs.crpix = [header['REFXCRPX'], header['REFYCRPX']]
-        w.wcs.cdelt = [header['REFXCDLT']/15, header['REFYCDLT']]
-        w.wcs.crval = [header['REFXCRVL']/15, header['REFYCRVL']]
-        w.wcs.ctype = [header['REFXCTYP'], header['REFYCTYP']]
-        angle = header['PA_PNT']       # Degrees
+    with Pool(n_workers) as p :
+        return p.map(_render_task, tasks, chunksize=1)
 
-        # Image limit
-        dlim = [header['REFXLMIN'], header['REFXLMAX'], header['REFYLMIN'],
-                header['REFYLMAX']]
+########################################################################
+
+def render_variability(var_file, output_file, sources=True, pars=None,
+        maximum_value=None) :
+    """
+    Function producing output pdf plots from the computed variability.
+    @param var_file: fits file containing variability and sources data
+    @param output_file: The path to the PDF file to be created
+    @param sources: If the detected sources are plotted or not
+    @param pars: observation parameters
+    @param maximum_value: The maximal value for the logarithmic scale
+    """
+    render_products(var_file, [(output_file, sources)], maximum_value)
+
+########################################################################
+
+def iter_products(var_files, n_workers=4, wcs_cache=None) :
+    """
+    Generator loading variability files in a pool of threads, at most
+    2 * n_workers files ahead of the one being used.
+    @param var_files: The variability files, read in order
+    @param n_workers: The number of threads
+    @param wcs_cache: Dictionary of the WCS transformations shared by the
+                      products, a new one if None
+    @return: The variability file, its VariabilityProduct and None, or None
+             and the error message if it could not be read
+    """
+    if wcs_cache == None :
+        wcs_cache = {}
+    files = iter(var_files)
+
+    with ThreadPoolExecutor(max(n_workers, 1)) as executor :
+        pending = deque([(f, executor.submit(VariabilityProduct, f,
+                wcs_cache)) for f in islice(files, 2 * max(n_workers, 1))])
+        while len(pending) != 0 :
+            var_file, future = pending.popleft()
+            for f in islice(files, 1) :
+                pending.append((f, executor.submit(VariabilityProduct, f,
+                        wcs_cache)))
+            try :
+                yield var_file, future.result(), None
+            except Exception as e :
+                yield var_file, None, '{0}: {1}'.format(type(e).__name__, e)
+
+########################################################################
+
+def comparison_figure(products, sources=True, ncols=None) :
+    """
+    Function drawing the variability of several products in a grid, with a
+    common colour scale in units of their detection level.
+    @param products: The VariabilityProducts
+    @param sources: If the detected sources are plotted or not
+    @param ncols: The number of columns of the grid, chosen to make it
+                  square if None
+    @return: The figure
+    """
+    n = len(products)
+    if ncols == None :
+        ncols = int(ceil(sqrt(n)))
+    nrows = int(ceil(n / ncols))
+
+    fig = plt.figure(figsize=(4.75 * ncols, 4 * nrows))
+    gs1 = gridspec.GridSpec(nrows, ncols, wspace=0.05, hspace=0.05)
+
+    for i, product in enumerate(products) :
+        header = product.header
 
         # Plotting the variability data
-        plt.subplot(gs1[i], projection=w)
-        ax = plt.gca()
-        im = plt.imshow(data/header['DL'], cmap=cm.inferno,
-                norm=colors.LogNorm(vmin=0.1, vmax=1.0), extent=dlim)
+        ax = fig.add_subplot(gs1[i], projection=product.wcs)
+        im = ax.imshow(product.data/header['DL'], cmap=cm.inferno,
+                norm=colors.LogNorm(vmin=0.1, vmax=1.0), extent=product.limits)
 
         # Plotting the sources
-        if sources :
-            if len(src) != 0 :
-                # Position of the sources
-                plt.plot(src['X'], src['Y'], 'wo', alpha = 1, fillstyle='none')
+        if sources and len(product.sources) != 0 :
+            ax.plot(product.sources['X'], product.sources['Y'], 'wo',
+                    alpha = 1, fillstyle='none')
 
-        plt.text(0.5, 0.92, "TW {0} s    DL {1}   BS {2}".format(header['TW'],
+        ax.text(0.5, 0.92, "TW {0} s    DL {1}   BS {2}".format(header['TW'],
                 header['DL'], header['BS']), color='white', fontsize=10,
                 horizontalalignment='center', transform = ax.transAxes)
 
         ra  = ax.coords[0]
         dec = ax.coords[1]
 
-        if i > 1 :
+        # Labels on the bottom panel of each column and on the first column
+        if i + ncols >= n :
             ra.set_axislabel('RA', fontsize=12)
-        if i % 2 == 0 :
-            dec.set_axislabel('DEC', fontsize=12)
-        if i < 2 :
+        else :
             ra.set_ticklabel_visible(False)
-        if i % 2 != 0 :
+        if i % ncols == 0 :
+            dec.set_axislabel('DEC', fontsize=12)
+        else :
             dec.set_ticklabel_visible(False)
 
         ra.display_minor_ticks(True)
@@ -199,12 +378,101 @@ def render_variability_all(var_file0, var_file1, var_file2, var_file3,
     fig.subplots_adjust(right=0.77)
     cbar_ax = fig.add_axes([0.8, 0.11, 0.02, 0.77])
     cbar    = fig.colorbar(im, cax=cbar_ax)
-    cbar.ax.set_ylabel('$\mathcal{V}$ / DL', fontsize=12)
-    fig.suptitle('OBS {0}'.format(header['OBS_ID']), x=0.5, y = 0.93,
-            fontsize=18)
+    cbar.ax.set_ylabel(r'$\mathcal{V}$ / DL', fontsize=12)
+    fig.suptitle('OBS {0}'.format(products[0].header['OBS_ID']), x=0.5,
+            y = 0.93, fontsize=18)
 
-    plt.savefig(output_file, pad_inches=0, dpi=500, bbox_inches='tight')
+    return fig
 
+########################################################################
+
+def render_comparison(var_files, output_file, sources=True, n_workers=4,
+        dpi=500, ncols=None) :
+    """
+    Function producing the comparison figure of several variability files of
+    an observation, computed with different parameters.
+    @param var_files: The variability files
+    @param output_file: The path to the figure
+    @param sources: If the detected sources are plotted or not
+    @param n_workers: The number of threads reading the files
+    @param dpi: The resolution of the figure
+    @param ncols: The number of columns of the grid, automatic if None
+    """
+    products = []
+    for var_file, product, error in iter_products(var_files, n_workers) :
+        if error != None :
+            print(" Impossible to read {0}: {1}".format(var_file, error))
+        else :
+            products.append(product)
+    if len(products) == 0 :
+        raise ValueError("No variability file to render")
+
+    fig = comparison_figure(products, sources, ncols)
+    try :
+        fig.savefig(output_file, pad_inches=0, dpi=dpi, bbox_inches='tight')
+    finally :
+        plt.close(fig)
+
+########################################################################
+
+def render_pages(groups, output_file, sources=True, n_workers=4, dpi=500,
+        maximum_value=10) :
+    """
+    Function writing one page per group of variability files to a multi-page
+    PDF file. The files are read in a pool of threads ahead of the page being
+    drawn, and each page is closed once written, so that the memory does not
+    grow with the number of pages. A group of one file gives the figure of
+    render_variability, a larger group the comparison figure.
+    @param groups: List of lists of variability files
+    @param output_file: The path to the PDF file
+    @param sources: If the detected sources are plotted or not
+    @param n_workers: The number of threads reading the files
+    @param dpi: The resolution of the pages
+    @param maximum_value: The maximal value for the logarithmic scale of the
+                          single file pages
+    @return: The number of pages written
+    """
+    products = iter_products([f for group in groups for f in group],
+            n_workers)
+    n_pages = 0
+
+    with PdfPages(output_file) as pdf :
+        for group in groups :
+            page = []
+            for var_file, product, error in islice(products, len(group)) :
+                if error != None :
+                    print(" Impossible to read {0}: {1}".format(var_file,
+                            error))
+                else :
+                    page.append(product)
+            if len(page) == 0 :
+                continue
+
+            if len(group) == 1 :
+                fig, ax = variability_figure(page[0], maximum_value)
+                if sources and len(page[0].sources) != 0 :
+                    ax.plot(page[0].sources['X'], page[0].sources['Y'], 'wo',
+                            alpha = 1, fillstyle='none')
+            else :
+                fig = comparison_figure(page, sources)
+
+            try :
+                pdf.savefig(fig, pad_inches=0, dpi=dpi, bbox_inches='tight')
+            finally :
+                plt.close(fig)
+            n_pages += 1
+
+    return n_pages
+
+########################################################################
+
+def render_variability_all(var_file0, var_file1, var_file2, var_file3,
+        output_file, sources=True, pars=None, maximum_value=10) :
+    """
+    Function producing the comparison figure of four variability files.
+    """
+    render_comparison([var_file0, var_file1, var_file2, var_file3],
+            output_file, sources, ncols=2)
 
 ########################################################################
 
@@ -217,3 +485,51 @@ def ds9_renderer(var_file, reg_file) :
     command = "ds9 {0} -scale linear -cmap bb -mode region -regionfile {1}".format(
             var_file, reg_file)
     process = subprocess.Popen(command.split(), stdout=subprocess.PIPE)
+
+########################################################################
+#                                                                      #
+# Main programme                                                       #
+#                                                                      #
+########################################################################
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Renders variability files "
+            "in a pool of workers. The figures are written next to each file")
+    parser.add_argument("-files", help="Variability files", nargs='+',
+            type=str)
+    parser.add_argument("-mta", "--max-threads-allowed", dest="mta",
+            help="Number of workers.\nDefault: 1", default=1, type=int)
+    parser.add_argument("-pdf", "--pdf", help="Write the PDF figures, with "
+            "and without sources", action='store_true')
+    parser.add_argument("-thumbnail", "--thumbnail", help="Write the PNG "
+            "thumbnails", action='store_true')
+    parser.add_argument("-max", "--maximum-value", dest="maximum_value",
+            help="Maximal value of the colour scale.\nDefault: 10",
+            default=10.0, type=float)
+    args = parser.parse_args()
+
+    if not (args.pdf or args.thumbnail) :
+        args.pdf = True
+
+    tasks = []
+    for var_file in args.files :
+        folder = os.path.dirname(os.path.abspath(var_file)) + '/'
+        outputs = []
+        if args.pdf :
+            outputs += [(folder + FileNames.OUTPUT_IMAGE, False),
+                        (folder + FileNames.OUTPUT_IMAGE_SRCS, True)]
+        if args.thumbnail :
+            outputs.append((folder + FileNames.OUTPUT_THUMBNAIL, True))
+        tasks.append((var_file, outputs, args.maximum_value))
+
+    failed = 0
+    for var_file, error in render_pool(tasks, args.mta) :
+        if error != None :
+            print(" Impossible to render {0}: {1}".format(var_file, error),
+                    file=sys.stderr)
+            failed += 1
+
+    sys.exit(1 if failed != 0 else 0)
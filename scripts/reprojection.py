@@ -0,0 +1,169 @@
+# coding=utf-8
+
+########################################################################
+#                                                                      #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                          #
+#                                                                      #
+# Reprojection of the CCD mosaic to the sky image                      #
+#                                                                      #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com       #
+#                                                                      #
+########################################################################
+"""
+Reprojection of the CCD mosaic to the 648 x 648 sky image. The rotation by
+the position angle, the flip, the resizing to the projected limits and the
+padding are folded into one sparse resampling matrix, computed once per
+geometry and applied to each map in one pass.
+"""
+
+# Third-party imports
+
+import numpy as np
+import scipy.sparse
+from scipy.special import cosdg, sindg
+
+# Size of the sky image
+IMAGE_SIZE = 648
+
+# Reprojections already computed, by geometry
+_reprojections = {}
+
+########################################################################
+
+
+def transformation_geometry(header) :
+    """
+    Function reading the geometry of the transformation from the header of
+    the events file.
+    @param header: The header of the clean events file
+    @return: The position angle
+    @return: The padding of the y and x axes, before and after the image
+    @return: The shape of the rotated mosaic once resized, (pixY, pixX)
+    """
+    angle = float(header['PA_PNT'])
+
+    xproj = [float(header['TDMIN6']), float(header['TDMAX6'])] # projected x
+    yproj = [float(header['TDMIN7']), float(header['TDMAX7'])] # projected y
+    xlims = [float(header['TLMIN6']), float(header['TLMAX6'])] # legal x
+    ylims = [float(header['TLMIN7']), float(header['TLMAX7'])] # legal y
+
+    # Scaling factor
+    sx = IMAGE_SIZE / (xlims[1] - xlims[0])
+    sy = IMAGE_SIZE / (ylims[1] - ylims[0])
+    # Padding
+    padX = (int((xproj[0] - xlims[0])*sx), int((xlims[1] - xproj[1])*sx))
+    padY = (int((yproj[0] - ylims[0])*sy), int((ylims[1] - yproj[1])*sy))
+    # Shape of the resized image
+    pixX = IMAGE_SIZE - (padX[0] + padX[1])
+    pixY = IMAGE_SIZE - (padY[0] + padY[1])
+
+    return angle, padY, padX, (pixY, pixX)
+
+########################################################################
+
+
+class Reprojection(object):
+    """
+    Resampling of a mosaic to the sky image.\n
+
+    Attributes:\n
+    in_shape:   The shape of the mosaic\n
+    out_shape:  The shape of the sky image\n
+    matrix:     The sparse matrix giving the flattened sky image from the
+                flattened mosaic
+    """
+
+    def __init__(self, angle, padY, padX, shape, in_shape):
+        """
+        Constructor for Reprojection class.
+        @param angle: The rotation angle in degrees
+        @param padY: The padding of the y axis, before and after the image
+        @param padX: The padding of the x axis, before and after the image
+        @param shape: The shape of the rotated mosaic once resized
+        @param in_shape: The shape of the mosaic
+        """
+        super(Reprojection, self).__init__()
+
+        self.in_shape  = tuple(in_shape)
+        self.out_shape = (padY[0] + shape[0] + padY[1],
+                padX[0] + shape[1] + padX[1])
+
+        # Rotation as in scipy.ndimage.rotate with reshape=True
+        c, s = cosdg(angle), sindg(angle)
+        rot_matrix = np.array([[c, s], [-s, c]])
+        iy, ix = self.in_shape
+        bounds = rot_matrix @ [[0, 0, iy, iy], [0, ix, 0, ix]]
+        rot_shape = (np.ptp(bounds, axis=1) + 0.5).astype(int)
+
+        # Scale between the rotated mosaic and the resized image, and
+        # subsamples per pixel so that no pixel of the mosaic is skipped
+        zoom = rot_shape / np.asarray(shape)
+        n_sub = max(int(np.ceil(zoom.max())), 1)
+        sub = (np.arange(n_sub) + 0.5) / n_sub
+
+        # Subsample positions in the rotated mosaic
+        y = ((np.arange(shape[0])[:, None] + sub).ravel() * zoom[0]) - 0.5
+        x = ((np.arange(shape[1])[:, None] + sub).ravel() * zoom[1]) - 0.5
+        y = rot_shape[0] - 1 - y
+        y = y - (rot_shape[0] - 1) / 2
+        x = x - (rot_shape[1] - 1) / 2
+
+        # Positions in the mosaic
+        y, x = np.meshgrid(y, x, indexing='ij')
+        src_y = rot_matrix[0, 0] * y + rot_matrix[0, 1] * x + (iy - 1) / 2
+        src_x = rot_matrix[1, 0] * y + rot_matrix[1, 1] * x + (ix - 1) / 2
+
+        # Sky image pixel of each subsample
+        rows = (np.arange(shape[0]).repeat(n_sub) + padY[0])[:, None] * \
+                self.out_shape[1] + (np.arange(shape[1]).repeat(n_sub) +
+                padX[0])
+
+        # Bilinear weights of the four neighbours, zero outside the mosaic
+        y0, x0 = np.floor(src_y), np.floor(src_x)
+        wy, wx = src_y - y0, src_x - x0
+        y0, x0 = y0.astype(np.int64), x0.astype(np.int64)
+
+        entries = []
+        for dy, dx, w in ((0, 0, (1 - wy) * (1 - wx)), (0, 1, (1 - wy) * wx),
+                (1, 0, wy * (1 - wx)), (1, 1, wy * wx)) :
+            yy, xx = y0 + dy, x0 + dx
+            cdt = (yy >= 0) & (yy < iy) & (xx >= 0) & (xx < ix) & (w > 0)
+            entries.append((rows[cdt], yy[cdt] * ix + xx[cdt],
+                    w[cdt] / n_sub**2))
+
+        rows, cols, weights = [np.concatenate(e) for e in zip(*entries)]
+        self.matrix = scipy.sparse.csr_matrix((weights, (rows, cols)),
+                shape=(self.out_shape[0] * self.out_shape[1], iy * ix))
+
+
+    def __call__(self, data) :
+        """
+        Reprojects a mosaic.
+        @param data: The mosaic, of shape in_shape
+        @return: The sky image
+        """
+        data = np.asarray(data, dtype=np.float64)
+        if data.shape != self.in_shape :
+            raise ValueError("Mosaic of shape {0} instead of {1}".format(
+                    data.shape, self.in_shape))
+
+        return (self.matrix @ data.ravel()).reshape(self.out_shape)
+
+########################################################################
+
+
+def reprojection(header, in_shape) :
+    """
+    Function returning the reprojection of a mosaic for the geometry of an
+    observation, computing it the first time only.
+    @param header: The header of the clean events file
+    @param in_shape: The shape of the mosaic
+    @return: The Reprojection
+    """
+    angle, padY, padX, shape = transformation_geometry(header)
+    key = (angle, padY, padX, shape, tuple(in_shape))
+
+    if key not in _reprojections :
+        _reprojections[key] = Reprojection(angle, padY, padX, shape, in_shape)
+
+    return _reprojections[key]
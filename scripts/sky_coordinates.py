@@ -0,0 +1,304 @@
+# coding=utf-8
+
+########################################################################
+#                                                                      #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                          #
+#                                                                      #
+# Conversion from raw CCD coordinates to sky coordinates               #
+#                                                                      #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com       #
+#                                                                      #
+########################################################################
+"""
+Batched conversion of raw CCD coordinates into sky pixel and equatorial
+coordinates. The raw-to-sky transformation of each CCD is fitted once per
+observation from a single edet2sky invocation and cached to disk.
+"""
+
+# Built-in imports
+
+import os
+import subprocess
+
+# Third-party imports
+
+import numpy as np
+from astropy import wcs
+from astropy.io import fits
+
+# Internal imports
+
+import file_names as FileNames
+
+# Command replacing the SAS task edet2sky, e.g. "python3 edet2sky_stub.py".
+# When it is set, the HEADAS and SAS initialisation scripts are not sourced.
+EDET2SKY_STUB = os.environ.get('EXOD_EDET2SKY')
+
+# Raw positions used to fit the transformation of each CCD
+REF_RAWX = np.array([1.0, 64.0,  1.0,  64.0,  32.5])
+REF_RAWY = np.array([1.0,  1.0, 200.0, 200.0, 100.5])
+
+# In-memory cache of the transformations, keyed by transformation file
+_transforms = {}
+
+########################################################################
+#                                                                      #
+# edet2sky                                                             #
+#                                                                      #
+########################################################################
+
+
+def edet2sky_command(path, img, rawx, rawy, ccd) :
+    """
+    Function writing the command converting a list of raw positions.
+    @param path: Path to the observation folder
+    @param img: Image file used as calibration information set
+    @param rawx: List of raw x coordinates
+    @param rawy: List of raw y coordinates
+    @param ccd: List of CCD numbers, starting at 1
+    @return: The shell command
+    """
+    x_list = ' '.join('{0}'.format(x) for x in rawx)
+    y_list = ' '.join('{0}'.format(y) for y in rawy)
+    c_list = ' '.join('{0}'.format(int(c)) for c in ccd)
+    arguments = f"datastyle=user inputunit=raw X='{x_list}' Y='{y_list}' " \
+                f"ccd='{c_list}' calinfoset={img} -V 0"
+
+    if EDET2SKY_STUB :
+        return f"{EDET2SKY_STUB} {arguments}"
+
+    return f"""
+    export SAS_ODF={path};
+    export SAS_CCF={path}ccf.cif;
+    export HEADAS={FileNames.HEADAS};
+    . $HEADAS/headas-init.sh;
+    . {FileNames.SAS};
+    edet2sky {arguments}
+    """
+
+########################################################################
+
+
+def parse_edet2sky(lines, n) :
+    """
+    Function reading the sky and equatorial coordinates from edet2sky output.
+    @param lines: Output lines of edet2sky
+    @param n: Number of converted positions
+    @return: x, y, ra, dec arrays
+    """
+    blocks = {'# Sky X        Y pixel' : [], '# RA (deg)   DEC (deg)' : []}
+    current = None
+
+    for line in lines :
+        line = line.rstrip('\n')
+        if line in blocks :
+            current = blocks[line]
+        elif current is not None and len(current) < n :
+            toks = line.split()
+            if len(toks) == 2 and not line.startswith('#') :
+                current.append([float(tok) for tok in toks])
+            else :
+                current = None
+
+    sky   = np.array(blocks['# Sky X        Y pixel'])
+    radec = np.array(blocks['# RA (deg)   DEC (deg)'])
+    if len(sky) != n or len(radec) != n :
+        raise ValueError("edet2sky returned {0} positions instead of {1}"
+                .format(min(len(sky), len(radec)), n))
+
+    return sky[:,0], sky[:,1], radec[:,0], radec[:,1]
+
+########################################################################
+
+
+def edet2sky(path, img, rawx, rawy, ccd, log_f=None) :
+    """
+    Function converting a list of raw positions with a single edet2sky call.
+    @param path: Path to the observation folder
+    @param img: Image file used as calibration information set
+    @param rawx: List of raw x coordinates
+    @param rawy: List of raw y coordinates
+    @param ccd: List of CCD numbers, starting at 1
+    @param log_f: Log file where the output is written
+    @return: x, y, ra, dec arrays
+    """
+    command = edet2sky_command(path, img, rawx, rawy, ccd)
+    process = subprocess.run(command, shell=True, stdout=subprocess.PIPE,
+            universal_newlines=True)
+    lines = process.stdout.splitlines()
+
+    if log_f :
+        log_f.write(" * edet2sky {0} positions * \n".format(len(rawx)))
+        log_f.write(process.stdout)
+
+    return parse_edet2sky(lines, len(rawx))
+
+########################################################################
+#                                                                      #
+# Transformation                                                       #
+#                                                                      #
+########################################################################
+
+
+class SkyTransform(object):
+    """
+    Datastructure holding the raw-to-sky transformation of an observation.\n
+
+    Attributes:\n
+    affine:  Affine transformation of each CCD, of shape (12, 2, 3), giving
+             the sky (X, Y) from (RAWX, RAWY, 1)\n
+    w:       WCS transformation from sky pixels to equatorial coordinates\n
+    source:  Name and modification time of the image used to compute it
+    """
+
+    def __init__(self, affine, header, source=''):
+        """
+        Constructor for SkyTransform class.
+        @param affine: Affine transformation of each CCD, shape (12, 2, 3)
+        @param header: Header containing the REFX/REFY WCS keywords
+        @param source: Name and modification time of the image
+        """
+        super(SkyTransform, self).__init__()
+
+        self.affine = np.asarray(affine, dtype=np.float64)
+        self.source = source
+        self.wcs_keys = {key : header[key] for key in ('REFXCRPX', 'REFYCRPX',
+                'REFXCDLT', 'REFYCDLT', 'REFXCRVL', 'REFYCRVL', 'REFXCTYP',
+                'REFYCTYP')}
+
+        self.w = wcs.WCS(naxis=2)
+        self.w.wcs.crpix = [header['REFXCRPX'], header['REFYCRPX']]
+        self.w.wcs.cdelt = [header['REFXCDLT'], header['REFYCDLT']]
+        self.w.wcs.crval = [header['REFXCRVL'], header['REFYCRVL']]
+        self.w.wcs.ctype = [header['REFXCTYP'], header['REFYCTYP']]
+
+
+    @classmethod
+    def from_edet2sky(cls, path, img, log_f=None) :
+        """
+        Fits the transformation of each CCD to the positions returned by a
+        single edet2sky call on reference raw positions.
+        """
+        n_ref = len(REF_RAWX)
+        rawx = np.tile(REF_RAWX, 12)
+        rawy = np.tile(REF_RAWY, 12)
+        ccd  = np.repeat(np.arange(1, 13), n_ref)
+
+        x, y, ra, dec = edet2sky(path, img, rawx, rawy, ccd, log_f)
+
+        affine = np.zeros((12, 2, 3))
+        for c in range(12) :
+            k = slice(c * n_ref, (c + 1) * n_ref)
+            a = np.column_stack((rawx[k], rawy[k], np.ones(n_ref)))
+            coeffs = np.linalg.lstsq(a, np.column_stack((x[k], y[k])),
+                    rcond=None)[0]
+            affine[c] = coeffs.T
+
+        return cls(affine, fits.getheader(img), image_signature(img))
+
+
+    @classmethod
+    def load(cls, file) :
+        """
+        Reads the transformation from its file.
+        """
+        with np.load(file) as data :
+            header = {key : data[key].item() for key in data.files
+                    if key.startswith('REF')}
+            return cls(data['affine'], header, str(data['source']))
+
+
+    def save(self, file) :
+        """
+        Writes the transformation to its file.
+        """
+        tmp_file = file + '.{0}.tmp'.format(os.getpid())
+        with open(tmp_file, 'wb') as f :
+            np.savez(f, affine=self.affine, source=self.source,
+                    **self.wcs_keys)
+        os.replace(tmp_file, file)
+
+
+    def raw_to_sky(self, ccd, rawx, rawy) :
+        """
+        Converts raw positions into sky pixel positions.
+        @param ccd: CCD numbers, starting at 1
+        @return: x, y arrays
+        """
+        a = self.affine[np.asarray(ccd, dtype=int) - 1]
+        rawx = np.asarray(rawx, dtype=np.float64)
+        rawy = np.asarray(rawy, dtype=np.float64)
+        x = a[...,0,0] * rawx + a[...,0,1] * rawy + a[...,0,2]
+        y = a[...,1,0] * rawx + a[...,1,1] * rawy + a[...,1,2]
+
+        return x, y
+
+
+    def sky_to_radec(self, x, y) :
+        """
+        Converts sky pixel positions into equatorial coordinates in degrees.
+        @return: ra, dec arrays
+        """
+        if len(np.atleast_1d(x)) == 0 :
+            return np.zeros(0), np.zeros(0)
+
+        return self.w.wcs_pix2world(x, y, 1)
+
+########################################################################
+
+
+def image_signature(img) :
+    """
+    Returns the name and modification time of an image, used to check that a
+    cached transformation was computed from it.
+    """
+    return '{0} {1}'.format(os.path.abspath(img), os.path.getmtime(img))
+
+########################################################################
+
+
+def sky_transform(path, img, log_f=None) :
+    """
+    Function returning the raw-to-sky transformation of an observation,
+    computing it only if it has not been cached for the same image.
+    @param path: Path to the observation folder
+    @param img: Image file used as calibration information set
+    @param log_f: Log file
+    @return: SkyTransform object
+    """
+    file = path + FileNames.SKY_TRANSFORM
+    signature = image_signature(img)
+
+    transform = _transforms.get(file)
+    if transform is None and os.path.isfile(file) :
+        try :
+            transform = SkyTransform.load(file)
+        except Exception as e :
+            transform = None
+    if transform is None or transform.source != signature :
+        transform = SkyTransform.from_edet2sky(path, img, log_f)
+        transform.save(file)
+
+    _transforms[file] = transform
+
+    return transform
+
+########################################################################
+
+
+def raw_to_radec(path, img, ccd, rawx, rawy, log_f=None) :
+    """
+    Function converting raw positions into sky and equatorial coordinates.
+    @param path: Path to the observation folder
+    @param img: Image file used as calibration information set
+    @param ccd: CCD numbers, starting at 1
+    @param rawx: Raw x coordinates
+    @param rawy: Raw y coordinates
+    @param log_f: Log file
+    @return: x, y, ra, dec arrays
+    """
+    transform = sky_transform(path, img, log_f)
+    x, y = transform.raw_to_sky(ccd, rawx, rawy)
+    ra, dec = transform.sky_to_radec(x, y)
+
+    return x, y, ra, dec
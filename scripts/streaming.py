@@ -0,0 +1,228 @@
+# coding=utf-8
+
+########################################################################
+#                                                                      #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                          #
+#                                                                      #
+# Bounded-memory variability computation                               #
+#                                                                      #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com       #
+#                                                                      #
+########################################################################
+"""
+Variability computation for event lists that do not fit into memory. The
+events file is read in chunks of rows, the raw counts of each pixel and time
+window are accumulated into an integer cube, kept in memory or spilled to a
+file on disk above the memory limit, and the variability is computed by
+blocks of pixel rows. The time windows start at the TSTART instant of the
+header, and the results are the same as with variability_sweep over the
+TSTART to TSTOP range.
+"""
+
+# Built-in imports
+
+import os
+import shutil
+import tempfile
+
+# Third-party imports
+
+from astropy.io import fits
+import numpy as np
+
+# Internal imports
+
+from variability_utils import neighbourhood_sum, rebin_counts, sweep_plan, \
+        projection_ratios, variability_from_counts
+
+# Bytes needed to process an event of a chunk
+EVENT_BYTES = 64
+
+########################################################################
+
+
+def event_chunks(events_file, chunk_rows) :
+    """
+    Generator reading the events of the 12 EPIC-pn CCDs by chunks of rows.
+    @param events_file: The events FITS file
+    @param chunk_rows: The number of rows of a chunk
+    @return: The TIME, RAWX, RAWY and CCDNR columns of each chunk
+    """
+    with fits.open(events_file, memmap=True) as hdulist :
+        events = hdulist[1].data
+        for i in range(0, len(events), chunk_rows) :
+            chunk = events[i:i + chunk_rows]
+            time  = np.asarray(chunk['TIME'], dtype=np.float64)
+            rawx  = np.asarray(chunk['RAWX'], dtype=np.int64)
+            rawy  = np.asarray(chunk['RAWY'], dtype=np.int64)
+            ccdnr = np.asarray(chunk['CCDNR'], dtype=np.int64)
+            del chunk
+
+            cdt = (ccdnr >= 1) & (ccdnr <= 12)
+            yield time[cdt], rawx[cdt], rawy[cdt], ccdnr[cdt]
+
+########################################################################
+
+
+def time_range(events_file, chunk_rows) :
+    """
+    Function reading the t0 and tf instants of an events file, from the
+    TSTART and TSTOP keywords of its header, or from the events read by
+    chunks if the keywords are missing.
+    @return: The t0 and tf instants, None if there are no events
+    """
+    header = fits.getheader(events_file, 1)
+    if 'TSTART' in header and 'TSTOP' in header :
+        return float(header['TSTART']), float(header['TSTOP'])
+
+    t0, tf = None, None
+    for time, rawx, rawy, ccdnr in event_chunks(events_file, chunk_rows) :
+        if len(time) != 0 :
+            t0 = time.min() if t0 == None else min(t0, time.min())
+            tf = time.max() if tf == None else max(tf, time.max())
+
+    return t0, tf
+
+########################################################################
+
+
+class CountsAccumulator(object):
+    """
+    Raw counts of the 12 CCDs on a padded (66, 202) grid, accumulated chunk
+    by chunk.\n
+
+    Attributes:\n
+    time_windows:   The start time of each time window\n
+    time_interval:  The duration of a time window\n
+    cube:           The counts, of shape (12, 66, 202, n_bins), in memory or
+                    mapped to a file
+    """
+
+    def __init__(self, time_windows, time_interval, in_memory, folder):
+        """
+        Constructor for CountsAccumulator class.
+        @param time_windows: The start time of each time window
+        @param time_interval: The duration of a time window
+        @param in_memory: If False, the cube is mapped to a file
+        @param folder: The folder of the mapped file
+        """
+        super(CountsAccumulator, self).__init__()
+
+        self.time_windows  = np.asarray(time_windows)
+        self.time_interval = time_interval
+        shape = (12, 66, 202, len(self.time_windows))
+
+        if in_memory :
+            self.cube = np.zeros(shape, dtype=np.int32)
+        else :
+            handle, file = tempfile.mkstemp(suffix='.counts', dir=folder)
+            os.close(handle)
+            self.cube = np.memmap(file, dtype=np.int32, mode='w+',
+                    shape=shape)
+
+
+    def add(self, time, rawx, rawy, ccdnr) :
+        """
+        Adds a chunk of events to the counts.
+        """
+        n_bins = len(self.time_windows)
+        n = np.searchsorted(self.time_windows + self.time_interval, time,
+                side='left')
+
+        # Same selection as count_columns
+        cdt = (n < n_bins) & (0 <= rawx) & (rawx < 66) & (0 <= rawy) & \
+                (rawy < 202)
+        flat = (((ccdnr[cdt] - 1) * 66 + rawx[cdt]) * 202 + rawy[cdt]) * \
+                n_bins + n[cdt]
+
+        index, counts = np.unique(flat, return_counts=True)
+        self.cube.reshape(-1)[index] += counts.astype(np.int32)
+
+########################################################################
+
+
+def variability_by_rows(cube, factor, n_bins, projection_ratio,
+        acceptable_ratio, block_rows) :
+    """
+    Function computing the variability of a CCD from its padded raw counts,
+    by blocks of pixel rows.
+    @param cube: The padded raw counts of the CCD, of shape (66, 202, n_fine)
+    @param factor: The number of counted windows in a time window
+    @param n_bins: The number of time windows
+    @param projection_ratio: The projection ratio of each time window
+    @param acceptable_ratio: The acceptability ratio for a TW - good time ratio
+    @param block_rows: The number of pixel rows of a block
+    @return: The matrix V_round, of shape (64, 200)
+    """
+    V_mat = np.ones((64, 200))
+    for row in range(0, 64, block_rows) :
+        end = min(row + block_rows, 64)
+        counts = neighbourhood_sum(np.asarray(cube[row:end + 2],
+                dtype=np.int64))
+        counts = rebin_counts(counts, factor, n_bins)
+        V_mat[row:end] = variability_from_counts(counts, projection_ratio,
+                acceptable_ratio)
+
+    return V_mat
+
+########################################################################
+
+
+def streaming_variability(events_file, gti, time_intervals, acceptable_ratio,
+        memory_limit, spill_folder=None) :
+    """
+    Function computing the variability of the 12 CCDs for several time
+    windows within a memory limit, reading the events by chunks.
+    @param events_file: The events FITS file
+    @param gti: G round, the list of TW cut-off the observation
+    @param time_intervals: The list of durations of the time windows
+    @param acceptable_ratio: The acceptability ratio for a TW - good time ratio
+    @param memory_limit: The memory available, in bytes
+    @param spill_folder: The folder of the counts cubes exceeding the limit
+    @return: The V round matrices of each CCD, one list per time window
+    """
+    chunk_rows = max(int(memory_limit / 8 / EVENT_BYTES), 2**14)
+
+    start_time, end_time = time_range(events_file, chunk_rows)
+    if start_time == None :
+        raise ValueError("No events in {0}".format(events_file))
+
+    counted, grids, sources = sweep_plan(time_intervals, acceptable_ratio,
+            start_time, end_time)
+
+    folder = tempfile.mkdtemp(prefix='exod_', dir=spill_folder)
+    try :
+        accumulators = []
+        budget = memory_limit / 2
+        for windows, tw in counted :
+            size = 12 * 66 * 202 * len(windows) * 4
+            accumulators.append(CountsAccumulator(windows, tw, size <= budget,
+                    folder))
+            if size <= budget :
+                budget -= size
+
+        for chunk in event_chunks(events_file, chunk_rows) :
+            for acc in accumulators :
+                acc.add(*chunk)
+
+        v_matrices = []
+        for k, tw in enumerate(time_intervals) :
+            acc, factor = accumulators[sources[k][0]], sources[k][1]
+            n_bins = len(grids[k])
+            projection_ratio = projection_ratios(gti, grids[k], tw)
+
+            # Rows such that the blocks of the computation fit into the limit
+            row_bytes = 202 * len(acc.time_windows) * 8 * 4
+            block_rows = int(min(max(memory_limit / 4 / row_bytes - 2, 1), 64))
+
+            v_matrices.append([variability_by_rows(acc.cube[ccd], factor,
+                    n_bins, projection_ratio, acceptable_ratio, block_rows)
+                    for ccd in range(12)])
+
+        for acc in accumulators :
+            acc.cube = None
+
+    finally :
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return v_matrices
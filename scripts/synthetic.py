@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+########################################################################
+#                                                                      #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                          #
+#                                                                      #
+# Synthetic observations                                               #
+#                                                                      #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com       #
+#                                                                      #
+########################################################################
+"""
+Generator of synthetic EPIC-pn observations: a clean events file with the
+12 CCDs of 64 x 200 raw pixels, a GTI file and an image carrying the WCS
+keywords used by the detector. The background is uniform and constant,
+events are removed during the GTI gaps, and flares are injected as bursts of
+events on a few pixels.
+"""
+
+# Built-in imports
+
+import os
+
+# Third-party imports
+
+from astropy.io import fits
+import numpy as np
+import argparse
+
+# Internal imports
+
+import file_names as FileNames
+from edet2sky_stub import mosaic_position, RAW_PIXEL
+
+# Default pointing, as in the example observation
+POINTING = {'RA' : 195.361708333333, 'DEC' : 27.7594166666667,
+        'PA_PNT' : 130.234176635742}
+
+# Size of the sky pixels of the image, in sky pixels of 0.05 arcsec
+IMAGE_BIN = 80
+
+########################################################################
+#                                                                      #
+# Events                                                               #
+#                                                                      #
+########################################################################
+
+class Flare(object):
+    """
+    Datastructure describing an injected flare.\n
+
+    Attributes:\n
+    ccd:       CCD number, starting at 1\n
+    rawx:      Raw x position of the centre\n
+    rawy:      Raw y position of the centre\n
+    start:     Start of the flare, in seconds from the start of the
+               observation\n
+    duration:  Duration of the flare, in seconds\n
+    counts:    Number of events of the flare\n
+    radius:    Half size of the square of pixels receiving the events
+    """
+
+    def __init__(self, ccd, rawx, rawy, start, duration, counts, radius=1):
+        """
+        Constructor for Flare class.
+        """
+        super(Flare, self).__init__()
+
+        self.ccd      = int(ccd)
+        self.rawx     = int(rawx)
+        self.rawy     = int(rawy)
+        self.start    = float(start)
+        self.duration = float(duration)
+        self.counts   = int(counts)
+        self.radius   = int(radius)
+
+
+    @classmethod
+    def parse(cls, text) :
+        """
+        Reads a flare from 'ccd,rawx,rawy,start,duration,counts[,radius]'.
+        """
+        return cls(*[float(v) for v in text.split(',')])
+
+
+    def events(self, rng, t0) :
+        """
+        Draws the events of the flare.
+        @return: TIME, RAWX, RAWY, CCDNR arrays
+        """
+        n = self.counts
+        time = t0 + self.start + rng.uniform(0, self.duration, n)
+        rawx = np.clip(self.rawx + rng.integers(-self.radius, self.radius + 1,
+                n), 1, 64)
+        rawy = np.clip(self.rawy + rng.integers(-self.radius, self.radius + 1,
+                n), 1, 200)
+
+        return time, rawx, rawy, np.full(n, self.ccd)
+
+########################################################################
+
+
+def good_time_intervals(duration, gaps) :
+    """
+    Function returning the good time intervals of an observation.
+    @param duration: The duration of the observation
+    @param gaps: List of (start, stop) bad time intervals
+    @return: The START and STOP arrays, relative to the start
+    """
+    start = [0.0]
+    stop  = []
+    for gap_start, gap_stop in sorted(gaps) :
+        stop.append(gap_start)
+        start.append(gap_stop)
+    stop.append(duration)
+
+    start = np.array(start)
+    stop  = np.array(stop)
+    keep  = stop > start
+
+    return start[keep], stop[keep]
+
+########################################################################
+
+
+def synthetic_events(duration, rate, gaps=(), flares=(), seed=0, t0=0.0) :
+    """
+    Function drawing the events of a synthetic observation.
+    @param duration: The duration of the observation, in seconds
+    @param rate: The background count rate of the whole detector
+    @param gaps: List of (start, stop) bad time intervals, relative to t0
+    @param flares: List of Flare objects
+    @param seed: The seed of the random generator
+    @param t0: The start time of the observation
+    @return: Record array of TIME, RAWX, RAWY, CCDNR, sorted by TIME
+    """
+    rng = np.random.default_rng(seed)
+
+    n = rng.poisson(rate * duration)
+    columns = [t0 + rng.uniform(0, duration, n), rng.integers(1, 65, n),
+            rng.integers(1, 201, n), rng.integers(1, 13, n)]
+    for flare in flares :
+        columns = [np.concatenate((c, f)) for c, f in zip(columns,
+                flare.events(rng, t0))]
+    time, rawx, rawy, ccdnr = columns
+
+    # Removing the events outside of the GTI
+    start, stop = good_time_intervals(duration, gaps)
+    k = np.searchsorted(start + t0, time, side='right') - 1
+    good = (k >= 0) & (time < stop[np.maximum(k, 0)] + t0)
+
+    events = np.empty(np.sum(good), dtype=[('TIME', 'f8'), ('RAWX', 'i2'),
+            ('RAWY', 'i2'), ('CCDNR', 'u1')])
+    order = np.argsort(time[good], kind='stable')
+    events['TIME']  = time[good][order]
+    events['RAWX']  = rawx[good][order]
+    events['RAWY']  = rawy[good][order]
+    events['CCDNR'] = ccdnr[good][order]
+
+    return events
+
+########################################################################
+#                                                                      #
+# Files                                                                #
+#                                                                      #
+########################################################################
+
+def wcs_keywords(pointing) :
+    """
+    Function returning the REFX/REFY keywords of the sky coordinates.
+    """
+    return {'REFXCTYP' : 'RA---TAN', 'REFXCRPX' : 25921,
+            'REFXCRVL' : pointing['RA'], 'REFXCDLT' : -1.38888888888889E-05,
+            'REFXLMIN' : 1, 'REFXLMAX' : 51840, 'REFXDMIN' : 36765,
+            'REFXDMAX' : 50895, 'REFXCUNI' : 'deg',
+            'REFYCTYP' : 'DEC--TAN', 'REFYCRPX' : 25921,
+            'REFYCRVL' : pointing['DEC'], 'REFYCDLT' : 1.38888888888889E-05,
+            'REFYLMIN' : 1, 'REFYLMAX' : 51840, 'REFYDMIN' : 19856,
+            'REFYDMAX' : 35153, 'REFYCUNI' : 'deg',
+            'PA_PNT' : pointing['PA_PNT']}
+
+########################################################################
+
+
+def sky_positions(events, pointing, rng) :
+    """
+    Function placing the events on the sky, as edet2sky_stub does.
+    @return: X and Y sky pixel arrays
+    """
+    keys  = wcs_keywords(pointing)
+    angle = np.radians(pointing['PA_PNT'])
+    row, col = mosaic_position(events['CCDNR'].astype(int),
+            events['RAWX'] + rng.uniform(-0.5, 0.5, len(events)),
+            events['RAWY'] + rng.uniform(-0.5, 0.5, len(events)))
+    dx = (col - 199.5) * RAW_PIXEL
+    dy = (191.5 - row) * RAW_PIXEL
+    x = keys['REFXCRPX'] + np.cos(angle) * dx - np.sin(angle) * dy
+    y = keys['REFYCRPX'] + np.sin(angle) * dx + np.cos(angle) * dy
+
+    return np.rint(x).astype(np.int32), np.rint(y).astype(np.int32)
+
+########################################################################
+
+
+def write_observation(path, events, duration, gaps, t0=0.0, obs_id='0000000001',
+        pointing=POINTING, seed=0) :
+    """
+    Function writing the events, GTI and image files of an observation.
+    @param path: The observation folder
+    @param events: The events returned by synthetic_events
+    @param duration: The duration of the observation
+    @param gaps: List of (start, stop) bad time intervals, relative to t0
+    @param t0: The start time of the observation
+    @param obs_id: The observation ID
+    @param pointing: Dictionary of the RA, DEC and PA_PNT of the pointing
+    """
+    if path[-1] != '/' :
+        path += '/'
+    os.makedirs(path, exist_ok=True)
+    rng  = np.random.default_rng(seed + 1)
+    keys = wcs_keywords(pointing)
+    x, y = sky_positions(events, pointing, rng)
+
+    # Events, with X and Y as columns 6 and 7 as in the pipeline products
+    n = len(events)
+    columns = [
+        fits.Column('TIME', 'D', array=events['TIME']),
+        fits.Column('RAWX', 'I', array=events['RAWX']),
+        fits.Column('RAWY', 'I', array=events['RAWY']),
+        fits.Column('DETX', 'I', array=np.zeros(n, dtype=np.int16)),
+        fits.Column('DETY', 'I', array=np.zeros(n, dtype=np.int16)),
+        fits.Column('X', 'J', array=x),
+        fits.Column('Y', 'J', array=y),
+        fits.Column('PI', 'I', array=rng.integers(500, 12000, n)),
+        fits.Column('PATTERN', 'B', array=rng.integers(0, 5, n)),
+        fits.Column('CCDNR', 'B', array=events['CCDNR'])]
+    hdu = fits.BinTableHDU.from_columns(columns, name='EVENTS')
+    for key, value in keys.items() :
+        hdu.header[key] = value
+    hdu.header['OBS_ID'] = obs_id
+    hdu.header['TSTART'] = t0
+    hdu.header['TSTOP']  = t0 + duration
+    for col, axis in ((6, 'X'), (7, 'Y')) :
+        hdu.header['TLMIN{0}'.format(col)] = keys['REF{0}LMIN'.format(axis)]
+        hdu.header['TLMAX{0}'.format(col)] = keys['REF{0}LMAX'.format(axis)]
+        hdu.header['TDMIN{0}'.format(col)] = keys['REF{0}DMIN'.format(axis)]
+        hdu.header['TDMAX{0}'.format(col)] = keys['REF{0}DMAX'.format(axis)]
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path + FileNames.CLEAN_FILE,
+            overwrite=True)
+
+    # GTI
+    start, stop = good_time_intervals(duration, gaps)
+    gti = fits.BinTableHDU.from_columns([
+        fits.Column('START', 'D', array=start + t0),
+        fits.Column('STOP', 'D', array=stop + t0)], name='STDGTI01')
+    fits.HDUList([fits.PrimaryHDU(), gti]).writeto(path + FileNames.GTI_FILE,
+            overwrite=True)
+
+    # Image binned by IMAGE_BIN sky pixels
+    size = int(np.ceil(keys['REFXLMAX'] / IMAGE_BIN))
+    image, xe, ye = np.histogram2d(y, x, bins=size, range=[[0.5,
+            keys['REFYLMAX'] + 0.5], [0.5, keys['REFXLMAX'] + 0.5]])
+    img = fits.PrimaryHDU(data=image.astype(np.int32))
+    for key, value in keys.items() :
+        img.header[key] = value
+    img.header['OBS_ID'] = obs_id
+    img.writeto(path + FileNames.IMG_FILE, overwrite=True)
+
+########################################################################
+
+
+def generate_observation(path, duration=20000.0, rate=10.0, gaps=(),
+        flares=(), seed=0, t0=0.0, obs_id='0000000001') :
+    """
+    Function generating a synthetic observation into a folder.
+    @param path: The observation folder
+    @param duration: The duration of the observation, in seconds
+    @param rate: The background count rate of the whole detector
+    @param gaps: List of (start, stop) bad time intervals, relative to t0
+    @param flares: List of Flare objects
+    @param seed: The seed of the random generator
+    @param t0: The start time of the observation
+    @param obs_id: The observation ID
+    @return: The number of events
+    """
+    events = synthetic_events(duration, rate, gaps, flares, seed, t0)
+    write_observation(path, events, duration, gaps, t0, obs_id, seed=seed)
+
+    return len(events)
+
+########################################################################
+#                                                                      #
+# Main programme                                                       #
+#                                                                      #
+########################################################################
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Generates a synthetic "
+            "EPIC-pn observation")
+    parser.add_argument("-path", help="Folder of the observation", type=str)
+    parser.add_argument("-duration", help="Duration in seconds",
+            default=20000.0, type=float)
+    parser.add_argument("-rate", help="Background count rate of the detector",
+            default=10.0, type=float)
+    parser.add_argument("-gaps", help="Bad time intervals, as start:stop in "
+            "seconds from the start", default=[], nargs='*', type=str)
+    parser.add_argument("-flares", help="Injected flares, as "
+            "ccd,rawx,rawy,start,duration,counts[,radius]", default=[],
+            nargs='*', type=str)
+    parser.add_argument("-seed", help="Seed of the random generator",
+            default=0, type=int)
+    args = parser.parse_args()
+
+    gaps   = [tuple(float(t) for t in gap.split(':')) for gap in args.gaps]
+    flares = [Flare.parse(flare) for flare in args.flares]
+    n = generate_observation(args.path, args.duration, args.rate, gaps,
+            flares, args.seed)
+    print(" {0} events written to {1}".format(n, args.path))
@@ -0,0 +1,236 @@
+# coding=utf-8
+
+########################################################################
+#                                                                      #
+# EXOD - EPIC-pn XMM-Newton Outburst Detector                          #
+#                                                                      #
+# Timing and memory telemetry of the detector stages                   #
+#                                                                      #
+# Inés Pastor Marazuela (2019) - ines.pastor.marazuela@gmail.com       #
+#                                                                      #
+########################################################################
+"""
+Instrumentation of the stages of the detector. Each stage records its wall
+time, its CPU time (including the worker processes), the resident memory
+at its start and at its end, the peak resident memory of the process, and
+counters set by the stage. A single stage can be profiled with cProfile or
+tracemalloc.
+"""
+
+# Built-in imports
+
+import os
+import time
+import json
+import resource
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+
+########################################################################
+
+
+def current_rss() :
+    """
+    Returns the current resident memory of the process in MB, or None if it
+    is not available.
+    """
+    try :
+        with open('/proc/self/statm') as f :
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (IOError, ValueError, IndexError) :
+        return None
+
+########################################################################
+
+
+def cpu_times() :
+    """
+    Returns the CPU time of the process and of its terminated children.
+    """
+    own      = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return own.ru_utime + own.ru_stime, \
+            children.ru_utime + children.ru_stime
+
+########################################################################
+
+
+def peak_rss() :
+    """
+    Returns the peak resident memory of the process and of its largest
+    terminated child, in MB.
+    """
+    own      = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return own.ru_maxrss / 2**10, children.ru_maxrss / 2**10
+
+########################################################################
+
+
+class Telemetry(object):
+    """
+    Records of the stages of a run.\n
+
+    Attributes:\n
+    records:   List of the records of the stages, in order\n
+    profile:   Name of the stage to profile, None to profile nothing\n
+    profiler:  'cprofile' or 'tracemalloc'\n
+    folder:    Folder where the profiling outputs are written
+    """
+
+    def __init__(self, profile=None, profiler='cprofile', folder='./'):
+        """
+        Constructor for Telemetry class.
+        """
+        super(Telemetry, self).__init__()
+
+        self.records  = []
+        self.profile  = profile
+        self.profiler = profiler
+        self.folder   = folder
+        self.start    = time.time()
+
+
+    @contextmanager
+    def stage(self, name, folder=None, **counts) :
+        """
+        Context manager recording a stage. It yields the dictionary of the
+        counters of the stage, which can be completed inside the block.
+        @param name: The name of the stage
+        @param folder: The folder of the profiling outputs of the stage,
+                       self.folder if None
+        @param counts: Information on the stage added to its record
+        """
+        folder = self.folder if folder == None else folder
+        record = {'stage' : name}
+        record.update(counts)
+        counters = record.setdefault('counts', {})
+
+        profiling = name == self.profile
+        if profiling and self.profiler == 'tracemalloc' :
+            tracemalloc.start()
+        elif profiling :
+            profile = cProfile.Profile()
+            profile.enable()
+
+        cpu0, children0 = cpu_times()
+        peak0, peak_children0 = peak_rss()
+        rss0 = current_rss()
+        wall0 = time.perf_counter()
+        try :
+            yield counters
+        finally :
+            wall = time.perf_counter() - wall0
+            cpu1, children1 = cpu_times()
+            peak, peak_children = peak_rss()
+
+            record['wall']           = wall
+            record['cpu']            = cpu1 - cpu0
+            record['cpu_children']   = children1 - children0
+            record['rss_start']      = rss0
+            record['rss']            = current_rss()
+            # The peaks are those of the process lifetime. They are known
+            # for the stage only if it raised them
+            record['process_peak_rss'] = peak
+            record['process_peak_rss_children'] = peak_children
+            record['peak_rss']       = peak if peak > peak0 else None
+            record['peak_rss_children'] = peak_children if \
+                    peak_children > peak_children0 else None
+
+            if profiling and self.profiler == 'tracemalloc' :
+                record['profile'] = self.write_tracemalloc(name, folder)
+            elif profiling :
+                profile.disable()
+                record['profile'] = self.write_cprofile(name, profile,
+                        folder)
+
+            self.records.append(record)
+
+
+    def write_cprofile(self, name, profile, folder) :
+        """
+        Writes the cProfile statistics of a stage, as a binary file and as
+        text sorted by cumulative time.
+        @return: The name of the binary file
+        """
+        file = folder + 'profile_{0}.prof'.format(name)
+        profile.dump_stats(file)
+        with open(folder + 'profile_{0}.txt'.format(name), 'w') as f :
+            stats = pstats.Stats(profile, stream=f)
+            stats.sort_stats('cumulative').print_stats(40)
+
+        return file
+
+
+    def write_tracemalloc(self, name, folder) :
+        """
+        Writes the largest allocations of a stage and stops tracemalloc.
+        @return: The name of the text file
+        """
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        file = folder + 'tracemalloc_{0}.txt'.format(name)
+        with open(file, 'w') as f :
+            f.write('# Traced memory: current {0:.1f} MB, peak {1:.1f} MB\n'
+                    .format(current / 2**20, peak / 2**20))
+            for stat in snapshot.statistics('lineno')[:40] :
+                f.write('{0}\n'.format(stat))
+
+        return file
+
+
+    def write(self, file, stages=None, **info) :
+        """
+        Writes the records to a JSON file. The records of an existing file
+        are kept, except those of the stages run again, and the summary of
+        each run is appended to its list of runs, so that a later run on the
+        same folder, e.g. rendering with --novar, does not lose the records
+        of the detection.
+        @param file: The JSON file
+        @param stages: The records written, all the records by default
+        @param info: Information on the run added to the file
+        """
+        start = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(self.start))
+        peak, peak_children = peak_rss()
+        run = {
+            'start'    : start,
+            'wall'     : time.time() - self.start,
+            'max_rss'  : peak,
+            'max_rss_children' : peak_children,
+            'stages'   : [],
+        }
+        run.update(info)
+
+        records = [dict(record, run=start) for record in (self.records if
+                stages == None else stages)]
+        run['stages'] = [record['stage'] for record in records]
+
+        data = {}
+        if os.path.isfile(file) :
+            try :
+                with open(file) as f :
+                    data = json.load(f)
+            except ValueError :
+                data = {}
+        if 'runs' not in data :
+            # File written before the runs were kept
+            data = {'runs' : [], 'stages' : data.get('stages', [])}
+
+        # A stage run again replaces its previous record
+        new = set([(record['stage'], record.get('tw')) for record in records])
+        data['stages'] = [record for record in data['stages'] if
+                (record['stage'], record.get('tw')) not in new] + records
+        data['runs'].append(run)
+        data.update([(key, value) for key, value in info.items()
+                if value != None])
+
+        with open(file + '.tmp', 'w') as f :
+            json.dump(data, f, indent=1, default=str)
+        os.replace(file + '.tmp', file)
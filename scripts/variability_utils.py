@@ -19,10 +19,26 @@ from math import *
 
 import numpy as np
 from numpy import inf
+import scipy.ndimage as nd
 
 # Internal imports
 
 from file_utils import *
+from sky_coordinates import raw_to_radec
+from gti_utils import good_time_fraction
+from mosaic import assemble, scatter, ccd_position, raw_position, \
+        CCD_SHAPE
+
+# Fields of the detected variable areas
+AREAS_DTYPE = [('CENTER_X', 'f8'), ('CENTER_Y', 'f8'), ('EXTENT_X', 'f8'),
+        ('EXTENT_Y', 'f8'), ('NPIX', 'i4')]
+
+# Bad columns of the EPIC-pn CCDs, as [ccd, rawx] with 0-based indices
+BAD_PIXELS = [[4,11], [4,12], [4,13], [5,12], [10,28]]
+
+# Valid pixels of the mosaic and number of valid pixels of each box, by bad
+# columns and box size
+_mosaic_masks = {}
 
 ########################################################################
 #                                                                      #
@@ -30,101 +46,414 @@ from file_utils import *
 #                                                                      #
 ########################################################################
 
+def _event_columns(data) :
+    """
+    Function returning the columns needed for the binning of an events list.
+    @param data: E round, either a list of FITS records or a record array
+    @return: The TIME, RAWX and RAWY columns as numpy arrays
+    """
+    if len(data) == 0 :
+        return np.zeros(0), np.zeros(0, dtype=np.int64), \
+                np.zeros(0, dtype=np.int64)
+
+    if isinstance(data, np.ndarray) :
+        time = np.asarray(data['TIME'], dtype=np.float64)
+        rawx = np.asarray(data['RAWX'], dtype=np.int64)
+        rawy = np.asarray(data['RAWY'], dtype=np.int64)
+    else :
+        time = np.fromiter((evt['TIME'] for evt in data), dtype=np.float64,
+                count=len(data))
+        rawx = np.fromiter((evt['RAWX'] for evt in data), dtype=np.int64,
+                count=len(data))
+        rawy = np.fromiter((evt['RAWY'] for evt in data), dtype=np.int64,
+                count=len(data))
+
+    return time, rawx, rawy
+
+########################################################################
+
+
+def count_events_loop(data, time_windows, time_interval) :
+    """
+    Reference implementation of the event counting, looping over the events.
+    Each event is added to the 3x3 pixels around its position.
+    @param data: E round, the list of events sorted by their TIME attribute
+    @param time_windows: The start time of each time window
+    @param time_interval: The duration of a time window
+    @return: The counts cube, of shape (64, 200, n_bins)
+    """
+    n_bins = len(time_windows)
+    counted_events = np.zeros([64,200,n_bins])
+
+    i = 0
+    for n in range(n_bins) :
+        while i < len(data) \
+                and data[i]['TIME'] <= time_windows[n] + time_interval :
+            j = int(data[i]['RAWX'])-1
+            k = int(data[i]['RAWY'])-1
+            for x in range(j-1,j+2) :
+                for y in range(k-1,k+2) :
+                    if 0<=x<64 and 0<=y<200 :
+                        counted_events[x][y][n] += 1
+            i += 1
+
+    return counted_events
+
+########################################################################
+
+
+def neighbourhood_sum(counts) :
+    """
+    Function summing the counts of the 3x3 neighbourhood of each pixel.
+    @param counts: counts cube padded with one pixel on each side of the
+                   two first axes, of shape (66, 202, n_bins)
+    @return: The spread counts cube, of shape (64, 200, n_bins)
+    """
+    rows = counts[:-2] + counts[1:-1] + counts[2:]
+
+    return rows[:, :-2] + rows[:, 1:-1] + rows[:, 2:]
+
+########################################################################
+
+
+def count_columns(time, rawx, rawy, time_windows, time_interval) :
+    """
+    Function counting the events of each pixel and time window from the event
+    columns. The events are binned into a padded grid, then spread over the
+    3x3 neighbourhood of each pixel with neighbourhood_sum.
+    @param time: The TIME column of the events
+    @param rawx: The RAWX column of the events
+    @param rawy: The RAWY column of the events
+    @param time_windows: The start time of each time window
+    @param time_interval: The duration of a time window
+    @return: The counts cube, of shape (64, 200, n_bins)
+    """
+    n_bins = len(time_windows)
+    rawx = np.asarray(rawx, dtype=np.int64)
+    rawy = np.asarray(rawy, dtype=np.int64)
+
+    # Time window of each event, the windows being closed on their right edge
+    n = np.searchsorted(np.asarray(time_windows) + time_interval, time,
+            side='left')
+
+    # Pixels of the padded grid. Events out of it do not reach the CCD
+    cdt = (n < n_bins) & (0 <= rawx) & (rawx < 66) & (0 <= rawy) & (rawy < 202)
+    flat = (rawx[cdt] * 202 + rawy[cdt]) * n_bins + n[cdt]
+
+    counts = np.bincount(flat, minlength=66 * 202 * n_bins)
+    counts = counts.reshape(66, 202, n_bins)
+
+    return neighbourhood_sum(counts)
+
+########################################################################
+
+
+def count_events_vectorized(data, time_windows, time_interval) :
+    """
+    Function counting the events of each pixel and time window with array
+    operations, see count_columns.
+    @param data: E round, the list of events (it does not need to be sorted)
+    @param time_windows: The start time of each time window
+    @param time_interval: The duration of a time window
+    @return: The counts cube, of shape (64, 200, n_bins)
+    """
+    time, rawx, rawy = _event_columns(data)
+
+    return count_columns(time, rawx, rawy, time_windows, time_interval)
+
+########################################################################
+
+
+def count_events(data, time_windows, time_interval, mode='vectorized') :
+    """
+    Function counting the events of each pixel and time window.
+    @param data: E round, the list of events sorted by their TIME attribute
+    @param time_windows: The start time of each time window
+    @param time_interval: The duration of a time window
+    @param mode: 'vectorized' for the array implementation, 'loop' for the
+                 reference implementation
+    @return: The counts cube, of shape (64, 200, n_bins)
+    """
+    if mode == 'vectorized' :
+        return count_events_vectorized(data, time_windows, time_interval)
+    elif mode == 'loop' :
+        return count_events_loop(data, time_windows, time_interval)
+    else :
+        raise ValueError("Unknown counting mode '{0}'".format(mode))
+
+########################################################################
+
+
+def integer_median(cube, max_histogram_size=2**23) :
+    """
+    Function computing the median of an integer cube along its last axis.
+    When the counts are small, the median is read from the cumulative
+    histogram of each pixel instead of partitioning its time series.
+    @param cube: Integer cube, with the time windows on the last axis
+    @param max_histogram_size: Maximal number of cells of the histograms
+    @return: The median of each pixel, as np.median would compute it
+    """
+    n = cube.shape[-1]
+    n_pix = cube.size // n if n != 0 else 0
+    max_value = int(cube.max()) if cube.size != 0 else 0
+
+    if cube.min() < 0 or (max_value + 1) * n_pix > max_histogram_size :
+        return np.median(cube, axis=-1)
+
+    # Histogram of the values of each pixel
+    n_values = max_value + 1
+    flat = np.arange(n_pix).reshape(cube.shape[:-1] + (1,)) * n_values + cube
+    hist = np.bincount(flat.ravel(), minlength=n_pix * n_values)
+    cumul = np.cumsum(hist.reshape(cube.shape[:-1] + (n_values,)), axis=-1)
+
+    # Lower and upper middle values, equal when n is odd
+    low  = np.argmax(cumul >= (n - 1) // 2 + 1, axis=-1)
+    high = np.argmax(cumul >= n // 2 + 1, axis=-1)
+
+    return (low + high) / 2
+
+########################################################################
+
+
+def variability_statistic(counted_events) :
+    """
+    Function computing the variability of each pixel from its time series,
+    V = max(max - median, |min - median|) / median, or V = max if the median
+    is zero.
+    @param counted_events: The counts cube, with the time windows on the
+                           last axis
+    @return: The matrix V_round
+    """
+    maximum = np.amax(counted_events, axis=-1)
+    minimum = np.amin(counted_events, axis=-1)
+    if np.issubdtype(counted_events.dtype, np.integer) :
+        median = integer_median(counted_events)
+    else :
+        median = np.median(counted_events, axis=-1)
+
+    deviation = np.maximum(maximum - median, np.absolute(minimum - median))
+    V_mat = np.divide(deviation, median, out=maximum.astype(np.float64),
+            where=median != 0)
+
+    return V_mat
+
+########################################################################
+
+
+def time_window_grid(start_time, end_time, time_interval, acceptable_ratio) :
+    """
+    Function dividing the observation into time windows.
+    @param  start_time:  The t0 instant of the observation
+    @param  end_time: THe tf instant of the observation
+    @param  time_interval:   The duration of a time window
+    @param  acceptable_ratio:  The acceptability ratio for a TW - good time ratio
+    @return: The start time of each time window
+    """
+    n_bins = int(np.ceil((end_time - start_time )/time_interval))
+    stop_time = start_time + n_bins*time_interval
+    if (stop_time - end_time)/time_interval > acceptable_ratio :
+        n_bins = n_bins - 1
+
+    return start_time + np.arange(n_bins) * time_interval
+
+########################################################################
+
+
+def projection_ratios(gti, time_windows, time_interval) :
+    """
+    Function computing the fraction of good time of each time window, for
+    any number of GTI edges within a window.
+    @param  gti:     G round, the list of TW cut-off the observation
+    @param  time_windows: The start time of each time window
+    @param  time_interval:   The duration of a time window
+    @return: The projection ratio of each time window
+    """
+    return good_time_fraction(gti, time_windows, time_interval)
+
+########################################################################
+
+
+def variability_from_counts(counted_events, projection_ratio,
+        acceptable_ratio) :
+    """
+    Function computing the variability from the counts cube.
+    @param  counted_events: The counts cube, of shape (64, 200, n_bins)
+    @param  projection_ratio: The projection ratio of each time window
+    @param  acceptable_ratio:  The acceptability ratio for a TW - good time ratio
+    @return: The matrix V_round
+    """
+    V_mat = np.ones(counted_events.shape[:2])
+
+    # Correcting with projection ratio
+    cdt = np.where(projection_ratio >= acceptable_ratio)[0]
+    counted_events = counted_events[:,:,cdt]
+    if np.any(projection_ratio[cdt] != 1) :
+        counted_events = counted_events / projection_ratio[cdt]
+
+    # Computing variability
+    if counted_events.shape[2] > 1 :
+        V_mat = variability_statistic(counted_events)
+
+    elif counted_events.shape[2] == 1 :
+        print("No data within the GTI")
+
+    return V_mat
+
+########################################################################
+
+
 def variability_computation(gti, time_interval, acceptable_ratio, start_time,
-		end_time, data) :
-	"""
-	Function implementing the variability calculation using average technique.
-	@param  gti:     G round, the list of TW cut-off the observation
-	@param  time_interval:   The duration of a time window
-	@param  acceptable_ratio:  The acceptability ratio for a TW - good time ratio
-	@param  start_time:  The t0 instant of the observation
-	@param  end_time: THe tf instant of the observation
-	@param  data:    E round, the list of events sorted by their TIME attribute
-	@return: The matrix V_round
-	"""
-
-	# Defining the variables and matrices
-	n_bins = int(np.ceil((end_time - start_time )/time_interval))
-	stop_time = start_time + n_bins*time_interval
-	if (stop_time - end_time)/time_interval > acceptable_ratio :
-		n_bins = n_bins - 1
-		stop_time = start_time + n_bins * time_interval
-
-	V_mat = np.ones([64,200])
-	counted_events = np.zeros([64,200,n_bins])
-	time_windows = np.arange(start_time, stop_time, time_interval)
-	projection_ratio = np.ones(n_bins)
-
-	# GTI
-	cdt_start = []
-	cdt_stop  = []
-	for l in range(len(gti['START'])):
-		start = np.where((time_windows[:] < gti[l]['START']) & \
-				(time_windows[:] + time_interval > gti[l]['START']))[0]
-		if len(start) != 0 :
-			cdt_start.append(start[0])
-		stop  = np.where((gti[l]['STOP'] > time_windows[:]) & \
-				(gti[l]['STOP'] < time_windows[:] + time_interval))[0]
-		if len(stop) != 0 :
-			cdt_stop.append(stop[0])
-
-	# Counting events
-	i = 0			# Data counts
-	n_last = None	# Last time window with a stop on it
-	for n in range(n_bins) :
-		# Good time
-		t0 = 0
-		tf = 0
-		if n in cdt_start :
-			t0 = gti[cdt_start.index(n)]['START']
-			n_last = None
-		else :
-			t0 = time_windows[n]
-		if n in cdt_stop :
-			tf = gti[cdt_stop.index(n)]['STOP']
-			n_last = n
-		else :
-			tf = time_windows[n] + time_interval
-		if n_last == None :
-			good_time = tf - t0
-			projection_ratio[n] = good_time / time_interval
-		else :
-			projection_ratio[n] = 0
-
-		# Counting events
-		while i < len(data) \
-				and data[i]['TIME'] <= time_windows[n] + time_interval :
-			j = int(data[i]['RAWX'])-1
-			k = int(data[i]['RAWY'])-1
-			for x in range(j-1,j+2) :
-				for y in range(k-1,k+2) :
-					if 0<=x<64 and 0<=y<200 :
-						counted_events[x][y][n] += 1
-			i += 1
-		i += 1
-
-	# Correcting with projection ratio
-	cdt = np.where(projection_ratio >= acceptable_ratio)[0]
-	counted_events = counted_events[:,:,cdt] / projection_ratio[cdt]
-	time_windows   = time_windows[cdt]
-
-	# Computing variability
-	if len(counted_events[0][0]) > 1 :
-		for i in range(len(counted_events)) :
-			for j in range(len(counted_events[i])) :
-				max = np.amax(counted_events[i][j])
-				min = np.amin(counted_events[i][j])
-				med = np.median(counted_events[i][j])
-				if med != 0 :
-					V_mat[i][j] = np.amax(
-							[(max - med),np.absolute(min - med)])/med
-				else :
-					V_mat[i][j] = max
-
-	elif len(counted_events[0][0]) == 1 :
-		print("No data within the GTI")
-
-	return V_mat
+        end_time, data, mode='vectorized') :
+    """
+    Function implementing the variability calculation using average technique.
+    @param  gti:     G round, the list of TW cut-off the observation
+    @param  time_interval:   The duration of a time window
+    @param  acceptable_ratio:  The acceptability ratio for a TW - good time ratio
+    @param  start_time:  The t0 instant of the observation
+    @param  end_time: THe tf instant of the observation
+    @param  data:    E round, the list of events sorted by their TIME attribute
+    @param  mode:    The counting mode, 'vectorized' or 'loop' (reference)
+    @return: The matrix V_round
+    """
+
+    time_windows = time_window_grid(start_time, end_time, time_interval,
+            acceptable_ratio)
+    projection_ratio = projection_ratios(gti, time_windows, time_interval)
+
+    # Counting events
+    counted_events = count_events(data, time_windows, time_interval, mode)
+
+    return variability_from_counts(counted_events, projection_ratio,
+            acceptable_ratio)
+
+########################################################################
+
+
+def rebin_counts(counted_events, factor, n_bins) :
+    """
+    Function summing adjacent time windows of a counts cube.
+    @param  counted_events: The counts cube, with the n_fine time windows on
+                            the last axis
+    @param  factor:  The number of windows summed together
+    @param  n_bins:  The number of output windows. The input must contain at
+                     least n_bins * factor windows
+    @return: The counts cube, with n_bins time windows on the last axis, a
+             view of the input when factor is 1
+    """
+    if factor == 1 :
+        return counted_events[..., :n_bins]
+
+    fine = counted_events[..., :n_bins * factor]
+
+    # The sums keep the type of the cube. A sum is the number of events of a
+    # pixel neighbourhood in a time window, at most the number of events of
+    # the observation, far below the int32 limit of 2**31
+    return fine.reshape(fine.shape[:-1] + (n_bins, factor)).sum(axis=-1,
+            dtype=counted_events.dtype)
+
+########################################################################
+
+
+def sweep_plan(time_intervals, acceptable_ratio, start_time, end_time) :
+    """
+    Function preparing the binning of several time windows from as few
+    countings of the events as possible. The time windows that are not
+    multiples of a smaller one are counted from the events, and the other
+    time windows are obtained by summing adjacent windows of the largest
+    counted time window dividing them.
+    @param  time_intervals:  The list of durations of the time windows
+    @param  acceptable_ratio:  The acceptability ratio for a TW - good time ratio
+    @param  start_time:  The t0 instant of the observation
+    @param  end_time: THe tf instant of the observation
+    @return: The list of (start times, duration) of the windows counted from
+             the events, covering all the time windows summed from them
+    @return: The start times of the windows of each time window
+    @return: The (index of the counted windows, rebinning factor) of each time
+             window
+    """
+    def factor(base, tw) :
+        """
+        Number of windows of duration base in tw, None if not a multiple.
+        """
+        n = int(round(tw / base))
+        return n if n > 0 and abs(tw - n * base) <= 1e-9 * tw else None
+
+    grids = [time_window_grid(start_time, end_time, tw, acceptable_ratio)
+            for tw in time_intervals]
+
+    bases = []
+    for tw in sorted(set(time_intervals)) :
+        if all([factor(base, tw) == None for base in bases]) :
+            bases.append(tw)
+
+    sources = []
+    for tw in time_intervals :
+        b = max([b for b, base in enumerate(bases) if factor(base, tw) != None],
+                key=lambda b : bases[b])
+        sources.append((b, factor(bases[b], tw)))
+
+    counted = []
+    for b, base in enumerate(bases) :
+        n_bins = max([len(grids[k]) * sources[k][1]
+                for k in range(len(time_intervals)) if sources[k][0] == b])
+        counted.append((start_time + np.arange(n_bins) * base, base))
+
+    return counted, grids, sources
+
+########################################################################
+
+
+def counts_sweep(gti, time_intervals, acceptable_ratio, start_time,
+        end_time, data, mode='vectorized') :
+    """
+    Function counting the events for several time windows with as few
+    binnings of the events as possible, see sweep_plan. The time windows that
+    are multiples of a counted one are obtained by summing its adjacent
+    windows.
+    @param  gti:     G round, the list of TW cut-off the observation
+    @param  time_intervals:  The list of durations of the time windows
+    @param  acceptable_ratio:  The acceptability ratio for a TW - good time ratio
+    @param  start_time:  The t0 instant of the observation
+    @param  end_time: THe tf instant of the observation
+    @param  data:    E round, the list of events sorted by their TIME attribute
+    @param  mode:    The counting mode, 'vectorized' or 'loop' (reference)
+    @return: The list of (counts cube, projection ratios), one per time window
+    """
+    counted, grids, sources = sweep_plan(time_intervals, acceptable_ratio,
+            start_time, end_time)
+    base_counts = [count_events(data, windows, base, mode)
+            for windows, base in counted]
+
+    counts = []
+    for k, tw in enumerate(time_intervals) :
+        b, factor = sources[k]
+        counted_events = rebin_counts(base_counts[b], factor, len(grids[k]))
+        counts.append((counted_events, projection_ratios(gti, grids[k], tw)))
+
+    return counts
+
+########################################################################
+
+
+def variability_sweep(gti, time_intervals, acceptable_ratio, start_time,
+        end_time, data, mode='vectorized') :
+    """
+    Function computing the variability for several time windows from a single
+    binning of the events, see counts_sweep.
+    @param  gti:     G round, the list of TW cut-off the observation
+    @param  time_intervals:  The list of durations of the time windows
+    @param  acceptable_ratio:  The acceptability ratio for a TW - good time ratio
+    @param  start_time:  The t0 instant of the observation
+    @param  end_time: THe tf instant of the observation
+    @param  data:    E round, the list of events sorted by their TIME attribute
+    @param  mode:    The counting mode, 'vectorized' or 'loop' (reference)
+    @return: The list of V_round matrices, one per time window
+    """
+    counts = counts_sweep(gti, time_intervals, acceptable_ratio, start_time,
+            end_time, data, mode)
+
+    return [variability_from_counts(counted_events, projection_ratio,
+            acceptable_ratio) for counted_events, projection_ratio in counts]
 
 
 ########################################################################
@@ -143,15 +472,15 @@ def box_computations(variability_matrix, x, y, box_size) :
     @param box_size:   The length of a side of a box
     @return: The sum of the variability for each pixel of the box
     """
-    assert x <= 63 - box_size
-    assert y <= 199 - box_size
+    assert x <= 64 - box_size
+    assert y <= 200 - box_size
     # Exception raised if box out of the limits of the CCD
 
     cpt = 0
 
     for i in range(x, x + box_size) :
         for j in range(y, y + box_size) :
-            cpt += variability_matrix[x][y]
+            cpt += variability_matrix[i][j]
 
     return cpt
 
@@ -195,80 +524,244 @@ def __add_to_detected_areas(x, y, box_size, detected_areas) :
 
 ########################################################################
 
-def variable_areas_detection(lower_limit, box_size, detection_level, variability_matrix) :
-	"""
-	Function detecting variable areas into a variability_matrix.
-	@param lower_limit:         The lower_limit value is the smallest
-								variability value needed to consider a pixel
-								variable
-	@param box_size:            The size of the box (optional, default = 3)
-	@param detection_level:     A factor for the limit of detection
-	@param variability_matrix:  The matrix returned by variability_calculation
-	@return: A list of sets of coordinates for each area detected as variable
-	"""
+def box_sums(variability_matrix, box_size) :
+    """
+    Function summing the variability values into every box of a matrix,
+    using its summed-area table.
+    @param variability_matrix:  The V round matrix
+    @param box_size:   The length of a side of a box
+    @return: The matrix of the box sums, indexed by the top-left corner of
+             each box, of shape (nx - box_size + 1, ny - box_size + 1)
+    """
+    sat = np.zeros((variability_matrix.shape[0] + 1,
+            variability_matrix.shape[1] + 1))
+    np.cumsum(np.cumsum(variability_matrix, axis=0), axis=1, out=sat[1:, 1:])
+
+    return sat[box_size:, box_size:] - sat[:-box_size, box_size:] \
+            - sat[box_size:, :-box_size] + sat[:-box_size, :-box_size]
+
+########################################################################
+
+
+def box_footprint(detected, box_size) :
+    """
+    Function computing the pixels covered by the boxes above detection level.
+    @param detected:  Boolean matrix of the boxes above detection level,
+                      indexed by their top-left corner
+    @param box_size:  The length of a side of a box
+    @return: Boolean matrix of the pixels belonging to a detected box
+    """
+    padded = np.pad(detected.astype(np.float64), box_size - 1, 'constant')
+
+    return box_sums(padded, box_size) > 0.5
+
+########################################################################
+
+
+def areas_statistics(labels, n_areas) :
+    """
+    Function computing the centroid, extent and size of labelled areas.
+    @param labels:   Matrix of the area label of each pixel, 0 outside areas
+    @param n_areas:  The number of labelled areas
+    @return: Record array of AREAS_DTYPE, one row per area
+    """
+    areas = np.zeros(n_areas, dtype=AREAS_DTYPE)
+    if n_areas == 0 :
+        return areas
+
+    # Coordinates and area index of the labelled pixels only
+    pixels = np.flatnonzero(labels)
+    area = labels.ravel()[pixels] - 1
+    x, y = np.divmod(pixels, labels.shape[1])
+
+    npix = np.bincount(area, minlength=n_areas)
+    center_x = np.bincount(area, x, minlength=n_areas) / npix
+    center_y = np.bincount(area, y, minlength=n_areas) / npix
+
+    # Largest distance to the centroid along each axis
+    extent_x = np.zeros(n_areas)
+    extent_y = np.zeros(n_areas)
+    np.maximum.at(extent_x, area, np.absolute(x - center_x[area]))
+    np.maximum.at(extent_y, area, np.absolute(y - center_y[area]))
+
+    areas['CENTER_X'] = center_x
+    areas['CENTER_Y'] = center_y
+    areas['EXTENT_X'] = extent_x
+    areas['EXTENT_Y'] = extent_y
+    areas['NPIX']     = npix
+
+    return areas
+
+########################################################################
+
+
+def areas_from_sets(detected_areas, shape=(64,200)) :
+    """
+    Function converting the sets of coordinates of the detected areas into
+    their statistics.
+    @param detected_areas:  The A round set, list of sets of coordinates
+    @param shape:           The shape of the variability matrix
+    @return: Record array of AREAS_DTYPE, one row per area
+    """
+    labels = np.zeros(shape, dtype=np.int64)
+    areas  = np.zeros(len(detected_areas), dtype=AREAS_DTYPE)
+
+    # Computing each area on its own, since the sets may overlap
+    for k, area in enumerate(detected_areas) :
+        labels[:] = 0
+        coords = np.array(sorted(area))
+        labels[coords[:,0], coords[:,1]] = 1
+        areas[k] = areas_statistics(labels, 1)[0]
+
+    return areas
+
+########################################################################
+
+
+def variable_areas_detection(lower_limit, box_size, detection_level,
+        variability_matrix, backend='label') :
+    """
+    Function detecting variable areas into a variability_matrix.
+    @param lower_limit:         The lower_limit value is the smallest
+                                variability value needed to consider a pixel
+                                variable, or the matrix of the lower limit of
+                                each pixel
+    @param box_size:            The size of the box (optional, default = 3)
+    @param detection_level:     A factor for the limit of detection
+    @param variability_matrix:  The matrix returned by variability_calculation
+    @param backend:             'label' to label the connected detected pixels,
+                                'sets' to merge the boxes as sets of
+                                coordinates (reference)
+    @return: Record array of AREAS_DTYPE, one row per area detected as variable
+    """
+
+    #detection_level = 4.56602579 * log10(TW) + 0.09141909
 
-	output = []
+    # Boxes above detection level
+    variability_matrix = np.asarray(variability_matrix, dtype=np.float64)
+    box_count = box_sums(variability_matrix, box_size)
+    if np.ndim(lower_limit) == 0 :
+        box_limit = (box_size**2) * lower_limit
+    else :
+        box_limit = box_sums(np.asarray(lower_limit, dtype=np.float64),
+                box_size)
+    detected = box_count > detection_level * box_limit
 
-	box_count = 0
+    if backend == 'label' :
+        labels, n_areas = nd.label(box_footprint(detected, box_size))
+        output = areas_statistics(labels, n_areas)
 
-	#detection_level = 4.56602579 * log10(TW) + 0.09141909
+    elif backend == 'sets' :
+        output = []
+        for i, j in zip(*np.nonzero(detected)) :
+            output = __add_to_detected_areas(int(i), int(j), box_size, output)
+        output = areas_from_sets(output, variability_matrix.shape)
 
-	for i in range(len(variability_matrix) - box_size) :
-		j = 0
-		m = 0	# boxes above detection level counter
-		while j < len(variability_matrix[i]) - box_size :
-			box_count = box_computations(variability_matrix, i, j, box_size)
+    else :
+        raise ValueError("Unknown detection backend '{0}'".format(backend))
 
-			# If there's nothing into the box, it is completely skipped
-			if box_count == 0 :
-				j += box_size
+    return output
+
+########################################################################
+
+
+def variable_areas_mosaic(lower_limit, box_size, detection_level,
+        variability_matrices, bad_pixels=BAD_PIXELS) :
+    """
+    Function detecting variable areas on the mosaic of the 12 CCDs in one
+    pass, so that the boxes and areas extend across the CCD boundaries. The
+    bad columns are masked, and the detection limit of a box is scaled to
+    the number of its valid pixels. Each area is assigned to the CCD of its
+    most variable pixel, and its centre is given in the raw coordinates of
+    that CCD, limited to the CCD.
+    @param lower_limit:          The smallest variability value needed to
+                                 consider a pixel variable, or the lower
+                                 limit of each pixel of each CCD
+    @param box_size:             The size of the box
+    @param detection_level:      A factor for the limit of detection
+    @param variability_matrices: The V round matrix of each CCD
+    @param bad_pixels:           The masked columns, as [ccd, rawx]
+    @return: Record array of AREAS_DTYPE for each CCD, as a list of 12
+    """
+    key = (tuple(map(tuple, bad_pixels)), box_size)
+    if key not in _mosaic_masks :
+        valid = np.ones((12,) + CCD_SHAPE, dtype=bool)
+        for ccd, col in bad_pixels :
+            valid[ccd, col] = False
+        valid = assemble(valid)
+        _mosaic_masks[key] = (valid, box_sums(valid.astype(np.float64),
+                box_size))
+    valid, n_valid = _mosaic_masks[key]
+
+    mosaic = np.where(valid, assemble(np.asarray(variability_matrices,
+            dtype=np.float64)), 0)
+
+    # Boxes above detection level, for their valid pixels
+    box_count = box_sums(mosaic, box_size)
+    if np.ndim(lower_limit) == 0 :
+        box_limit = n_valid * lower_limit
+    else :
+        box_limit = box_sums(np.where(valid, assemble(np.broadcast_to(
+                lower_limit, (12,) + CCD_SHAPE)), 0), box_size)
+    detected = (n_valid > 0.5) & (box_count > detection_level * box_limit)
+
+    labels, n_areas = nd.label(box_footprint(detected, box_size) & valid)
+    areas = areas_statistics(labels, n_areas)
+
+    # CCD of the most variable pixel of each area
+    pixels = np.flatnonzero(labels)
+    area = labels.ravel()[pixels]
+    order = np.lexsort((mosaic.ravel()[pixels], area))
+    peaks = pixels[order[np.searchsorted(area[order],
+            np.arange(1, n_areas + 1), side='right') - 1]]
+    ccd = ccd_position(*np.divmod(peaks, mosaic.shape[1]))[0]
+
+    rawx, rawy = raw_position(ccd, areas['CENTER_X'], areas['CENTER_Y'])
+    areas['CENTER_X'] = np.clip(rawx, 0, CCD_SHAPE[0] - 1)
+    areas['CENTER_Y'] = np.clip(rawy, 0, CCD_SHAPE[1] - 1)
+
+    return [areas[ccd == k] for k in range(12)]
 
-			else :
-				if box_count > detection_level * ((box_size**2) * lower_limit) :
-					output=__add_to_detected_areas(i, j, box_size, output)
-					m += 1
-				j += 1
+########################################################################
 
-	return output
 
 def variable_sources_position(variable_areas_matrix, obs, path_out, reg_file,
-		log_file, img_file) :
-	"""
-	Function computing the position of the detected varable sources.
-	@param variable_areas_matrix: variable_areas_detection output
-	@param obs: EPIC-pn OBSID. It will be written in the output file
-	@file_out: region file where the sources will be written
-	@return: astropy.table.Table object containing the source parameters
-	"""
-
-	sources = []
-	cpt_source = 0
-
-	# Computing source position
-	for ccd in range(12) :
-	    for source in variable_areas_matrix[ccd] :
-	        center_x = round(sum([p[0] for p in source]) / len(source), 2)
-	        center_y = round(sum([p[1] for p in source]) / len(source), 2)
-
-	        r = round(sqrt( (max([abs(p[0] - center_x)
-					for p in source]))**2 + (max([abs(p[1] - center_y)
-					for p in source]))**2 ), 2)
-
-	        # Avoiding bad pixels
-	        if [ccd, int(center_x)] not in [[4,11], [4,12], [4,13],
-					[5,12], [10,28]] :
-	            cpt_source += 1
-	            sources.append([cpt_source, ccd+1, center_x, center_y, r])
-
-
-	# Making output table
-	source_table = Table(names=('ID', 'CCDNR', 'RAWX', 'RAWY', 'RAWR',
-			'X', 'Y', 'SKYR', 'RA', 'DEC', 'R'),
-			dtype=('i2', 'i2', 'f8', 'f8', 'f8',
-			'f8', 'f8', 'f8', 'f8', 'f8', 'f8'))
-
-	# Head text
-	text = """# Region file format: DS9 version 4.0 global
+        log_file, img_file) :
+    """
+    Function computing the position of the detected varable sources.
+    @param variable_areas_matrix: variable_areas_detection output for each CCD
+    @param obs: EPIC-pn OBSID. It will be written in the output file
+    @file_out: region file where the sources will be written
+    @return: astropy.table.Table object containing the source parameters
+    """
+
+    sources = []
+    cpt_source = 0
+
+    # Computing source position
+    for ccd in range(12) :
+        areas = variable_areas_matrix[ccd]
+        center_x = np.round(areas['CENTER_X'], 2)
+        center_y = np.round(areas['CENTER_Y'], 2)
+        r = np.round(np.hypot(areas['EXTENT_X'], areas['EXTENT_Y']), 2)
+
+        # Avoiding bad pixels
+        bad_columns = [col for c, col in BAD_PIXELS if c == ccd]
+        good = ~np.isin(center_x.astype(int), bad_columns)
+
+        for k in np.nonzero(good)[0] :
+            cpt_source += 1
+            sources.append([cpt_source, ccd+1, center_x[k], center_y[k], r[k]])
+
+
+    # Making output table
+    source_table = Table(names=('ID', 'CCDNR', 'RAWX', 'RAWY', 'RAWR',
+            'X', 'Y', 'SKYR', 'RA', 'DEC', 'R'),
+            dtype=('i2', 'i2', 'f8', 'f8', 'f8',
+            'f8', 'f8', 'f8', 'f8', 'f8', 'f8'))
+
+    # Head text
+    text = """# Region file format: DS9 version 4.0 global
 # XMM-Newton OBSID {0}
 # Instrument PN
 # EXOD variable sources
@@ -278,18 +771,24 @@ j2000
 
 """.format(obs)
 
-	for i in range(len(sources)) :
-		# Getting Source class
-		src = Source(sources[i])
-		src.sky_coord(path_out, img_file, log_file)
-		# Adding source to table
-		source_table.add_row([src.id_src, src.ccd, src.rawx, src.rawy, src.rawr, src.x, src.y, src.skyr, src.ra, src.dec, src.r])
-		# ds9 text
-		text = text + 'circle {0}, {1}, {2}" # text="{3}"\n'.format(src.ra, src.dec, src.r, src.id_src)
-
-	# Writing region file
-	reg_f = open(reg_file, 'w')
-	reg_f.write(text)
-	reg_f.close()
-
-	return source_table
+    # Sky coordinates of all the sources
+    if len(sources) != 0 :
+        ccd, rawx, rawy = np.array(sources)[:,1:4].T
+        x, y, ra, dec = raw_to_radec(path_out, img_file, ccd, rawx, rawy,
+                log_file)
+
+    for i in range(len(sources)) :
+        # Getting Source class
+        src = Source(sources[i])
+        src.set_sky_coord(x[i], y[i], ra[i], dec[i])
+        # Adding source to table
+        source_table.add_row([src.id_src, src.ccd, src.rawx, src.rawy, src.rawr, src.x, src.y, src.skyr, src.ra, src.dec, src.r])
+        # ds9 text
+        text = text + 'circle {0}, {1}, {2}" # text="{3}"\n'.format(src.ra, src.dec, src.r, src.id_src)
+
+    # Writing region file
+    reg_f = open(reg_file, 'w')
+    reg_f.write(text)
+    reg_f.close()
+
+    return source_table